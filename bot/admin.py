@@ -1,12 +1,255 @@
+from collections import OrderedDict
+
 from django.contrib import admin
-from .models import Project, ReferralUser, Settings
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import (Count, DecimalField, ExpressionWrapper, F,
+                              IntegerField, OuterRef, Subquery, Sum)
+from django.db.models.functions import Coalesce
+from django.utils.html import format_html
+from .broadcast import create_project_broadcast
+from .models import (Broadcast, OrderNotification, Project, ReferralUser,
+                     Reward, Settings)
+from .referrals import REFERRAL_LEVELS
 
 
 @admin.register(Settings)
 class SettingsAdmin(admin.ModelAdmin):
     def has_add_permission(self, request):
-        return False if self.model.objects.count() > 0\
+        return False if self.model.objects.exists()\
                      else super().has_add_permission(request)
 
 
-admin.site.register(Project)
+@admin.register(OrderNotification)
+class OrderNotificationAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'telegram_status', 'email_status', 'attempts',
+                    'next_attempt')
+    list_filter = ('telegram_status', 'email_status')
+    readonly_fields = ('created',)
+
+
+@admin.register(Reward)
+class RewardAdmin(admin.ModelAdmin):
+    # Журнал начислений только дополняется при регистрации, изменение
+    # или удаление записи исказило бы балансы, поэтому записи доступны
+    # только для просмотра
+    list_display = ('__str__', 'user', 'invitee', 'level', 'created')
+    list_filter = ('level',)
+    raw_id_fields = ('user', 'invitee')
+    readonly_fields = ('user', 'invitee', 'level', 'amount', 'created')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def change_view(self, request, object_id, form_url='',
+                    extra_context=None):
+        extra_context = dict(extra_context or {}, show_save=False,
+                             show_save_and_continue=False)
+        return super().change_view(request, object_id, form_url,
+                                   extra_context)
+
+    def save_model(self, request, obj, form, change):
+        pass
+
+
+@admin.register(Broadcast)
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'status', 'sent', 'failed', 'blocked',
+                    'finished')
+    list_filter = ('status',)
+    readonly_fields = ('status', 'created', 'finished', 'position', 'sent',
+                       'failed', 'blocked')
+
+
+@admin.register(Project)
+class ProjectAdmin(admin.ModelAdmin):
+    list_display = ('title', 'preview')
+    actions = ('announce',)
+
+    def preview(self, obj):
+        if not obj.thumbnail:
+            return ''
+        return format_html('<img src="{}" height="60">', obj.thumbnail.url)
+    preview.short_description = 'Изображение'
+
+    def announce(self, request, queryset):
+        broadcasts = [create_project_broadcast(project)
+                      for project in queryset]
+        self.message_user(request, 'Создано рассылок: {}, их отправит '
+                                   'команда broadcast'.format(len(broadcasts)))
+    announce.short_description = 'Разослать анонс пользователям'
+
+
+# Параметр адреса списка пользователей: id, после которого начинается
+# страница
+AFTER_VAR = 'after'
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Класс списка объектов с постраничным выводом по id вместо OFFSET
+    и COUNT: страница - следующие list_per_page записей после
+    последнего показанного id, поэтому любая страница открывается
+    одинаково быстро при любом размере таблицы. Сортировка по столбцам
+    не поддерживается, записи всегда идут по id
+    """
+    def get_ordering(self, request, queryset):
+        return ['id']
+
+    def get_ordering_field_columns(self):
+        return OrderedDict()
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(AFTER_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        try:
+            after = int(self.params.get(AFTER_VAR, 0))
+        except ValueError:
+            raise IncorrectLookupParameters
+        rows = list(self.queryset.filter(id__gt=after).order_by('id')[
+            :self.list_per_page + 1
+        ])
+        self.result_list = rows[:self.list_per_page]
+        self.next_after = (self.result_list[-1].id
+                           if len(rows) > self.list_per_page else None)
+        self.first_page_url = (self.get_query_string(remove=[AFTER_VAR])
+                               if after else None)
+        self.next_page_url = (self.get_query_string({
+            AFTER_VAR: self.next_after
+        }) if self.next_after else None)
+        self.result_count = len(self.result_list)
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = bool(after or self.next_after)
+        self.paginator = None
+
+
+def ledger_tail(aggregate, output_field, **filters):
+    """
+    Функция возвращает подзапрос aggregate по начислениям пользователя,
+    еще не перенесенным в снимок
+    """
+    tail = Reward.objects.filter(
+        user=OuterRef('pk'), id__gt=OuterRef('ledger_position'), **filters
+    ).order_by().values('user').annotate(value=aggregate)
+    return Coalesce(Subquery(tail.values('value'),
+                             output_field=output_field), 0)
+
+
+class ParentFilter(admin.SimpleListFilter):
+    """
+    Класс фильтра пользователей по пригласившему: дерево раскрывается
+    по одному узлу, выбираются только приглашенные выбранного
+    пользователя
+    """
+    title = 'Пригласивший пользователь'
+    parameter_name = 'parent'
+
+    def lookups(self, request, model_admin):
+        choices = [('root', 'Без пригласившего')]
+        if self.value() and self.value().isdigit():
+            parent = ReferralUser.objects.filter(id=self.value()).first()
+            if parent is not None:
+                choices.append((self.value(), str(parent)))
+        return choices
+
+    def queryset(self, request, queryset):
+        if self.value() == 'root':
+            return queryset.filter(parent__isnull=True)
+        if self.value():
+            if not self.value().isdigit():
+                raise IncorrectLookupParameters
+            return queryset.filter(parent_id=self.value())
+        return queryset
+
+
+@admin.register(ReferralUser)
+class ReferralUserAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'telegram_id', 'inviter', 'children',
+                    'downline', 'user_balance')
+    list_filter = (ParentFilter,)
+    list_select_related = ('parent',)
+    # Поиск по точному chat_id или началу username, см. get_search_results
+    search_fields = ('=chat_id', '^username')
+    raw_id_fields = ('parent',)
+    readonly_fields = ('refer_code', 'ledger_position')
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_queryset(self, request):
+        # Статистика и баланс по снимку и начислениям, еще не
+        # перенесенным в него, одним запросом на страницу. Не зависят
+        # от границ узлов MPTT, которые в режиме closure устаревают
+        downline = sum((F('invited_level_{}'.format(level))
+                        for level in range(1, REFERRAL_LEVELS + 1)),
+                       ledger_tail(Count('id'), IntegerField(),
+                                   level__lte=REFERRAL_LEVELS))
+        balance = F('balance') + ledger_tail(
+            Sum('amount'), DecimalField(max_digits=50, decimal_places=2)
+        )
+        return super().get_queryset(request).annotate(
+            children_count=ExpressionWrapper(
+                F('invited_level_1') + ledger_tail(Count('id'),
+                                                   IntegerField(), level=1),
+                output_field=IntegerField()
+            ),
+            downline_count=ExpressionWrapper(downline,
+                                             output_field=IntegerField()),
+            balance_total=ExpressionWrapper(
+                balance, output_field=DecimalField(max_digits=50,
+                                                   decimal_places=2)
+            ),
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        # Поиск использует индексы chat_id и username: число ищется
+        # по точному совпадению, строка - по началу username диапазоном
+        # значений, LIKE индекс не использует
+        search_term = search_term.strip().lstrip('@')
+        if not search_term:
+            return queryset, False
+        if search_term.lstrip('-').isdigit():
+            return queryset.filter(chat_id=int(search_term)), False
+        return queryset.filter(username__gte=search_term,
+                               username__lt=search_term + '\uffff'), False
+
+    def telegram_id(self, obj):
+        return obj.chat_id
+    telegram_id.short_description = 'Идентификатор пользователя'
+
+    def inviter(self, obj):
+        if obj.parent is None:
+            return ''
+        return format_html('<a href="?parent={}">{}</a>', obj.parent_id,
+                           obj.parent)
+    inviter.short_description = 'Пригласивший пользователь'
+
+    def children(self, obj):
+        # Количество берется из статистики и журнала начислений,
+        # приглашенные загружаются только при раскрытии узла
+        return format_html('<a href="?parent={}">{} &rarr;</a>', obj.id,
+                           obj.children_count)
+    children.short_description = 'Приглашенные'
+
+    def downline(self, obj):
+        return obj.downline_count
+    downline.short_description = 'Сеть до {} уровня'.format(REFERRAL_LEVELS)
+
+    def user_balance(self, obj):
+        return obj.balance_total
+    user_balance.short_description = 'Баланс'
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class BotConfig(AppConfig):
     name = 'bot'
+
+    def ready(self):
+        from . import metrics, signals  # noqa: F401
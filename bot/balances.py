@@ -0,0 +1,203 @@
+"""
+Пересчет балансов и статистики приглашений всех пользователей
+по дереву. Пользователи загружаются в массивы NumPy, связь
+с пригласившим хранится номером его строки, поэтому предки
+следующего уровня и количество приглашенных каждого уровня считаются
+сразу для всех пользователей. Пересчет не использует поля вложенных
+множеств и не требует пересборки дерева в режиме closure.
+Суммы хранятся в копейках целыми числами
+"""
+from decimal import Decimal
+
+import numpy as np
+from django.db import connection
+from django.db.models import BigIntegerField, Count, F, Func, Max, Sum
+from django.db.models.functions import Cast, Coalesce
+
+from .database import write_queue
+from .models import ReferralUser, Reward
+from .referrals import REFERRAL_LEVELS
+
+# Поля статистики, которые есть у модели, по уровням
+INVITED_FIELDS = tuple('invited_level_{}'.format(level)
+                       for level in range(1, REFERRAL_LEVELS + 1))
+EARNED_FIELDS = tuple('earned_level_{}'.format(level)
+                      for level in range(1, REFERRAL_LEVELS + 1))
+
+
+def cents(expression):
+    """
+    Функция возвращает выражение суммы в копейках целым числом
+    """
+    if isinstance(expression, str):
+        expression = F(expression)
+    return Cast(Func(expression * 100, function='ROUND'), BigIntegerField())
+
+
+class UserArrays(object):
+    """
+    Класс полей пользователей в массивах NumPy в порядке id: id, chat_id,
+    номер строки пригласившего (-1 у пользователя без пригласившего)
+    и снимок баланса и статистики (суммы в копейках)
+    """
+    def __init__(self, chunk_size=10000):
+        fields = (['id', 'chat_id', 'inviter_id', 'ledger_position',
+                   'balance_cents'] + list(INVITED_FIELDS) +
+                  ['{}_cents'.format(field) for field in EARNED_FIELDS])
+        queryset = ReferralUser.objects.annotate(
+            inviter_id=Coalesce('parent_id', 0),
+            balance_cents=cents('balance'),
+            **{'{}_cents'.format(field): cents(field)
+               for field in EARNED_FIELDS}
+        ).order_by('id').values_list(*fields)
+        # В SQL поля модели идут перед вычисляемыми
+        columns = (list(queryset.query.values_select) +
+                   list(queryset.query.annotation_select))
+        order = [columns.index(field) for field in fields]
+        chunks = []
+        last = 0
+        while True:
+            # Все значения целые, поэтому строки читаются курсором
+            # без построчных преобразований ORM
+            sql, params = queryset.filter(
+                id__gt=last
+            )[:chunk_size].query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.int64)[:, order])
+            last = rows[-1][order[0]]
+        data = (np.concatenate(chunks) if chunks
+                else np.zeros((0, len(fields)), dtype=np.int64))
+        (self.id, self.chat_id, inviter_id, self.ledger_position,
+         self.balance) = data.T[:5]
+        self.invited = data[:, 5:5 + REFERRAL_LEVELS]
+        self.earned = data[:, 5 + REFERRAL_LEVELS:]
+        self.parent = self.index(inviter_id)
+
+    def __len__(self):
+        return len(self.id)
+
+    def index(self, ids):
+        """
+        Номера строк пользователей по id, -1 для отсутствующих
+        """
+        indexes = np.searchsorted(self.id, ids)
+        found = indexes < len(self.id)
+        found[found] = self.id[indexes[found]] == ids[found]
+        return np.where(found, indexes, -1)
+
+    def count_descendants(self, levels):
+        """
+        Количество приглашенных каждого пользователя на уровнях
+        1..levels: массив (пользователи, levels). На каждом уровне
+        для всех пользователей сразу берется предок следующего уровня
+        и считается, сколько раз встречается каждый предок
+        """
+        counts = np.zeros((len(self), levels), dtype=np.int64)
+        ancestors = self.parent
+        for depth in range(levels):
+            exists = ancestors >= 0
+            if not exists.any():
+                break
+            counts[:, depth] = np.bincount(ancestors[exists],
+                                           minlength=len(self))
+            ancestors = np.where(exists, self.parent[ancestors], -1)
+        return counts
+
+    def add_ledger_tail(self):
+        """
+        Добавляет к снимку начисления, еще не перенесенные в него,
+        и возвращает (баланс, приглашено, заработано) с их учетом
+        """
+        balance = self.balance.copy()
+        invited = self.invited.copy()
+        earned = self.earned.copy()
+        rows = Reward.objects.filter(
+            id__gt=F('user__ledger_position')
+        ).values_list('user_id', 'level').annotate(
+            count=Count('id'), amount=cents(Sum('amount'))
+        ).order_by()
+        for user_id, level, count, amount in rows.iterator():
+            index = np.searchsorted(self.id, user_id)
+            balance[index] += amount
+            if level <= REFERRAL_LEVELS:
+                invited[index, level - 1] += count
+                earned[index, level - 1] += amount
+        return balance, invited, earned
+
+
+def recompute_balances(rewards, chunk_size=10000):
+    """
+    Функция пересчитывает баланс и статистику всех пользователей
+    по дереву при начислениях rewards по уровням (в рублях).
+    Начисления не указанных уровней до REFERRAL_LEVELS равны нулю,
+    приглашенные на этих уровнях учитываются в статистике.
+    Возвращает массивы пользователей, текущие значения с учетом журнала,
+    новые значения и номер последнего начисления журнала
+    """
+    position = Reward.objects.aggregate(position=Max('id'))['position'] or 0
+    users = UserArrays(chunk_size)
+    rewards = [int(Decimal(reward) * 100) for reward in rewards]
+    rewards.extend([0] * (REFERRAL_LEVELS - len(rewards)))
+    rewards = np.array(rewards, dtype=np.int64)
+    counts = users.count_descendants(len(rewards))
+    earned = counts * rewards
+    current = users.add_ledger_tail()
+    computed = (earned.sum(axis=1), counts[:, :REFERRAL_LEVELS],
+                earned[:, :REFERRAL_LEVELS])
+    return users, current, computed, position
+
+
+def changed_rows(current, computed):
+    """
+    Функция возвращает маску пользователей, у которых пересчитанные
+    значения отличаются от текущих
+    """
+    return ((current[0] != computed[0]) |
+            (current[1] != computed[1]).any(axis=1) |
+            (current[2] != computed[2]).any(axis=1))
+
+
+def save_balances(users, computed, position, chunk_size=10000):
+    """
+    Функция сохраняет пересчитанные значения как новый снимок,
+    учитывающий журнал до начисления position. Записываются только
+    пользователи, у которых изменился снимок или позиция журнала,
+    пачками по chunk_size строк в одной транзакции.
+    Возвращает количество записанных пользователей
+    """
+    balance, invited, earned = computed
+    mask = ((users.balance != balance) |
+            (users.invited != invited).any(axis=1) |
+            (users.earned != earned).any(axis=1) |
+            (users.ledger_position != position))
+    indexes = np.flatnonzero(mask)
+    columns = (['balance'] + list(INVITED_FIELDS) + list(EARNED_FIELDS) +
+               ['ledger_position'])
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        connection.ops.quote_name(ReferralUser._meta.db_table),
+        ', '.join('{} = %s'.format(connection.ops.quote_name(column))
+                  for column in columns),
+        connection.ops.quote_name('id')
+    )
+    for start in range(0, len(indexes), chunk_size):
+        params = [
+            [to_decimal(balance[index])] +
+            [int(value) for value in invited[index]] +
+            [to_decimal(value) for value in earned[index]] +
+            [position, int(users.id[index])]
+            for index in indexes[start:start + chunk_size]
+        ]
+        with write_queue.write(), connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+    return len(indexes)
+
+
+def to_decimal(value):
+    """
+    Функция переводит сумму в копейках в Decimal рублей
+    """
+    return Decimal(int(value)).scaleb(-2)
@@ -0,0 +1,490 @@
+"""
+Замер производительности обработчиков бота на синтетических обновлениях.
+Обновления проходят через настоящий диспетчер с обработчиками из
+bot.telegrambot.main(), запросы к Telegram подменяются заглушкой
+"""
+import json
+import multiprocessing
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from django.db import OperationalError, connection, connections, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+from . import telegrambot
+from .database import write_queue
+from .ledger import get_statistics, record_rewards
+from .models import (OrderNotification, Project, QueuedUpdate,
+                     ReferralUser, Settings)
+from .referrals import make_referral_token
+from .tree import get_tree
+from .updates import UpdateConsumer, get_chat_id
+
+BOT_ID = 100000
+# Идентификаторы чатов синтетических пользователей
+FIRST_CHAT_ID = 1000000
+UNLIMITED = {'RATE': float('inf'), 'BURST': float('inf'),
+             'DUPLICATE_WINDOW': 0}
+
+
+@contextmanager
+def benchmark_cache():
+    """
+    Функция подменяет общий кэш временным каталогом на время замера.
+    Иначе замер меняет версии кэшей и данные работающего бота.
+    Кэш файловый, чтобы его видели процессы обработчиков очереди.
+    Подходит и как декоратор команды замера
+    """
+    location = tempfile.mkdtemp()
+    caches = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': location,
+        }
+    }
+    try:
+        with override_settings(CACHES=caches):
+            yield
+    finally:
+        shutil.rmtree(location, ignore_errors=True)
+
+
+class StubRequest(object):
+    """
+    Класс заглушки HTTP-запросов к Telegram.
+    Запоминает исходящие вызовы и возвращает правдоподобные ответы
+    """
+    def __init__(self):
+        self.calls = Counter()
+        self.message_id = 0
+
+    def get(self, url, timeout=None):
+        return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Benchmark',
+                'username': 'benchmark_bot'}
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        self.calls[method] += 1
+        if method.startswith(('send', 'edit')):
+            self.message_id += 1
+            return {'message_id': self.message_id, 'date': int(time.time()),
+                    'chat': {'id': data.get('chat_id', 0), 'type': 'private'}}
+        return True
+
+    def stop(self):
+        pass
+
+
+class UpdateFactory(object):
+    """
+    Класс для создания синтетических обновлений Telegram
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def _next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, chat_id, text=None, contact=None):
+        user = {'id': chat_id, 'is_bot': False, 'first_name': 'User',
+                'last_name': str(chat_id),
+                'username': 'user{}'.format(chat_id)}
+        message = {
+            'message_id': self._next_id(),
+            'date': int(time.time()),
+            'chat': dict(user, type='private'),
+            'from': user,
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                        'length': len(text.split()[0])}]
+        if contact is not None:
+            message['contact'] = {'phone_number': contact,
+                                  'first_name': 'User', 'user_id': chat_id}
+        return Update.de_json({'update_id': self.update_id,
+                               'message': message}, self.bot)
+
+
+class Benchmark(object):
+    """
+    Класс прогона обновлений через диспетчер с замером времени
+    и количества SQL-запросов для каждого типа обновления
+    """
+    def __init__(self, seed=0):
+        self.request = StubRequest()
+        self.bot = Bot('{}:benchmark'.format(BOT_ID), request=self.request)
+        self.dispatcher = Dispatcher(self.bot, None, workers=0)
+        # Синтетические чаты шлют запросы чаще живых пользователей,
+        # ограничение частоты для замера отключается
+        with override_settings(BOT_RATE_LIMIT=UNLIMITED):
+            telegrambot.main(self.dispatcher)
+        self.updates = UpdateFactory(self.bot)
+        self.random = random.Random(seed)
+        self.results = OrderedDict()
+        self.next_chat_id = FIRST_CHAT_ID
+        self.chat_ids = []
+
+    def process(self, kind, update):
+        """
+        Обработка одного обновления с замером
+        """
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            self.dispatcher.process_update(update)
+            elapsed = time.perf_counter() - started
+        self.results.setdefault(kind, []).append((elapsed, len(queries)))
+
+    def new_chat_id(self):
+        self.next_chat_id += 1
+        return self.next_chat_id
+
+    def referral_code(self, chat_id):
+        return make_referral_token(ReferralUser.objects.values_list(
+            'id', flat=True
+        ).get(chat_id=chat_id))
+
+    def seed(self, projects):
+        """
+        Заполнение базы настройками и проектами
+        """
+        owner = ReferralUser.objects.create(chat_id=self.new_chat_id(),
+                                            name='Owner')
+        Settings.objects.create(email='owner@example.com', telegram=owner,
+                                referrals_description='Описание',
+                                order_text='Текст заказа')
+        for number in range(projects):
+            Project.objects.create(title='Проект {}'.format(number),
+                                   description='Описание проекта ' * 20,
+                                   link='https://example.com/')
+
+    def start_storm(self, users):
+        """
+        Регистрация пользователей, большинство по реферальной ссылке
+        """
+        for _ in range(users):
+            chat_id = self.new_chat_id()
+            if self.chat_ids and self.random.random() < 0.9:
+                parent = self.random.choice(self.chat_ids)
+                text = '/start {}'.format(self.referral_code(parent))
+                kind = 'start_referral'
+            else:
+                text = '/start'
+                kind = 'start'
+            self.process(kind, self.updates.message(chat_id, text))
+            self.chat_ids.append(chat_id)
+        # Повторный /start уже зарегистрированных пользователей
+        for chat_id in self.random.sample(self.chat_ids,
+                                          min(users, len(self.chat_ids))):
+            self.process('start_repeat', self.updates.message(chat_id,
+                                                              '/start'))
+
+    def menu_browsing(self, clicks):
+        """
+        Переходы по меню и просмотр проектов
+        """
+        labels = list(telegrambot.router.routes)
+        titles = list(Project.objects.values_list('title', flat=True))
+        for _ in range(clicks):
+            chat_id = self.random.choice(self.chat_ids)
+            if titles and self.random.random() < 0.3:
+                self.process('project', self.updates.message(
+                    chat_id, self.random.choice(titles)
+                ))
+            else:
+                label = self.random.choice(labels)
+                self.process('menu:{}'.format(label),
+                             self.updates.message(chat_id, label))
+
+    def deep_tree(self, depth):
+        """
+        Цепочка приглашений глубины depth и просмотр приглашенных
+        пользователями с большой сетью
+        """
+        chain = []
+        for _ in range(depth):
+            chat_id = self.new_chat_id()
+            text = '/start'
+            if chain:
+                text += ' {}'.format(self.referral_code(chain[-1]))
+            self.process('start_deep', self.updates.message(chat_id, text))
+            chain.append(chat_id)
+            # У каждого звена несколько приглашенных без своей сети
+            for _ in range(3):
+                child = self.new_chat_id()
+                self.process('start_deep', self.updates.message(
+                    child, '/start {}'.format(self.referral_code(chat_id))
+                ))
+        for chat_id in chain:
+            self.process('referrals', self.updates.message(
+                chat_id, 'Список приглашенных'
+            ))
+            self.process('balance', self.updates.message(chat_id, 'Баланс'))
+        self.chat_ids.extend(chain)
+
+    def orders(self, count):
+        """
+        Полные диалоги оформления заказа
+        """
+        for chat_id in self.random.sample(self.chat_ids,
+                                          min(count, len(self.chat_ids))):
+            steps = [
+                self.updates.message(chat_id, 'Заказать'),
+                self.updates.message(chat_id, 'Сделать заказ'),
+                self.updates.message(chat_id, 'Да'),
+                self.updates.message(chat_id, contact='+79990000000'),
+                self.updates.message(chat_id, 'user@example.com'),
+            ]
+            for update in steps:
+                self.process('order', update)
+
+    def report(self):
+        """
+        Сводка по типам обновлений: количество, пропускная способность,
+        задержка p50/p99 и среднее число SQL-запросов
+        """
+        rows = []
+        for kind, results in self.results.items():
+            durations = sorted(elapsed for elapsed, queries in results)
+            total = sum(durations)
+            rows.append(OrderedDict([
+                ('kind', kind),
+                ('count', len(results)),
+                ('per_second', len(results) / total if total else 0),
+                ('p50_ms', percentile(durations, 50) * 1000),
+                ('p99_ms', percentile(durations, 99) * 1000),
+                ('queries', sum(queries for elapsed, queries in results) /
+                 len(results)),
+            ]))
+        return rows
+
+
+class QueueBenchmark(Benchmark):
+    """
+    Класс прогона обновлений через очередь несколькими процессами
+    команды consume_updates. Обновления разных чатов перемешаны,
+    обновления одного чата идут по порядку
+    """
+    def workload(self, clicks, orders):
+        """
+        Список обновлений: переходы по меню и диалоги заказа
+        """
+        labels = list(telegrambot.router.routes)
+        chats = {}
+        for _ in range(clicks):
+            chat_id = self.random.choice(self.chat_ids)
+            chats.setdefault(chat_id, []).append(
+                self.updates.message(chat_id, self.random.choice(labels))
+            )
+        for chat_id in self.random.sample(self.chat_ids,
+                                          min(orders, len(self.chat_ids))):
+            chats.setdefault(chat_id, []).extend([
+                self.updates.message(chat_id, 'Заказать'),
+                self.updates.message(chat_id, 'Сделать заказ'),
+                self.updates.message(chat_id, 'Да'),
+                self.updates.message(chat_id, contact='+79990000000'),
+                self.updates.message(chat_id, 'user@example.com'),
+            ])
+        updates = []
+        queues = [list(reversed(queue)) for queue in chats.values()]
+        while queues:
+            queue = self.random.choice(queues)
+            updates.append(queue.pop().to_dict())
+            if not queue:
+                queues.remove(queue)
+        return updates
+
+    def replay(self, updates, workers, batch_size=100):
+        """
+        Обработка обновлений workers процессами, возвращает время
+        обработки и количество оформленных заказов
+        """
+        QueuedUpdate.objects.all().delete()
+        OrderNotification.objects.all().delete()
+        QueuedUpdate.objects.bulk_create([
+            QueuedUpdate(bot_id=str(BOT_ID), update_id=data['update_id'],
+                         chat_id=get_chat_id(data), data=json.dumps(data))
+            for data in updates
+        ])
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=self.consume,
+                                    args=(shard, workers, batch_size))
+            for shard in range(workers)
+        ]
+        started = time.perf_counter()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - started
+        return elapsed, OrderNotification.objects.count()
+
+    def consume(self, shard, shards, batch_size):
+        UpdateConsumer(batch_size=batch_size, shard=shard, shards=shards,
+                       dispatchers={str(BOT_ID): self.dispatcher}).drain()
+        connections.close_all()
+
+
+class TreeBenchmark(object):
+    """
+    Класс замера регистрации пользователей и чтения списка приглашенных
+    в одном из режимов хранения дерева. Пригласивший выбирается
+    случайно среди уже зарегистрированных, как при вирусном росте
+    """
+    def __init__(self, backend, seed=0):
+        self.tree = get_tree(backend)
+        self.random = random.Random(seed)
+        self.user_ids = []
+        self.next_chat_id = FIRST_CHAT_ID
+
+    def signup(self, parent_id=None):
+        """
+        Регистрация одного пользователя так же, как в команде /start
+        """
+        parent = None
+        if parent_id is not None:
+            parent = ReferralUser.objects.get(id=parent_id)
+        self.next_chat_id += 1
+        with transaction.atomic():
+            user, ancestors = self.tree.create_user(
+                chat_id=self.next_chat_id,
+                name='User {}'.format(self.next_chat_id),
+                parent=parent
+            )
+            if ancestors:
+                record_rewards(user, ancestors)
+        self.user_ids.append(user.id)
+
+    def grow(self, users, batch_size):
+        """
+        Регистрация users пользователей, для каждой пачки возвращает
+        общее число пользователей и скорость регистрации
+        """
+        if not self.user_ids:
+            self.signup()
+        while len(self.user_ids) < users:
+            count = min(batch_size, users - len(self.user_ids))
+            started = time.perf_counter()
+            for _ in range(count):
+                self.signup(self.random.choice(self.user_ids))
+            elapsed = time.perf_counter() - started
+            yield len(self.user_ids), count / elapsed
+
+    def read(self, samples):
+        """
+        Замер первой страницы приглашенных и счетчиков по уровням
+        для случайных пользователей, возвращает p50 и p99 в мс
+        """
+        durations = []
+        for user_id in self.random.sample(self.user_ids,
+                                          min(samples, len(self.user_ids))):
+            user = ReferralUser.objects.get(id=user_id)
+            started = time.perf_counter()
+            self.tree.first_referrals_page(user)
+            durations.append(time.perf_counter() - started)
+        durations.sort()
+        return (percentile(durations, 50) * 1000,
+                percentile(durations, 99) * 1000)
+
+
+class DatabaseBenchmark(TreeBenchmark):
+    """
+    Класс замера одновременной работы потоков бота с базой данных:
+    каждый поток регистрирует пользователей так же, как команда /start,
+    и читает статистику и список приглашенных случайных пользователей.
+    Ошибки базы данных, например "database is locked", считаются
+    неудачными операциями
+    """
+    def __init__(self, backend, seed=0):
+        super().__init__(backend, seed)
+        self._lock = threading.Lock()
+
+    def signup(self, parent_id=None):
+        with self._lock:
+            self.next_chat_id += 1
+            chat_id = self.next_chat_id
+        parent = None
+        if parent_id is not None:
+            parent = ReferralUser.objects.get(id=parent_id)
+        with write_queue.write():
+            user, ancestors = self.tree.create_user(
+                chat_id=chat_id, name='User {}'.format(chat_id),
+                parent=parent
+            )
+            if ancestors:
+                record_rewards(user, ancestors)
+        self.user_ids.append(user.id)
+
+    def view(self, user_id):
+        """
+        Чтение статистики и первой страницы приглашенных пользователя
+        """
+        user = ReferralUser.objects.get(id=user_id)
+        get_statistics(user)
+        self.tree.first_referrals_page(user)
+
+    def worker(self, operations, write_ratio, seed, results):
+        generator = random.Random(seed)
+        done = failed = 0
+        try:
+            for _ in range(operations):
+                user_id = generator.choice(self.user_ids)
+                try:
+                    if generator.random() < write_ratio:
+                        self.signup(user_id)
+                    else:
+                        self.view(user_id)
+                except OperationalError:
+                    failed += 1
+                else:
+                    done += 1
+        finally:
+            connection.close()
+        with self._lock:
+            results.append((done, failed))
+
+    def run(self, threads, operations, write_ratio):
+        """
+        Выполнение operations операций в каждом из threads потоков,
+        возвращает количество успешных операций в секунду и количество
+        ошибок
+        """
+        if not self.user_ids:
+            self.signup()
+        results = []
+        workers = [
+            threading.Thread(target=self.worker, args=(
+                operations, write_ratio, self.random.random(), results
+            ))
+            for _ in range(threads)
+        ]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        done = sum(done for done, failed in results)
+        failed = sum(failed for done, failed in results)
+        return done / elapsed, failed
+
+
+def percentile(values, percent):
+    """
+    Функция возвращает перцентиль отсортированного списка
+    """
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(len(values) * percent / 100))
+    return values[index]
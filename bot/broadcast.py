@@ -0,0 +1,159 @@
+"""
+Рассылка сообщений всем пользователям бота.
+Пользователи читаются пачками по id, сообщения отправляются
+несколькими потоками с общим ограничением частоты. Ответ Telegram 429
+останавливает отправку всеми потоками на указанное время.
+После каждой пачки прогресс сохраняется в рассылке, прерванная
+рассылка продолжается с места остановки
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from telegram.error import (BadRequest, NetworkError, RetryAfter,
+                            Unauthorized)
+
+from .cache import user_cache
+from .metrics import metrics
+from .models import Broadcast, ReferralUser
+from .telegrambot import render_project
+
+
+logger = logging.getLogger(__name__)
+
+SENT, FAILED, BLOCKED = 'sent', 'failed', 'blocked'
+# Количество попыток отправки одного сообщения при сетевых ошибках
+MAX_ATTEMPTS = 3
+
+
+class RateScheduler(object):
+    """
+    Класс общего для потоков ограничения частоты отправки по алгоритму
+    token bucket: acquire() ждет, пока в ведре появится токен.
+    pause() останавливает выдачу токенов на заданное время
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self.updated:
+                    self.tokens = min(self.burst, self.tokens +
+                                      (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.updated - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+def get_broadcast_options():
+    """
+    Функция возвращает настройку BOT_BROADCAST
+    """
+    return getattr(settings, 'BOT_BROADCAST', {})
+
+
+def create_project_broadcast(project):
+    """
+    Функция создания рассылки с анонсом проекта
+    """
+    return Broadcast.objects.create(
+        text='Новый проект!\n{}'.format(render_project(project)),
+        parse_mode='HTML'
+    )
+
+
+def send_message(bot, scheduler, chat_id, broadcast):
+    """
+    Функция отправки сообщения рассылки одному пользователю,
+    возвращает результат отправки. После ответа 429 сообщение
+    отправляется повторно, после сетевой ошибки - не больше
+    MAX_ATTEMPTS раз
+    """
+    attempt = 0
+    while True:
+        scheduler.acquire()
+        started = time.perf_counter()
+        try:
+            bot.sendMessage(chat_id, broadcast.text,
+                            parse_mode=broadcast.parse_mode or None)
+        except RetryAfter as e:
+            logger.warning('Превышен лимит Telegram, пауза %s с',
+                           e.retry_after)
+            scheduler.pause(e.retry_after)
+        except Unauthorized:
+            return BLOCKED
+        except BadRequest as e:
+            if 'chat not found' in str(e).lower():
+                return BLOCKED
+            logger.error('Ошибка рассылки в чат %s: %s', chat_id, e)
+            return FAILED
+        except NetworkError as e:
+            logger.warning('Ошибка сети при рассылке в чат %s: %s',
+                           chat_id, e)
+            attempt += 1
+            if attempt >= MAX_ATTEMPTS:
+                return FAILED
+            time.sleep(attempt)
+        else:
+            metrics.observe('broadcast:send',
+                            (time.perf_counter() - started) * 1000)
+            return SENT
+
+
+def send_broadcast(bot, broadcast, rate=25, workers=8, batch_size=500):
+    """
+    Функция отправки рассылки пользователям, которые не заблокировали
+    бота, начиная с сохраненной позиции
+    """
+    scheduler = RateScheduler(rate)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            users = list(ReferralUser.objects.filter(
+                is_blocked=False, id__gt=broadcast.position
+            ).order_by('id').values_list('id', 'chat_id')[:batch_size])
+            if not users:
+                break
+            results = list(executor.map(
+                lambda user: send_message(bot, scheduler, user[1],
+                                          broadcast),
+                users
+            ))
+            blocked = [user for user, result in zip(users, results)
+                       if result == BLOCKED]
+            if blocked:
+                ReferralUser.objects.filter(
+                    id__in=[user_id for user_id, chat_id in blocked]
+                ).update(is_blocked=True)
+                # Повторный /start должен снять отметку, поэтому
+                # пользователи перечитываются из базы данных
+                user_cache.evict([chat_id for user_id, chat_id in blocked])
+            broadcast.position = users[-1][0]
+            Broadcast.objects.filter(id=broadcast.id).update(
+                position=broadcast.position,
+                sent=F('sent') + results.count(SENT),
+                failed=F('failed') + results.count(FAILED),
+                blocked=F('blocked') + len(blocked),
+            )
+    Broadcast.objects.filter(id=broadcast.id).update(
+        status=Broadcast.DONE, finished=timezone.now()
+    )
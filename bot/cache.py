@@ -0,0 +1,293 @@
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from .models import Project, ReferralUser, Settings
+from .state import MISSING, MemoryStateStore
+
+
+def get_check_interval():
+    """
+    Функция возвращает настройку BOT_CACHE_CHECK_INTERVAL
+    """
+    return getattr(settings, 'BOT_CACHE_CHECK_INTERVAL', 1)
+
+
+class VersionedCache(object):
+    """
+    Класс кэша значения в памяти процесса.
+    Значение загружается один раз и перечитывается только после сброса.
+    Номер версии хранится в общем кэше Django, поэтому сброс в одном
+    процессе заставляет остальные процессы перечитать значение.
+    Общий кэш проверяется не чаще раза в BOT_CACHE_CHECK_INTERVAL
+    секунд, сброс в этом же процессе виден сразу
+    """
+    def __init__(self, key, loader):
+        self.version_key = 'bot:version:{}'.format(key)
+        self.loader = loader
+        # Версия и значение заменяются одним кортежем, поэтому поток,
+        # читающий кэш во время сброса, получает прежнее значение
+        # или новое, но не пустое
+        self._loaded = None
+        # Время последней проверки версии и номер сброса в этом процессе
+        # на момент проверки
+        self._checked = None
+        self._resets = 0
+        # Номер загрузки в этом процессе, по нему зависимые кэши
+        # узнают, что значение изменилось
+        self.generation = 0
+
+    def get(self):
+        now = time.monotonic()
+        resets = self._resets
+        loaded = self._loaded
+        checked = self._checked
+        if (loaded is not None and checked is not None and
+                checked[1] == resets and
+                now - checked[0] < get_check_interval()):
+            return loaded[1]
+        version = cache.get(self.version_key)
+        if loaded is None or version != loaded[0]:
+            # Версию запоминаем до загрузки, чтобы сброс во время загрузки
+            # не потерялся
+            loaded = (version, self.loader())
+            self._loaded = loaded
+            self.generation += 1
+        self._checked = (now, resets)
+        return loaded[1]
+
+    def invalidate(self):
+        """
+        Сброс значения во всех процессах: меняется номер версии, значение
+        перечитывается при следующем обращении. Вызывается после
+        фиксации транзакции, иначе другой процесс может перечитать
+        старые данные под новой версией
+        """
+        cache.set(self.version_key, uuid4().hex, None)
+        self._resets += 1
+
+
+class DerivedCache(object):
+    """
+    Класс кэша значения, вычисляемого из значений других кэшей.
+    Значение пересчитывается, только когда перезагрузился один из них
+    """
+    def __init__(self, loader, *sources):
+        self.loader = loader
+        self.sources = sources
+        self._generations = None
+        self._value = None
+
+    def get(self):
+        for source in self.sources:
+            source.get()
+        generations = tuple(source.generation for source in self.sources)
+        if generations != self._generations:
+            self._value = self.loader()
+            self._generations = generations
+        return self._value
+
+
+def load_settings():
+    """
+    Функция загрузки единственной записи настроек бота
+    """
+    return Settings.objects.select_related('telegram').first()
+
+
+settings_cache = VersionedCache('settings', load_settings)
+
+
+def get_settings():
+    """
+    Функция возвращает закэшированные настройки бота или None,
+    если настройки еще не добавлены
+    """
+    return settings_cache.get()
+
+
+class ProjectCatalog(object):
+    """
+    Класс каталога проектов: проекты, проиндексированные по названию,
+    и готовый список названий в порядке добавления
+    """
+    def __init__(self, projects):
+        self.projects = OrderedDict(
+            (project.title, project) for project in projects
+        )
+        self.titles = list(self.projects)
+
+    def __contains__(self, title):
+        return title in self.projects
+
+    def get(self, title):
+        return self.projects.get(title)
+
+
+def load_catalog():
+    """
+    Функция загрузки каталога проектов
+    """
+    return ProjectCatalog(Project.objects.order_by('id'))
+
+
+catalog_cache = VersionedCache('catalog', load_catalog)
+
+
+def get_catalog():
+    """
+    Функция возвращает закэшированный каталог проектов
+    """
+    return catalog_cache.get()
+
+
+# Поля пользователя, которые нужны экранам бота: баланс и статистика
+# вместе с позицией журнала, до которой они посчитаны, и положение
+# в дереве приглашений
+USER_FIELDS = ('id', 'chat_id', 'parent_id', 'tree_id', 'lft', 'rght',
+               'level', 'balance', 'invited_level_1', 'invited_level_2',
+               'invited_level_3', 'earned_level_1', 'earned_level_2',
+               'earned_level_3', 'ledger_position', 'is_blocked')
+
+
+class UserCache(object):
+    """
+    Класс кэша пользователей по chat_id в памяти процесса с вытеснением
+    давно не использованных записей и истечением по ttl.
+    Хранится кортеж полей USER_FIELDS, пользователь собирается из него
+    без запроса к базе данных. Номер версии хранится в общем кэше
+    Django, сброс в одном процессе очищает кэш всех процессов.
+    Отдельные пользователи удаляются из кэша всех процессов через
+    журнал удалений в общем кэше: номер последней записи и записи
+    со списками chat_id. Общий кэш проверяется не чаще раза
+    в BOT_CACHE_CHECK_INTERVAL секунд
+    """
+    version_key = 'bot:version:users'
+    position_key = 'bot:users:evicted'
+    evicted_key = 'bot:users:evicted:{}'
+    # Процесс, отставший больше чем на столько записей журнала или
+    # не нашедший запись, очищает кэш целиком
+    max_evicted = 1000
+    evicted_timeout = 3600
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._version = None
+        self._position = None
+        self._checked = None
+        self._store = MemoryStateStore(max_size=max_size, ttl=ttl)
+        # Model.from_db ожидает значения в порядке полей модели
+        self.fields = [field.attname
+                       for field in ReferralUser._meta.concrete_fields
+                       if field.attname in USER_FIELDS]
+
+    def _clear(self):
+        self._store = MemoryStateStore(max_size=self.max_size, ttl=self.ttl)
+
+    def _check_version(self):
+        now = time.monotonic()
+        if (self._checked is not None and
+                now - self._checked < get_check_interval()):
+            return
+        self._checked = now
+        values = cache.get_many([self.version_key, self.position_key])
+        version = values.get(self.version_key)
+        position = values.get(self.position_key)
+        if version != self._version:
+            self._clear()
+            self._version = version
+        elif position != self._position:
+            self._apply_evicted(position)
+        self._position = position
+
+    def _apply_evicted(self, position):
+        """
+        Удаление пользователей по записям журнала удалений, появившимся
+        после последней проверки
+        """
+        if (self._position is None or position is None or
+                not 0 < position - self._position <= self.max_evicted):
+            self._clear()
+            return
+        keys = [self.evicted_key.format(number)
+                for number in range(self._position + 1, position + 1)]
+        found = cache.get_many(keys)
+        if len(found) < len(keys):
+            self._clear()
+            return
+        for chat_ids in found.values():
+            for chat_id in chat_ids:
+                self._store.delete(chat_id)
+
+    def get(self, chat_id):
+        """
+        Пользователь по chat_id или None, если он не зарегистрирован.
+        Отсутствие пользователя не кэшируется
+        """
+        self._check_version()
+        values = self._store.get(chat_id, MISSING)
+        if values is MISSING:
+            values = ReferralUser.objects.filter(
+                chat_id=chat_id
+            ).values_list(*self.fields).first()
+            if values is None:
+                return None
+            self._store.set(chat_id, values)
+        return ReferralUser.from_db(DEFAULT_DB_ALIAS, self.fields, values)
+
+    def set(self, user):
+        self._check_version()
+        self._store.set(user.chat_id, tuple(
+            getattr(user, field) for field in self.fields
+        ))
+
+    def delete(self, chat_id):
+        self._store.delete(chat_id)
+
+    def evict(self, chat_ids):
+        """
+        Удаление пользователей из кэша этого и остальных процессов
+        """
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return
+        for chat_id in chat_ids:
+            self._store.delete(chat_id)
+        cache.add(self.position_key, 0, None)
+        try:
+            position = cache.incr(self.position_key)
+        except ValueError:
+            # Номер журнала вытеснен из общего кэша
+            self.invalidate()
+            return
+        cache.set(self.evicted_key.format(position), chat_ids,
+                  self.evicted_timeout)
+
+    def invalidate(self):
+        cache.set(self.version_key, uuid4().hex, None)
+        self._clear()
+
+
+def get_user_cache_options():
+    """
+    Функция возвращает настройку BOT_USER_CACHE
+    """
+    return getattr(settings, 'BOT_USER_CACHE', {})
+
+
+user_cache = UserCache(
+    max_size=get_user_cache_options().get('MAX_SIZE', 10000),
+    ttl=get_user_cache_options().get('TTL')
+)
+
+
+def get_user(chat_id):
+    """
+    Функция возвращает закэшированного пользователя или None
+    """
+    return user_cache.get(chat_id)
@@ -0,0 +1,87 @@
+"""
+Настройка SQLite для одновременной работы потоков и процессов бота.
+При каждом подключении выполняются PRAGMA из настройки BOT_SQLITE:
+в режиме журнала WAL чтение не ждет записи, а busy_timeout заставляет
+запись ждать снятия блокировки вместо ошибки "database is locked".
+SQLite допускает только одну пишущую транзакцию, поэтому записи потоков
+одного процесса выстраиваются в очередь write_queue и не мешают друг
+другу, чтение выполняется параллельно без очереди
+"""
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+
+def get_sqlite_options():
+    """
+    Функция возвращает настройку BOT_SQLITE
+    """
+    return getattr(settings, 'BOT_SQLITE', {})
+
+
+def configure_connection(connection):
+    """
+    Функция выполняет PRAGMA из настройки для нового подключения к SQLite
+    """
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = get_sqlite_options().get('PRAGMAS', {})
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+
+class WriteQueue(object):
+    """
+    Класс очереди записи: транзакции, открытые через write(), выполняются
+    по одной в порядке обращения потоков. Вложенная запись потока,
+    уже получившего очередь, выполняется сразу. Для других баз данных
+    и при выключенной настройке WRITE_QUEUE write() - обычный atomic()
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._local = threading.local()
+
+    def enabled(self, using):
+        return (connections[using].vendor == 'sqlite' and
+                get_sqlite_options().get('WRITE_QUEUE', False))
+
+    def _acquire(self):
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._condition.wait()
+
+    def _release(self):
+        with self._condition:
+            self._serving += 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def write(self, using=None):
+        """
+        Транзакция записи в порядке очереди, подходит и как декоратор
+        """
+        using = using or DEFAULT_DB_ALIAS
+        if getattr(self._local, 'writing', False) or not self.enabled(using):
+            with transaction.atomic(using=using):
+                yield
+            return
+        self._acquire()
+        self._local.writing = True
+        try:
+            with transaction.atomic(using=using):
+                yield
+        finally:
+            self._local.writing = False
+            self._release()
+
+
+write_queue = WriteQueue()
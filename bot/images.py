@@ -0,0 +1,64 @@
+"""
+Подготовка изображений проектов для отправки в Telegram.
+Из загруженного изображения создаются уменьшенные копии в JPEG,
+в Telegram отправляется копия, а не исходный файл
+"""
+from io import BytesIO
+import logging
+import os
+
+from django.core.files.base import ContentFile
+from PIL import Image
+
+# Наибольшие размеры копий: фото для отправки пользователям
+# и миниатюра для админки
+RENDITIONS = {
+    'photo': (1280, 1280),
+    'thumbnail': (320, 320),
+}
+JPEG_QUALITY = 85
+
+logger = logging.getLogger(__name__)
+
+
+def make_rendition(image_file, size):
+    """
+    Функция создает уменьшенную до size копию изображения в JPEG
+    и возвращает ее как файл для сохранения в поле модели
+    """
+    image_file.seek(0)
+    image = Image.open(image_file)
+    image.load()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # Прозрачные области заливаются белым, в JPEG нет прозрачности
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail(size, Image.LANCZOS)
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True,
+               progressive=True)
+    return ContentFile(output.getvalue())
+
+
+def rendition_name(name, rendition):
+    """
+    Функция возвращает имя файла копии по имени исходного файла
+    """
+    base = os.path.splitext(os.path.basename(name))[0]
+    return '{}_{}.jpg'.format(base, rendition)
+
+
+def delete_files(storage, names):
+    """
+    Функция удаляет файлы замененных копий из хранилища. Ошибка
+    удаления записывается в журнал и не мешает остальным файлам
+    """
+    for name in names:
+        try:
+            storage.delete(name)
+        except OSError as e:
+            logger.warning('Не удалось удалить файл %s: %s', name, e)
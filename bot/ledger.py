@@ -0,0 +1,120 @@
+"""
+Журнал начислений за приглашенных пользователей.
+Регистрация только добавляет записи в журнал и не изменяет строки
+пригласивших. Баланс и статистика пользователя хранятся снимком,
+который периодически досчитывается по журналу командой compact_ledger,
+при чтении к снимку прибавляются еще не учтенные начисления
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Sum
+from django.utils import timezone
+
+from .cache import user_cache
+from .models import ReferralUser, Reward
+from .referrals import REFERRAL_BONUS, REFERRAL_LEVELS
+
+# Свежие начисления не учитываются в снимке, чтобы не пропустить
+# записи транзакций, которые еще не завершились
+COMPACT_DELAY = timedelta(seconds=60)
+
+
+def record_rewards(invitee, ancestors):
+    """
+    Функция записывает начисления пригласившим за нового пользователя.
+    ancestors - список (id пригласившего, уровень)
+    """
+    Reward.objects.bulk_create([
+        Reward(user_id=user_id, invitee=invitee, level=level,
+               amount=REFERRAL_BONUS)
+        for user_id, level in ancestors
+    ])
+
+
+def get_tail(user):
+    """
+    Функция возвращает не учтенные в снимке начисления пользователя
+    по уровням: {уровень: (количество, сумма)}
+    """
+    rows = Reward.objects.filter(
+        user=user, id__gt=user.ledger_position
+    ).values_list('level').annotate(
+        count=Count('id'), amount=Sum('amount')
+    ).order_by()
+    return {level: (count, amount) for level, count, amount in rows}
+
+
+def get_balance(user):
+    """
+    Функция возвращает баланс пользователя с учетом последних начислений
+    """
+    tail = Reward.objects.filter(
+        user=user, id__gt=user.ledger_position
+    ).aggregate(amount=Sum('amount'))['amount']
+    return user.balance + (tail or 0)
+
+
+def get_statistics(user):
+    """
+    Функция возвращает баланс и статистику приглашений пользователя
+    с учетом последних начислений: баланс, {уровень: (приглашено,
+    заработано)}
+    """
+    tail = get_tail(user)
+    balance = user.balance
+    levels = {}
+    for level in range(1, REFERRAL_LEVELS + 1):
+        count, amount = tail.get(level, (0, 0))
+        levels[level] = (
+            getattr(user, 'invited_level_{}'.format(level)) + count,
+            getattr(user, 'earned_level_{}'.format(level)) + amount,
+        )
+        balance += amount
+    return balance, levels
+
+
+def compact_ledger(batch_size=10000, delay=COMPACT_DELAY):
+    """
+    Функция переносит начисления из журнала в снимки балансов
+    и статистики пачками по batch_size записей. Каждый пользователь
+    обновляется одним UPDATE на пачку, сколько бы начислений
+    он ни получил. Возвращает количество учтенных записей
+    """
+    checkpoint = ReferralUser.objects.aggregate(
+        position=Max('ledger_position')
+    )['position'] or 0
+    horizon = timezone.now() - delay
+    compacted = 0
+    while True:
+        ids = list(Reward.objects.filter(
+            id__gt=checkpoint, created__lte=horizon
+        ).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        with transaction.atomic():
+            # Записи, уже учтенные в снимке пользователя, пропускаются
+            rows = Reward.objects.filter(
+                id__gt=checkpoint, id__lte=last_id
+            ).filter(id__gt=F('user__ledger_position'))
+            totals = {}
+            for user_id, level, count, amount in rows.values_list(
+                    'user_id', 'level').annotate(
+                    count=Count('id'), amount=Sum('amount')).order_by():
+                totals.setdefault(user_id, []).append((level, count, amount))
+            for user_id, levels in totals.items():
+                counters = {'ledger_position': last_id,
+                            'balance': F('balance')}
+                for level, count, amount in levels:
+                    invited = 'invited_level_{}'.format(level)
+                    earned = 'earned_level_{}'.format(level)
+                    counters['balance'] += amount
+                    counters[invited] = F(invited) + count
+                    counters[earned] = F(earned) + amount
+                ReferralUser.objects.filter(id=user_id).update(**counters)
+        checkpoint = last_id
+        compacted += len(ids)
+    if compacted:
+        user_cache.invalidate()
+    return compacted
@@ -0,0 +1,139 @@
+"""
+Журнал бота в формате JSON Lines с записью в файл в фоновом потоке.
+Обработчик AsyncFileHandler только кладет запись в очередь,
+файл пишет поток QueueListener, поэтому запись на диск не задерживает
+ответы бота. В один файл пишут все процессы (веб-сервер и обработчики
+очереди), поэтому сами они файл не вращают: его вращает внешняя
+программа (logrotate), а обработчик открывает файл заново, когда
+его переименовали или удалили. Частые отладочные сообщения
+прореживаются фильтром SamplingFilter.
+Модуль подключается из настройки LOGGING до загрузки приложений
+и не должен импортировать модели
+"""
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+
+# Дополнительные поля записи (logger.info(..., extra={...})),
+# которые попадают в JSON
+LOG_FIELDS = ('chat_id', 'handler', 'latency_ms', 'update_id', 'sampled')
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Класс форматирования записи в одну строку JSON
+    """
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(
+                record.created, timezone.utc
+            ).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Класс фильтра, пропускающего каждое every-е отладочное сообщение
+    с одним шаблоном текста. Сообщения уровня INFO и выше проходят все
+    """
+    def __init__(self, every=100):
+        super().__init__()
+        self.every = every
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every <= 1:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self._counters.get(key, 0)
+            # Число шаблонов сообщений в коде ограничено
+            self._counters[key] = count + 1
+        if count % self.every:
+            return False
+        record.sampled = self.every
+        return True
+
+
+class AsyncFileHandler(QueueHandler):
+    """
+    Класс обработчика, передающего записи в файл через очередь.
+    Файл дописывается и открывается заново после внешнего вращения.
+    Текст сообщения и трассировка исключения вычисляются в потоке
+    вызова, форматирование и запись в файл - в потоке QueueListener.
+    При переполнении очереди записи отбрасываются и подсчитываются
+    в dropped. После fork поток записи запускается заново
+    """
+    def __init__(self, filename, queue_size=10000, encoding='utf-8'):
+        self.target = WatchedFileHandler(filename, encoding=encoding,
+                                         delay=True)
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.listener = None
+        self._pid = None
+        super().__init__(queue.Queue(queue_size))
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self.listener = QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        # Формат применяется в потоке записи
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            # Поток записи родительского процесса в дочернем не работает,
+            # его блокировка файла могла остаться захваченной
+            self.target.createLock()
+            self.queue = queue.Queue(self.queue_size)
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Ожидание записи накопленных сообщений
+        """
+        if self.listener is not None and self._pid == os.getpid():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+        self.target.close()
+        super().close()
@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from bot.benchmark import QueueBenchmark, benchmark_cache
+
+
+class Command(BaseCommand):
+    help = ('Замер обработки очереди обновлений разным числом процессов. '
+            'Использует отдельную тестовую базу данных')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200,
+                            help='Количество пользователей')
+        parser.add_argument('--clicks', type=int, default=2000,
+                            help='Количество переходов по меню')
+        parser.add_argument('--orders', type=int, default=50,
+                            help='Количество заказов')
+        parser.add_argument('--workers', type=int, nargs='+',
+                            default=[1, 2, 4],
+                            help='Количество процессов для замеров')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Количество обновлений в одной пачке')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Начальное значение генератора случайных '
+                                 'чисел')
+
+    @benchmark_cache()
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            # Процессы должны видеть одну базу, а не свою базу в памяти
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                tempfile.mkdtemp(), 'bench_queue.sqlite3'
+            )
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+        try:
+            benchmark = QueueBenchmark(seed=options['seed'])
+            benchmark.seed(20)
+            benchmark.start_storm(options['users'])
+            updates = benchmark.workload(options['clicks'],
+                                         options['orders'])
+            line = '{:>7} {:>9} {:>10} {:>7}'
+            self.stdout.write(line.format('workers', 'updates', 'upd/s',
+                                          'orders'))
+            for workers in options['workers']:
+                elapsed, orders = benchmark.replay(updates, workers,
+                                                   options['batch_size'])
+                self.stdout.write(line.format(
+                    workers, len(updates),
+                    '{:.1f}'.format(len(updates) / elapsed), orders
+                ))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,63 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from bot.benchmark import DatabaseBenchmark, benchmark_cache
+from bot.tree import get_tree
+
+
+class Command(BaseCommand):
+    help = ('Замер одновременной записи и чтения несколькими потоками '
+            'с настройками SQLite по умолчанию и с настройкой BOT_SQLITE. '
+            'Для каждого замера создается отдельная тестовая база данных '
+            'в файле')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Количество пользователей до замера')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='Количество потоков')
+        parser.add_argument('--operations', type=int, default=200,
+                            help='Количество операций в каждом потоке')
+        parser.add_argument('--write-ratio', type=float, default=0.3,
+                            help='Доля регистраций среди операций')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Начальное значение генератора случайных '
+                                 'чисел')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Замер предназначен для SQLite')
+        profiles = [('default', {}),
+                    ('tuned', getattr(settings, 'BOT_SQLITE', {}))]
+        line = '{:<8} {:>8} {:>8} {:>7}'
+        self.stdout.write(line.format('profile', 'threads', 'ops/s',
+                                      'errors'))
+        for name, profile in profiles:
+            with override_settings(BOT_SQLITE=profile):
+                rate, failed = self.measure(options)
+            self.stdout.write(line.format(name, options['threads'],
+                                          '{:.1f}'.format(rate), failed))
+
+    @benchmark_cache()
+    def measure(self, options):
+        # Режим журнала сохраняется в файле базы, поэтому у каждого
+        # замера своя база
+        connection.settings_dict['TEST']['NAME'] = os.path.join(
+            tempfile.mkdtemp(), 'bench_sqlite.sqlite3'
+        )
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+        try:
+            benchmark = DatabaseBenchmark(get_tree().name,
+                                          seed=options['seed'])
+            for _ in benchmark.grow(options['users'], options['users']):
+                pass
+            return benchmark.run(options['threads'], options['operations'],
+                                 options['write_ratio'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
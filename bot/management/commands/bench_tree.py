@@ -0,0 +1,49 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from bot.benchmark import TreeBenchmark, benchmark_cache
+from bot.tree import TREE_BACKENDS
+
+
+class Command(BaseCommand):
+    help = ('Сравнение режимов хранения дерева приглашений: скорость '
+            'регистрации по мере роста дерева и время чтения списка '
+            'приглашенных. Использует отдельную тестовую базу данных, '
+            'которая очищается перед замером каждого режима')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000,
+                            help='Размер дерева, например 1000000')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Через сколько регистраций выводить '
+                                 'скорость')
+        parser.add_argument('--samples', type=int, default=200,
+                            help='Количество замеров чтения')
+        parser.add_argument('--backend', action='append',
+                            choices=sorted(TREE_BACKENDS),
+                            help='Режим для замера, по умолчанию все')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Начальное значение генератора случайных '
+                                 'чисел')
+
+    @benchmark_cache()
+    def handle(self, *args, **options):
+        line = '{:<10} {:>10} {:>12}'
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+        try:
+            for backend in options['backend'] or sorted(TREE_BACKENDS):
+                call_command('flush', interactive=False, verbosity=0)
+                benchmark = TreeBenchmark(backend, seed=options['seed'])
+                self.stdout.write(line.format('backend', 'users',
+                                              'signups/s'))
+                for users, rate in benchmark.grow(options['users'],
+                                                  options['batch_size']):
+                    self.stdout.write(line.format(backend, users,
+                                                  '{:.1f}'.format(rate)))
+                p50, p99 = benchmark.read(options['samples'])
+                self.stdout.write('{}: список приглашенных p50 {:.2f} мс, '
+                                  'p99 {:.2f} мс'.format(backend, p50, p99))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
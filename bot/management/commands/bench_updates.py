@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from bot.benchmark import Benchmark, benchmark_cache
+
+
+class Command(BaseCommand):
+    help = ('Замер пропускной способности бота на синтетических обновлениях. '
+            'Использует отдельную тестовую базу данных')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500,
+                            help='Количество регистраций')
+        parser.add_argument('--projects', type=int, default=20,
+                            help='Количество проектов')
+        parser.add_argument('--clicks', type=int, default=2000,
+                            help='Количество переходов по меню')
+        parser.add_argument('--depth', type=int, default=30,
+                            help='Глубина цепочки приглашений')
+        parser.add_argument('--orders', type=int, default=50,
+                            help='Количество заказов')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Начальное значение генератора случайных '
+                                 'чисел')
+
+    @benchmark_cache()
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+        try:
+            benchmark = Benchmark(seed=options['seed'])
+            benchmark.seed(options['projects'])
+            benchmark.start_storm(options['users'])
+            benchmark.menu_browsing(options['clicks'])
+            benchmark.deep_tree(options['depth'])
+            benchmark.orders(options['orders'])
+            rows = benchmark.report()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        line = '{:<40} {:>7} {:>10} {:>9} {:>9} {:>8}'
+        self.stdout.write(line.format('update', 'count', 'upd/s', 'p50 ms',
+                                      'p99 ms', 'queries'))
+        for row in rows:
+            self.stdout.write(line.format(
+                row['kind'], row['count'], '{:.1f}'.format(row['per_second']),
+                '{:.2f}'.format(row['p50_ms']), '{:.2f}'.format(row['p99_ms']),
+                '{:.1f}'.format(row['queries'])
+            ))
+        self.stdout.write('Telegram API calls: {}'.format(
+            ', '.join('{}={}'.format(method, count) for method, count
+                      in sorted(benchmark.request.calls.items()))
+        ))
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_telegrambot.apps import DjangoTelegramBot
+
+from bot.broadcast import (create_project_broadcast, get_broadcast_options,
+                           send_broadcast)
+from bot.models import Broadcast, Project
+
+
+class Command(BaseCommand):
+    help = ('Рассылка сообщения всем пользователям бота. Без --text и '
+            '--project отправляет созданные в админке и прерванные '
+            'рассылки')
+
+    def add_arguments(self, parser):
+        options = get_broadcast_options()
+        parser.add_argument('--text', help='Текст новой рассылки')
+        parser.add_argument('--html', action='store_true',
+                            help='Текст рассылки содержит HTML-разметку')
+        parser.add_argument('--project', type=int,
+                            help='id проекта для рассылки анонса')
+        parser.add_argument('--rate', type=float,
+                            default=options.get('RATE', 25),
+                            help='Сообщений в секунду')
+        parser.add_argument('--workers', type=int,
+                            default=options.get('WORKERS', 8),
+                            help='Количество потоков отправки')
+        parser.add_argument('--batch-size', type=int,
+                            default=options.get('BATCH_SIZE', 500),
+                            help='Через сколько пользователей сохранять '
+                                 'прогресс')
+
+    def handle(self, *args, **options):
+        if not DjangoTelegramBot.bots:
+            raise CommandError('Телеграм бот не настроен')
+        if options['text']:
+            Broadcast.objects.create(
+                text=options['text'],
+                parse_mode='HTML' if options['html'] else ''
+            )
+        if options['project'] is not None:
+            try:
+                project = Project.objects.get(id=options['project'])
+            except Project.DoesNotExist:
+                raise CommandError('Проект не найден')
+            create_project_broadcast(project)
+        bot = DjangoTelegramBot.get_bot()
+        for broadcast in Broadcast.objects.filter(
+                status=Broadcast.PENDING).order_by('id'):
+            self.stdout.write('{}: отправка'.format(broadcast))
+            send_broadcast(bot, broadcast, rate=options['rate'],
+                           workers=options['workers'],
+                           batch_size=options['batch_size'])
+            broadcast.refresh_from_db()
+            self.stdout.write('{}: отправлено {}, ошибок {}, '
+                              'заблокировали бота {}'.format(
+                                  broadcast, broadcast.sent,
+                                  broadcast.failed, broadcast.blocked))
@@ -0,0 +1,33 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from bot.ledger import COMPACT_DELAY, compact_ledger
+
+
+class Command(BaseCommand):
+    help = ('Перенос начислений из журнала в балансы и статистику '
+            'пользователей')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Обработать журнал один раз и завершиться')
+        parser.add_argument('--interval', type=float, default=60,
+                            help='Пауза между обработками журнала, секунд')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Количество начислений в одной транзакции')
+        parser.add_argument('--delay', type=float,
+                            default=COMPACT_DELAY.total_seconds(),
+                            help='Не учитывать начисления моложе этого '
+                                 'числа секунд')
+
+    def handle(self, *args, **options):
+        delay = timedelta(seconds=options['delay'])
+        while True:
+            compacted = compact_ledger(options['batch_size'], delay)
+            if compacted:
+                self.stdout.write('Учтено начислений: {}'.format(compacted))
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,76 @@
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django_telegrambot.apps import DjangoTelegramBot
+
+from bot.updates import (UpdateConsumer, get_queue_options,
+                         reset_bot_requests)
+
+
+class Command(BaseCommand):
+    help = ('Обработка очереди входящих обновлений Telegram. Чаты '
+            'распределяются между процессами, обновления одного чата '
+            'обрабатываются по порядку. По SIGINT/SIGTERM процессы '
+            'завершают взятые обновления и останавливаются')
+
+    def add_arguments(self, parser):
+        options = get_queue_options()
+        parser.add_argument('--workers', type=int,
+                            default=options.get('WORKERS', 1),
+                            help='Количество процессов-обработчиков')
+        parser.add_argument('--batch-size', type=int,
+                            default=options.get('BATCH_SIZE', 100),
+                            help='Количество обновлений в одной пачке')
+        parser.add_argument('--interval', type=float,
+                            default=options.get('INTERVAL', 0.5),
+                            help='Пауза при пустой очереди, секунд')
+        parser.add_argument('--once', action='store_true',
+                            help='Обработать очередь один раз и завершиться')
+
+    def handle(self, *args, **options):
+        if not DjangoTelegramBot.bots:
+            raise CommandError('Телеграм бот не настроен')
+        workers = options['workers']
+        if workers == 1:
+            self.consume(options, 0, 1)
+            return
+        # Каждый процесс открывает свое соединение с базой данных
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=self.consume,
+                                    args=(options, shard, workers))
+            for shard in range(workers)
+        ]
+        for process in processes:
+            process.start()
+
+        def stop(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        for process in processes:
+            process.join()
+
+    def consume(self, options, shard, shards):
+        if shards > 1:
+            # Процесс порожден fork и унаследовал соединения
+            # с Telegram родителя
+            reset_bot_requests()
+        consumer = UpdateConsumer(
+            batch_size=options['batch_size'],
+            claim_timeout=get_queue_options().get('CLAIM_TIMEOUT', 300),
+            shard=shard,
+            shards=shards,
+            stats_interval=get_queue_options().get('STATS_INTERVAL', 10)
+        )
+        signal.signal(signal.SIGINT, consumer.stop)
+        signal.signal(signal.SIGTERM, consumer.stop)
+        if options['once']:
+            consumer.drain()
+        else:
+            consumer.run(options['interval'])
@@ -0,0 +1,104 @@
+import csv
+import gzip
+import json
+
+from django.core.management.base import BaseCommand
+from django.db.models import (Count, DecimalField, F, OuterRef, Subquery,
+                              Sum)
+from django.db.models.functions import Coalesce
+
+from bot.models import ReferralLink, ReferralUser, Reward
+from bot.referrals import REFERRAL_LEVELS
+
+FIELDS = ('id', 'chat_id', 'name', 'username', 'parent_chat_id', 'level',
+          'balance', 'pending')
+COLUMNS = (('id', 'chat_id', 'name', 'username', 'parent_chat_id', 'depth',
+            'balance', 'downline') +
+           tuple('level_{}'.format(level)
+                 for level in range(1, REFERRAL_LEVELS + 1)))
+
+
+class Command(BaseCommand):
+    help = ('Выгрузка пользователей, балансов и дерева приглашений в CSV '
+            'или JSON Lines. Пользователи читаются пачками по id, '
+            'пригласивший берется по parent_id, количество приглашенных '
+            'по уровням - из таблицы связей, поэтому выгрузка не зависит '
+            'от вложенных множеств и расход памяти не зависит от числа '
+            'пользователей. downline - приглашенные до {} '
+            'уровня'.format(REFERRAL_LEVELS))
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            default='csv', help='Формат выгрузки')
+        parser.add_argument('--output', default='-',
+                            help='Файл выгрузки, для имени на .gz файл '
+                                 'сжимается, по умолчанию stdout')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Количество пользователей в одной пачке')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        if output == '-':
+            self.export(self.stdout, options)
+        elif output.endswith('.gz'):
+            with gzip.open(output, 'wt', encoding='utf-8',
+                           newline='') as stream:
+                self.export(stream, options)
+        else:
+            with open(output, 'w', encoding='utf-8', newline='') as stream:
+                self.export(stream, options)
+
+    def export(self, stream, options):
+        if options['format'] == 'csv':
+            writer = csv.writer(stream, lineterminator='\n')
+            writer.writerow(COLUMNS)
+            write = writer.writerow
+        else:
+            def write(values):
+                stream.write(json.dumps(dict(zip(COLUMNS, values)),
+                                        ensure_ascii=False) + '\n')
+        for row, counts in self.iter_rows(options['chunk_size']):
+            (user_id, chat_id, name, username, parent_chat_id, level,
+             balance, pending) = row
+            write([
+                user_id, chat_id, name, username,
+                parent_chat_id if parent_chat_id is not None else '',
+                level, str(balance + pending), sum(counts),
+            ] + counts)
+
+    def iter_rows(self, chunk_size):
+        """
+        Пользователи читаются пачками по id, для каждого возвращается
+        строка FIELDS и количество приглашенных по уровням. Количество
+        считается одним запросом на пачку по диапазону id пригласивших
+        """
+        # Начисления, еще не перенесенные в снимок баланса
+        tail = Reward.objects.filter(
+            user=OuterRef('pk'), id__gt=OuterRef('ledger_position')
+        ).order_by().values('user').annotate(
+            amount=Sum('amount')
+        ).values('amount')
+        queryset = ReferralUser.objects.annotate(
+            parent_chat_id=F('parent__chat_id'),
+            pending=Coalesce(
+                Subquery(tail, output_field=DecimalField(max_digits=50,
+                                                         decimal_places=2)),
+                0
+            )
+        ).order_by('id').values_list(*FIELDS)
+        last = 0
+        while True:
+            rows = list(queryset.filter(id__gt=last)[:chunk_size])
+            if not rows:
+                return
+            counts = {}
+            for ancestor_id, depth, count in ReferralLink.objects.filter(
+                ancestor_id__gt=last, ancestor_id__lte=rows[-1][0]
+            ).values_list('ancestor_id', 'depth').annotate(
+                count=Count('id')
+            ).order_by():
+                counts[ancestor_id, depth] = count
+            for row in rows:
+                yield row, [counts.get((row[0], depth), 0)
+                            for depth in range(1, REFERRAL_LEVELS + 1)]
+            last = rows[-1][0]
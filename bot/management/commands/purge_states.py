@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from bot.state import DBStateStore, get_state_store
+
+
+class Command(BaseCommand):
+    help = 'Удаление брошенных диалогов из хранилища состояния'
+
+    def handle(self, *args, **options):
+        store = get_state_store()
+        # Хранилище в базе может быть скрыто за кэшем в памяти
+        store = getattr(store, 'backend', None) or store
+        if not isinstance(store, DBStateStore):
+            self.stdout.write('Состояние хранится в памяти процесса')
+            return
+        self.stdout.write('Удалено записей: {}'.format(store.purge_expired()))
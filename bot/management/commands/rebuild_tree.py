@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from bot.cache import user_cache
+from bot.tree import rebuild_nested_sets
+
+
+class Command(BaseCommand):
+    help = ('Пересборка полей вложенных множеств дерева приглашений '
+            'по пригласившим пользователям')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Количество пользователей в одной '
+                                 'пачке чтения и в одной транзакции')
+
+    def handle(self, *args, **options):
+        rebuilt = rebuild_nested_sets(batch_size=options['batch_size'])
+        if rebuilt:
+            user_cache.invalidate()
+        self.stdout.write('Дерево пересобрано, изменено пользователей: '
+                          '{}'.format(rebuilt))
@@ -0,0 +1,69 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.cache import user_cache
+from bot.referrals import REFERRAL_BONUS, REFERRAL_LEVELS
+
+
+class Command(BaseCommand):
+    help = ('Пересчет баланса и статистики приглашений всех пользователей '
+            'по дереву с заданными начислениями по уровням. Пользователи '
+            'загружаются в массивы NumPy, количество приглашенных всех '
+            'уровней считается сразу для всех пользователей. Запускать '
+            'при остановленном боте')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rewards', nargs='+', type=Decimal,
+                            default=[Decimal(REFERRAL_BONUS)] *
+                            REFERRAL_LEVELS,
+                            help='Начисления за приглашенного по уровням '
+                                 'в рублях, по умолчанию {} для {} '
+                                 'уровней. Для не указанных уровней '
+                                 'начисление 0'.format(REFERRAL_BONUS,
+                                                       REFERRAL_LEVELS))
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Количество пользователей в одной пачке '
+                                 'чтения и в одной транзакции записи')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только показать изменения, не сохраняя')
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Количество изменений, выводимых '
+                                 'при --dry-run')
+
+    def handle(self, *args, **options):
+        try:
+            from bot import balances
+        except ImportError:
+            raise CommandError('Для пересчета нужен пакет numpy')
+        for reward in options['rewards']:
+            if reward < 0 or reward != reward.quantize(Decimal('0.01')):
+                raise CommandError('Начисление должно быть неотрицательным '
+                                   'с точностью до копейки: {}'.format(reward))
+        started = time.perf_counter()
+        users, current, computed, position = balances.recompute_balances(
+            options['rewards'], options['chunk_size']
+        )
+        changed = balances.changed_rows(current, computed)
+        delta = int((computed[0] - current[0])[changed].sum())
+        self.stdout.write('Пользователей: {}, изменится баланс или '
+                          'статистика: {}, сумма изменений: {}'.format(
+                              len(users), int(changed.sum()),
+                              balances.to_decimal(delta)))
+        if options['dry_run']:
+            for index in changed.nonzero()[0][:options['limit']]:
+                self.stdout.write('{}: {} -> {}'.format(
+                    users.chat_id[index],
+                    balances.to_decimal(current[0][index]),
+                    balances.to_decimal(computed[0][index])
+                ))
+        else:
+            saved = balances.save_balances(users, computed, position,
+                                           options['chunk_size'])
+            if saved:
+                user_cache.invalidate()
+            self.stdout.write('Записано пользователей: {}'.format(saved))
+        self.stdout.write('Время: {:.1f} с'.format(
+            time.perf_counter() - started
+        ))
@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from bot.cache import user_cache
+from bot.ledger import compact_ledger
+from bot.referrals import repair_referral_stats
+from bot.tree import get_tree
+
+
+class Command(BaseCommand):
+    help = ('Пересчет статистики приглашений пользователей по дереву. '
+            'Запускать при остановленном боте: статистика сравнивается '
+            'со снимком после переноса всего журнала начислений')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Количество пользователей в одной '
+                                 'транзакции')
+
+    def handle(self, *args, **options):
+        # Статистика считается по полям вложенных множеств и сравнивается
+        # со снимком, в который перенесены все начисления
+        compact_ledger(delay=timedelta(0))
+        get_tree().refresh()
+        repaired = repair_referral_stats(batch_size=options['batch_size'])
+        if repaired:
+            user_cache.invalidate()
+        self.stdout.write('Исправлено пользователей: {}'.format(repaired))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django_telegrambot.apps import DjangoTelegramBot
+
+from bot.tasks import deliver_notifications
+
+
+class Command(BaseCommand):
+    help = 'Отправка уведомлений о новых заказах из очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Отправить очередь один раз и завершиться')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Пауза между проверками очереди, секунд')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Количество уведомлений в одной пачке')
+
+    def handle(self, *args, **options):
+        if not DjangoTelegramBot.bots:
+            raise CommandError('Телеграм бот не настроен')
+        bot = DjangoTelegramBot.get_bot()
+        while True:
+            processed = deliver_notifications(bot, options['batch_size'])
+            if processed:
+                self.stdout.write('Обработано уведомлений: {}'.format(
+                    processed
+                ))
+            if options['once'] and processed < options['batch_size']:
+                break
+            if processed < options['batch_size']:
+                time.sleep(options['interval'])
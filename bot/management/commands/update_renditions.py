@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from bot.models import Project
+
+
+class Command(BaseCommand):
+    help = ('Создание уменьшенных копий изображений проектов, '
+            'добавленных до их появления')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Пересоздать копии у всех проектов')
+
+    def handle(self, *args, **options):
+        updated = 0
+        for project in Project.objects.exclude(image='').order_by('id'):
+            if options['force'] or not project.photo:
+                project.update_renditions()
+                project.save()
+                updated += 1
+        self.stdout.write('Обновлено проектов: {}'.format(updated))
@@ -0,0 +1,279 @@
+"""
+Легковесная телеметрия обработчиков бота: время выполнения,
+количество и время SQL-запросов, время запросов к Telegram.
+Значения накапливаются в гистограммах в памяти процесса
+"""
+import logging
+import math
+import threading
+import time
+from functools import wraps
+
+from django.core.cache import cache
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from telegram import Update
+
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """
+    Класс гистограммы со степенями двойки в качестве границ корзин.
+    Хранит количество, сумму и максимум наблюдений
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        # Корзина k содержит значения из [2 ** (k - 1), 2 ** k)
+        bucket = math.frexp(value)[1]
+        with self._lock:
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, percent):
+        """
+        Оценка перцентиля сверху по границе корзины
+        """
+        rank = self.count * percent / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2.0 ** bucket, self.max)
+        return self.max
+
+    def state(self):
+        """
+        Накопленные значения для передачи в другой процесс
+        """
+        with self._lock:
+            return {'buckets': dict(self.buckets), 'count': self.count,
+                    'total': self.total, 'max': self.max}
+
+    def merge(self, state):
+        """
+        Добавление значений, накопленных гистограммой другого процесса
+        """
+        with self._lock:
+            for bucket, count in state['buckets'].items():
+                self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+            self.count += state['count']
+            self.total += state['total']
+            self.max = max(self.max, state['max'])
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Metrics(object):
+    """
+    Класс набора именованных гистограмм
+    """
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.observe(value)
+
+    def state(self):
+        return {name: histogram.state()
+                for name, histogram in list(self.histograms.items())}
+
+    def merge(self, state):
+        for name, histogram_state in state.items():
+            self.observe_state(name, histogram_state)
+
+    def observe_state(self, name, state):
+        with self._lock:
+            histogram = self.histograms.setdefault(name, Histogram())
+        histogram.merge(state)
+
+    def snapshot(self):
+        return {name: histogram.snapshot()
+                for name, histogram in sorted(self.histograms.items())}
+
+
+metrics = Metrics()
+
+# Ключ общего кэша, под которым процесс публикует свою телеметрию
+EXPORT_KEY = 'bot:metrics:{}'
+
+
+def export_metrics(name, timeout, **extra):
+    """
+    Функция публикует телеметрию процесса в общем кэше Django, чтобы
+    ее увидели другие процессы, например страница /bot/stats/
+    """
+    cache.set(EXPORT_KEY.format(name), dict(extra, metrics=metrics.state()),
+              timeout)
+
+
+def load_metrics(name):
+    """
+    Функция возвращает телеметрию, опубликованную процессом name,
+    или None
+    """
+    return cache.get(EXPORT_KEY.format(name))
+
+
+# Счетчики текущего обработчика в потоке диспетчера
+_context = threading.local()
+
+
+def _add(attr, value):
+    setattr(_context, attr, getattr(_context, attr, 0) + value)
+
+
+class QueryTimingMixin(object):
+    """
+    Примесь к курсору, учитывающая количество и время SQL-запросов
+    """
+    def execute(self, sql, params=None):
+        started = time.perf_counter()
+        try:
+            return super(QueryTimingMixin, self).execute(sql, params)
+        finally:
+            _add('db_queries', 1)
+            _add('db_time', time.perf_counter() - started)
+
+    def executemany(self, sql, param_list):
+        started = time.perf_counter()
+        try:
+            return super(QueryTimingMixin, self).executemany(sql, param_list)
+        finally:
+            _add('db_queries', 1)
+            _add('db_time', time.perf_counter() - started)
+
+
+class TimedCursorWrapper(QueryTimingMixin, CursorWrapper):
+    pass
+
+
+class TimedCursorDebugWrapper(QueryTimingMixin, CursorDebugWrapper):
+    pass
+
+
+@receiver(connection_created)
+def install_timed_cursor(sender, connection, **kwargs):
+    """
+    Подключение учета запросов к каждому новому соединению с базой
+    """
+    connection.make_cursor = lambda cursor: TimedCursorWrapper(cursor,
+                                                               connection)
+    connection.make_debug_cursor = (
+        lambda cursor: TimedCursorDebugWrapper(cursor, connection)
+    )
+
+
+class TimedRequest(object):
+    """
+    Класс обертки над HTTP-клиентом бота, учитывающей время
+    запросов к Telegram
+    """
+    def __init__(self, request):
+        self.request = request
+
+    def _call(self, func, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(url, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            _add('telegram_time', elapsed)
+            metrics.observe('telegram:{}'.format(url.rsplit('/', 1)[-1]),
+                            elapsed * 1000)
+
+    def get(self, url, *args, **kwargs):
+        return self._call(self.request.get, url, *args, **kwargs)
+
+    def post(self, url, *args, **kwargs):
+        return self._call(self.request.post, url, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.request, name)
+
+
+def instrument(name, callback):
+    """
+    Обертка обработчика, записывающая время выполнения, количество
+    и время SQL-запросов и время запросов к Telegram.
+    Повторно обработчик не оборачивается
+    """
+    if getattr(callback, 'instrumented', False):
+        return callback
+
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        outer = (getattr(_context, 'db_queries', 0),
+                 getattr(_context, 'db_time', 0),
+                 getattr(_context, 'telegram_time', 0))
+        _context.db_queries = _context.db_time = _context.telegram_time = 0
+        started = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            queries = _context.db_queries
+            db_time = _context.db_time
+            telegram_time = _context.telegram_time
+            metrics.observe('handler:{}'.format(name), elapsed * 1000)
+            metrics.observe('db_queries:{}'.format(name), queries)
+            metrics.observe('db_time:{}'.format(name), db_time * 1000)
+            metrics.observe('telegram_time:{}'.format(name),
+                            telegram_time * 1000)
+            if logger.isEnabledFor(logging.DEBUG):
+                log_handler(name, args, elapsed, queries)
+            # Вложенный обработчик учитывается и во внешнем
+            _context.db_queries = outer[0] + queries
+            _context.db_time = outer[1] + db_time
+            _context.telegram_time = outer[2] + telegram_time
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def log_handler(name, args, elapsed, queries):
+    """
+    Функция записывает в журнал отладочное сообщение о выполнении
+    обработчика с номером чата, именем обработчика и временем
+    """
+    update = next((arg for arg in args if isinstance(arg, Update)), None)
+    chat = update.effective_chat if update is not None else None
+    logger.debug('Обработчик %s: %.1f мс, %s SQL-запросов', name,
+                 elapsed * 1000, queries, extra={
+                     'chat_id': chat.id if chat is not None else None,
+                     'update_id': (update.update_id if update is not None
+                                   else None),
+                     'handler': name,
+                     'latency_ms': round(elapsed * 1000, 3),
+                 })
+
+
+def instrument_bot(bot):
+    """
+    Подключение учета времени запросов к Telegram для бота
+    """
+    if not isinstance(bot._request, TimedRequest):
+        bot._request = TimedRequest(bot._request)
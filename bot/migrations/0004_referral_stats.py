@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 17:51
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+# Копия логики bot.referrals на момент миграции: журнала начислений
+# еще нет, каждый приглашенный приносил фиксированный бонус
+REFERRAL_BONUS = 100
+REFERRAL_LEVELS = 3
+STATS_FIELDS = (
+    'invited_level_1', 'invited_level_2', 'invited_level_3',
+    'earned_level_1', 'earned_level_2', 'earned_level_3',
+)
+
+
+def iter_referral_stats(queryset):
+    rows = queryset.order_by('tree_id', 'lft').values_list(
+        'id', 'tree_id', 'lft', 'rght'
+    ).iterator()
+    # Путь от корня: [id, tree_id, rght, счетчики]
+    path = []
+    for user_id, tree_id, lft, rght in rows:
+        while path and (path[-1][1] != tree_id or path[-1][2] < lft):
+            yield make_stats(path.pop())
+        for distance, ancestor in enumerate(reversed(path[-REFERRAL_LEVELS:]),
+                                            1):
+            ancestor[3][distance - 1] += 1
+        path.append([user_id, tree_id, rght, [0] * REFERRAL_LEVELS])
+    while path:
+        yield make_stats(path.pop())
+
+
+def make_stats(node):
+    user_id, tree_id, rght, counts = node
+    earned = [Decimal(count * REFERRAL_BONUS) for count in counts]
+    return user_id, tuple(counts) + tuple(earned)
+
+
+def fill_referral_stats(apps, schema_editor):
+    ReferralUser = apps.get_model('bot', 'ReferralUser')
+    for user_id, values in iter_referral_stats(ReferralUser.objects.all()):
+        if any(values):
+            ReferralUser.objects.filter(id=user_id).update(
+                **dict(zip(STATS_FIELDS, values))
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0003_conversation_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='referraluser',
+            name='earned_level_1',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=50, verbose_name='Заработано на первом уровне'),
+        ),
+        migrations.AddField(
+            model_name='referraluser',
+            name='earned_level_2',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=50, verbose_name='Заработано на втором уровне'),
+        ),
+        migrations.AddField(
+            model_name='referraluser',
+            name='earned_level_3',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=50, verbose_name='Заработано на третьем уровне'),
+        ),
+        migrations.AddField(
+            model_name='referraluser',
+            name='invited_level_1',
+            field=models.PositiveIntegerField(default=0, verbose_name='Приглашено на первом уровне'),
+        ),
+        migrations.AddField(
+            model_name='referraluser',
+            name='invited_level_2',
+            field=models.PositiveIntegerField(default=0, verbose_name='Приглашено на втором уровне'),
+        ),
+        migrations.AddField(
+            model_name='referraluser',
+            name='invited_level_3',
+            field=models.PositiveIntegerField(default=0, verbose_name='Приглашено на третьем уровне'),
+        ),
+        migrations.RunPython(fill_referral_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 17:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Число уровней связей на момент миграции
+LEVELS = 3
+
+
+def fill_links(apps, schema_editor):
+    """
+    Заполнение таблицы связей по пригласившим пользователям
+    """
+    ReferralUser = apps.get_model('bot', 'ReferralUser')
+    ReferralLink = apps.get_model('bot', 'ReferralLink')
+    parents = dict(ReferralUser.objects.values_list('id', 'parent_id'))
+    batch = []
+    for user_id in sorted(parents):
+        ancestor_id = parents[user_id]
+        depth = 1
+        while ancestor_id is not None and depth <= LEVELS:
+            batch.append(ReferralLink(ancestor_id=ancestor_id,
+                                      descendant_id=user_id, depth=depth))
+            ancestor_id = parents[ancestor_id]
+            depth += 1
+        if len(batch) >= 1000:
+            ReferralLink.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        ReferralLink.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0004_referral_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField(verbose_name='Уровень')),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='bot.ReferralUser', verbose_name='Пригласивший пользователь')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='bot.ReferralUser', verbose_name='Приглашенный пользователь')),
+            ],
+            options={
+                'verbose_name': 'Связь приглашения',
+                'verbose_name_plural': 'Связи приглашений',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='referrallink',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='referrallink',
+            index_together=set([('ancestor', 'depth', 'descendant')]),
+        ),
+        migrations.RunPython(fill_links, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 18:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_referral_link'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reward',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveSmallIntegerField(verbose_name='Уровень')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=50, verbose_name='Сумма')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата начисления')),
+            ],
+            options={
+                'verbose_name': 'Начисление',
+                'verbose_name_plural': 'Начисления',
+                'ordering': ('-id',),
+            },
+        ),
+        migrations.AddField(
+            model_name='referraluser',
+            name='ledger_position',
+            field=models.PositiveIntegerField(db_index=True, default=0, verbose_name='Учтено начислений до номера'),
+        ),
+        migrations.AddField(
+            model_name='reward',
+            name='invitee',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='bot.ReferralUser', verbose_name='Приглашенный пользователь'),
+        ),
+        migrations.AddField(
+            model_name='reward',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rewards', to='bot.ReferralUser', verbose_name='Пользователь'),
+        ),
+        migrations.AlterIndexTogether(
+            name='reward',
+            index_together=set([('user', 'id')]),
+        ),
+    ]
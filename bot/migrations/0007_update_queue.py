@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 18:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0006_reward_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bot_id', models.CharField(max_length=20, verbose_name='Идентификатор бота')),
+                ('update_id', models.BigIntegerField(verbose_name='Номер обновления')),
+                ('data', models.TextField(verbose_name='Обновление')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата получения')),
+                ('owner', models.CharField(blank=True, db_index=True, max_length=40, verbose_name='Обработчик')),
+                ('claimed', models.DateTimeField(blank=True, null=True, verbose_name='Дата взятия в обработку')),
+            ],
+            options={
+                'verbose_name': 'Входящее обновление',
+                'verbose_name_plural': 'Входящие обновления',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='queuedupdate',
+            unique_together=set([('bot_id', 'update_id')]),
+        ),
+    ]
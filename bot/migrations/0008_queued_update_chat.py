@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 18:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0007_update_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedupdate',
+            name='chat_id',
+            field=models.BigIntegerField(default=0, verbose_name='Чат'),
+        ),
+    ]
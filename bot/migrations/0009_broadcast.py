@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 18:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0008_queued_update_chat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField(verbose_name='Текст сообщения')),
+                ('parse_mode', models.CharField(blank=True, max_length=10, verbose_name='Разметка текста')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает отправки'), ('done', 'Отправлена')], db_index=True, default='pending', max_length=10, verbose_name='Статус')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Дата завершения')),
+                ('position', models.PositiveIntegerField(default=0, verbose_name='Отправлено до пользователя')),
+                ('sent', models.PositiveIntegerField(default=0, verbose_name='Отправлено')),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='Ошибок')),
+                ('blocked', models.PositiveIntegerField(default=0, verbose_name='Заблокировали бота')),
+            ],
+            options={
+                'verbose_name': 'Рассылка',
+                'verbose_name_plural': 'Рассылки',
+                'ordering': ('-id',),
+            },
+        ),
+        migrations.AddField(
+            model_name='referraluser',
+            name='is_blocked',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='Заблокировал бота'),
+        ),
+    ]
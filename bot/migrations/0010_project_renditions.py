@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 18:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0009_broadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='photo',
+            field=models.ImageField(blank=True, editable=False, upload_to='projects_img/renditions', verbose_name='Фото для отправки'),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='telegram_file_id',
+            field=models.CharField(blank=True, editable=False, max_length=200, verbose_name='Идентификатор фото в Telegram'),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='thumbnail',
+            field=models.ImageField(blank=True, editable=False, upload_to='projects_img/renditions', verbose_name='Миниатюра'),
+        ),
+    ]
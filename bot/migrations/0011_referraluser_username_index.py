@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 18:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0010_project_renditions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='referraluser',
+            name='username',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=100, verbose_name='Телеграм username'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 18:27
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0011_referraluser_username_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='referraluser',
+            index_together=set([('tree_id', 'lft')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 19:12
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0012_referraluser_tree_order_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='queuedupdate',
+            index_together=set([('chat_id', 'id')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 19:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0013_queuedupdate_chat_order_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ordernotification',
+            name='email_status',
+            field=models.CharField(choices=[('pending', 'Ожидает отправки'), ('sending', 'Отправляется'), ('sent', 'Отправлено'), ('failed', 'Ошибка отправки'), ('skipped', 'Не указан адрес')], default='pending', max_length=10, verbose_name='Отправка на E-mail'),
+        ),
+        migrations.AlterField(
+            model_name='ordernotification',
+            name='telegram_status',
+            field=models.CharField(choices=[('pending', 'Ожидает отправки'), ('sending', 'Отправляется'), ('sent', 'Отправлено'), ('failed', 'Ошибка отправки'), ('skipped', 'Не указан адрес')], default='pending', max_length=10, verbose_name='Отправка в телеграм'),
+        ),
+    ]
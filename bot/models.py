@@ -1,7 +1,12 @@
+from functools import partial
+
 from django.core.signing import Signer
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from mptt.models import TreeForeignKey, MPTTModel
 
+from .images import RENDITIONS, delete_files, make_rendition, rendition_name
+
 
 class Project(models.Model):
     """
@@ -14,10 +19,57 @@ class Project(models.Model):
                               blank=True)
     link = models.URLField(verbose_name='Ссылка на сайт',
                            blank=True)
+    # Уменьшенные копии изображения, создаются при сохранении проекта
+    photo = models.ImageField(upload_to='projects_img/renditions',
+                              verbose_name='Фото для отправки',
+                              blank=True, editable=False)
+    thumbnail = models.ImageField(upload_to='projects_img/renditions',
+                                  verbose_name='Миниатюра',
+                                  blank=True, editable=False)
+    # Идентификатор фото на серверах Telegram, полученный при первой
+    # отправке, дальше фото отправляется по нему
+    telegram_file_id = models.CharField(max_length=200, blank=True,
+                                        editable=False,
+                                        verbose_name='Идентификатор фото '
+                                                     'в Telegram')
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # При замене изображения пересоздаем его копии
+        previous = None
+        if self.pk:
+            previous = Project.objects.filter(pk=self.pk).values(
+                'image', *RENDITIONS
+            ).first()
+        if previous is None or self.image.name != previous['image']:
+            self.update_renditions()
+        super(Project, self).save(*args, **kwargs)
+        if previous is not None:
+            # Замененные копии удаляются после фиксации транзакции,
+            # при откате проект продолжает ссылаться на них
+            stale = [previous[rendition] for rendition in RENDITIONS
+                     if previous[rendition] and
+                     previous[rendition] != getattr(self, rendition).name]
+            if stale:
+                transaction.on_commit(partial(delete_files,
+                                              self.photo.storage, stale))
+
+    def update_renditions(self):
+        """
+        Создание уменьшенных копий изображения, старый идентификатор
+        фото в Telegram больше не подходит
+        """
+        self.telegram_file_id = ''
+        for rendition, size in RENDITIONS.items():
+            field = getattr(self, rendition)
+            if self.image:
+                field.save(rendition_name(self.image.name, rendition),
+                           make_rendition(self.image, size), save=False)
+            else:
+                setattr(self, rendition, '')
+
     class Meta:
         verbose_name = verbose_name_plural = 'Заработок в интернете'
 
@@ -30,9 +82,11 @@ class ReferralUser(MPTTModel):
                                   verbose_name='Идентификатор пользователя')
     name = models.CharField(max_length=100,
                             verbose_name='Имя пользователя')
-    username = models.CharField(max_length=100,
+    username = models.CharField(max_length=100, db_index=True,
                                 verbose_name='Телеграм username',
                                 blank=True, default='')
+    # Код ссылок, выданных до введения подписанных кодов
+    # (bot.referrals.make_referral_token), нужен только для их проверки
     refer_code = models.CharField(max_length=30, db_index=True,
                                   verbose_name='Хэш для реферальной ссылки')
     parent = TreeForeignKey('self', on_delete=models.SET_NULL, db_index=True,
@@ -40,6 +94,38 @@ class ReferralUser(MPTTModel):
                             verbose_name='Пригласивший пользователь')
     balance = models.DecimalField(max_digits=50, decimal_places=2,
                                   verbose_name='Баланс', default=0)
+    # Статистика приглашений по уровням, обновляется командой
+    # compact_ledger, пересчитывается командой repair_referral_stats
+    invited_level_1 = models.PositiveIntegerField(
+        default=0, verbose_name='Приглашено на первом уровне'
+    )
+    invited_level_2 = models.PositiveIntegerField(
+        default=0, verbose_name='Приглашено на втором уровне'
+    )
+    invited_level_3 = models.PositiveIntegerField(
+        default=0, verbose_name='Приглашено на третьем уровне'
+    )
+    earned_level_1 = models.DecimalField(
+        max_digits=50, decimal_places=2, default=0,
+        verbose_name='Заработано на первом уровне'
+    )
+    earned_level_2 = models.DecimalField(
+        max_digits=50, decimal_places=2, default=0,
+        verbose_name='Заработано на втором уровне'
+    )
+    earned_level_3 = models.DecimalField(
+        max_digits=50, decimal_places=2, default=0,
+        verbose_name='Заработано на третьем уровне'
+    )
+    # Пользователь заблокировал бота, рассылки его пропускают
+    is_blocked = models.BooleanField(default=False, db_index=True,
+                                     verbose_name='Заблокировал бота')
+    # Баланс и статистика выше - снимок журнала начислений до записи
+    # с этим номером, более поздние начисления досчитываются при чтении
+    ledger_position = models.PositiveIntegerField(
+        default=0, db_index=True,
+        verbose_name='Учтено начислений до номера'
+    )
 
     def __str__(self):
         string = '{}'.format(self.name)
@@ -57,6 +143,62 @@ class ReferralUser(MPTTModel):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        # Обход дерева по порядку и постраничная выгрузка
+        index_together = ('tree_id', 'lft')
+
+
+class ReferralLink(models.Model):
+    """
+    Класс модели связи пользователя с пригласившими его пользователями
+    до третьего уровня (таблица замыкания дерева с ограниченной глубиной).
+    Регистрация добавляет не больше трех записей, не затрагивая
+    остальных пользователей
+    """
+    ancestor = models.ForeignKey(ReferralUser, on_delete=models.CASCADE,
+                                 related_name='descendant_links',
+                                 verbose_name='Пригласивший пользователь')
+    descendant = models.ForeignKey(ReferralUser, on_delete=models.CASCADE,
+                                   related_name='ancestor_links',
+                                   verbose_name='Приглашенный пользователь')
+    depth = models.PositiveSmallIntegerField(verbose_name='Уровень')
+
+    def __str__(self):
+        return '{} -> {}'.format(self.ancestor_id, self.descendant_id)
+
+    class Meta:
+        verbose_name = 'Связь приглашения'
+        verbose_name_plural = 'Связи приглашений'
+        unique_together = ('ancestor', 'descendant')
+        index_together = ('ancestor', 'depth', 'descendant')
+
+
+class Reward(models.Model):
+    """
+    Класс модели журнала начислений за приглашенных пользователей.
+    Записи только добавляются, баланс пользователя периодически
+    пересчитывается по ним командой compact_ledger
+    """
+    user = models.ForeignKey(ReferralUser, on_delete=models.CASCADE,
+                             related_name='rewards',
+                             verbose_name='Пользователь')
+    invitee = models.ForeignKey(ReferralUser, on_delete=models.SET_NULL,
+                                null=True, blank=True, related_name='+',
+                                verbose_name='Приглашенный пользователь')
+    level = models.PositiveSmallIntegerField(verbose_name='Уровень')
+    amount = models.DecimalField(max_digits=50, decimal_places=2,
+                                 verbose_name='Сумма')
+    created = models.DateTimeField(default=timezone.now,
+                                   verbose_name='Дата начисления')
+
+    def __str__(self):
+        return '{} за приглашенного {} уровня'.format(self.amount,
+                                                      self.level)
+
+    class Meta:
+        verbose_name = 'Начисление'
+        verbose_name_plural = 'Начисления'
+        ordering = ('-id',)
+        index_together = ('user', 'id')
 
 
 class Settings(models.Model):
@@ -89,3 +231,140 @@ class Settings(models.Model):
 
     class Meta:
         verbose_name = verbose_name_plural = 'Настройки'
+
+
+class OrderNotification(models.Model):
+    """
+    Класс модели очереди уведомлений о новых заказах.
+    Уведомления отправляются в фоне командой send_notifications
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+    STATUS_CHOICES = (
+        (PENDING, 'Ожидает отправки'),
+        (SENDING, 'Отправляется'),
+        (SENT, 'Отправлено'),
+        (FAILED, 'Ошибка отправки'),
+        (SKIPPED, 'Не указан адрес'),
+    )
+
+    text = models.TextField(verbose_name='Текст уведомления')
+    created = models.DateTimeField(auto_now_add=True,
+                                   verbose_name='Дата создания')
+    telegram_status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                                       default=PENDING,
+                                       verbose_name='Отправка в телеграм')
+    email_status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                                    default=PENDING,
+                                    verbose_name='Отправка на E-mail')
+    attempts = models.PositiveSmallIntegerField(default=0,
+                                                verbose_name='Попыток')
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True,
+                                        verbose_name='Следующая попытка')
+    last_error = models.TextField(blank=True,
+                                  verbose_name='Последняя ошибка')
+
+    def __str__(self):
+        return 'Заказ от {:%d.%m.%Y %H:%M}'.format(
+            timezone.localtime(self.created)
+        )
+
+    class Meta:
+        verbose_name = 'Уведомление о заказе'
+        verbose_name_plural = 'Уведомления о заказах'
+        ordering = ('-id',)
+
+
+class ConversationState(models.Model):
+    """
+    Класс модели для хранения состояния диалогов с пользователями,
+    чтобы заказы переживали перезапуск и обрабатывались любым процессом
+    """
+    key = models.CharField(max_length=100, primary_key=True,
+                           verbose_name='Ключ')
+    value = models.TextField(verbose_name='Значение')
+    updated = models.DateTimeField(default=timezone.now, db_index=True,
+                                   verbose_name='Дата изменения')
+
+    def __str__(self):
+        return self.key
+
+    class Meta:
+        verbose_name = 'Состояние диалога'
+        verbose_name_plural = 'Состояния диалогов'
+
+
+class QueuedUpdate(models.Model):
+    """
+    Класс модели очереди входящих обновлений Telegram.
+    Webhook только сохраняет обновление, обработчики бота вызываются
+    в фоне командой consume_updates
+    """
+    bot_id = models.CharField(max_length=20,
+                              verbose_name='Идентификатор бота')
+    update_id = models.BigIntegerField(verbose_name='Номер обновления')
+    # Обновления одного чата обрабатывает один процесс, по порядку
+    chat_id = models.BigIntegerField(default=0, verbose_name='Чат')
+    data = models.TextField(verbose_name='Обновление')
+    created = models.DateTimeField(default=timezone.now,
+                                   verbose_name='Дата получения')
+    owner = models.CharField(max_length=40, blank=True, db_index=True,
+                             verbose_name='Обработчик')
+    claimed = models.DateTimeField(null=True, blank=True,
+                                   verbose_name='Дата взятия в обработку')
+
+    def __str__(self):
+        return '{}:{}'.format(self.bot_id, self.update_id)
+
+    class Meta:
+        verbose_name = 'Входящее обновление'
+        verbose_name_plural = 'Входящие обновления'
+        unique_together = ('bot_id', 'update_id')
+        index_together = ('chat_id', 'id')
+
+
+class Broadcast(models.Model):
+    """
+    Класс модели рассылки сообщения всем пользователям бота.
+    Рассылка отправляется командой broadcast, position - id последнего
+    пользователя, до которого рассылка уже отправлена
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    STATUS_CHOICES = (
+        (PENDING, 'Ожидает отправки'),
+        (DONE, 'Отправлена'),
+    )
+
+    text = models.TextField(verbose_name='Текст сообщения')
+    parse_mode = models.CharField(max_length=10, blank=True,
+                                  verbose_name='Разметка текста')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True,
+                              verbose_name='Статус')
+    created = models.DateTimeField(auto_now_add=True,
+                                   verbose_name='Дата создания')
+    finished = models.DateTimeField(null=True, blank=True,
+                                    verbose_name='Дата завершения')
+    position = models.PositiveIntegerField(default=0,
+                                           verbose_name='Отправлено до '
+                                                        'пользователя')
+    sent = models.PositiveIntegerField(default=0,
+                                       verbose_name='Отправлено')
+    failed = models.PositiveIntegerField(default=0,
+                                         verbose_name='Ошибок')
+    blocked = models.PositiveIntegerField(default=0,
+                                          verbose_name='Заблокировали бота')
+
+    def __str__(self):
+        return 'Рассылка от {:%d.%m.%Y %H:%M}'.format(
+            timezone.localtime(self.created)
+        )
+
+    class Meta:
+        verbose_name = 'Рассылка'
+        verbose_name_plural = 'Рассылки'
+        ordering = ('-id',)
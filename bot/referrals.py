@@ -0,0 +1,138 @@
+import re
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import base36_to_int, int_to_base36
+
+from .models import ReferralUser, Reward
+
+# Бонус за приглашенного пользователя и число уровней, получающих бонус
+REFERRAL_BONUS = 100
+REFERRAL_LEVELS = 3
+
+# Реферальный код: id пригласившего в base36 и подпись id, например
+# 'q3-9f1c2e7a0b4d6e8f'. Параметр /start ограничен Telegram 64 символами
+# [A-Za-z0-9_-]
+REFERRAL_TOKEN_RE = re.compile(r'^([0-9a-z]{1,13})-([0-9a-f]{16})$')
+REFERRAL_TOKEN_SALT = 'bot.referrals.token'
+# Коды, выданные до введения подписанных кодов: подпись chat_id
+# в base64, хранится в поле refer_code
+LEGACY_CODE_RE = re.compile(r'^[A-Za-z0-9_-]{27}$')
+
+
+def sign_referral_id(value):
+    return salted_hmac(REFERRAL_TOKEN_SALT, value).hexdigest()[:16]
+
+
+def make_referral_token(user_id):
+    """
+    Функция возвращает реферальный код пользователя с id user_id
+    """
+    value = int_to_base36(user_id)
+    return '{}-{}'.format(value, sign_referral_id(value))
+
+
+def parse_referral_token(token):
+    """
+    Функция проверяет подпись реферального кода без обращения к базе
+    данных и возвращает id пригласившего или None
+    """
+    match = REFERRAL_TOKEN_RE.match(token)
+    if match is None:
+        return None
+    value, signature = match.groups()
+    if not constant_time_compare(signature, sign_referral_id(value)):
+        return None
+    return base36_to_int(value)
+
+
+STATS_FIELDS = (
+    'invited_level_1', 'invited_level_2', 'invited_level_3',
+    'earned_level_1', 'earned_level_2', 'earned_level_3',
+)
+
+
+def iter_referral_stats(queryset):
+    """
+    Функция обходит пользователей в порядке (tree_id, lft) и для каждого
+    возвращает id, текущие значения статистики и число приглашенных
+    по уровням, посчитанное по дереву. В памяти держится только путь
+    от корня до текущего узла
+    """
+    rows = queryset.order_by('tree_id', 'lft').values_list(
+        'id', 'tree_id', 'lft', 'rght', *STATS_FIELDS
+    ).iterator()
+    # Путь от корня: [id, tree_id, rght, текущие значения, счетчики]
+    path = []
+    for row in rows:
+        user_id, tree_id, lft, rght = row[:4]
+        while path and (path[-1][1] != tree_id or path[-1][2] < lft):
+            yield make_stats(path.pop())
+        for distance, ancestor in enumerate(reversed(path[-REFERRAL_LEVELS:]),
+                                            1):
+            ancestor[4][distance - 1] += 1
+        path.append([user_id, tree_id, rght, row[4:],
+                     [0] * REFERRAL_LEVELS])
+    while path:
+        yield make_stats(path.pop())
+
+
+def make_stats(node):
+    user_id, tree_id, rght, current, counts = node
+    return user_id, tuple(current), tuple(counts)
+
+
+def get_earned(user_ids):
+    """
+    Функция возвращает суммы начислений пользователей user_ids
+    по уровням. Суммы берутся из журнала, а не из числа приглашенных:
+    начисления могли быть пересчитаны командой recompute_balances
+    """
+    earned = {}
+    rows = Reward.objects.filter(
+        user_id__in=user_ids, level__lte=REFERRAL_LEVELS
+    ).values_list('user_id', 'level').annotate(
+        amount=Sum('amount')
+    ).order_by()
+    for user_id, level, amount in rows:
+        earned.setdefault(user_id, [Decimal(0)] * REFERRAL_LEVELS)
+        earned[user_id][level - 1] = amount
+    return earned
+
+
+def repair_referral_stats(batch_size=500):
+    """
+    Функция пересчитывает статистику приглашений всех пользователей
+    и сохраняет изменившиеся значения. Пользователи проверяются
+    пачками по batch_size, каждая пачка сохраняется одной транзакцией.
+    Размер пачки ограничен числом параметров запроса в SQLite
+    (999 в старых версиях). Возвращает количество исправленных пользователей
+    """
+    repaired = 0
+    no_rewards = (Decimal(0),) * REFERRAL_LEVELS
+
+    def repair(batch):
+        earned = get_earned([user_id for user_id, _, _ in batch])
+        changed = []
+        for user_id, current, counts in batch:
+            values = counts + tuple(earned.get(user_id, no_rewards))
+            if current != values:
+                changed.append((user_id, values))
+        with transaction.atomic():
+            for user_id, values in changed:
+                ReferralUser.objects.filter(id=user_id).update(
+                    **dict(zip(STATS_FIELDS, values))
+                )
+        return len(changed)
+
+    batch = []
+    for stats in iter_referral_stats(ReferralUser.objects.all()):
+        batch.append(stats)
+        if len(batch) >= batch_size:
+            repaired += repair(batch)
+            batch = []
+    if batch:
+        repaired += repair(batch)
+    return repaired
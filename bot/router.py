@@ -0,0 +1,83 @@
+from collections import Counter, OrderedDict
+from threading import Lock
+
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+
+
+class Router(object):
+    """
+    Класс маршрутизатора текстовых сообщений.
+    Надпись кнопки сопоставляется с обработчиком поиском по словарю,
+    сообщения, не совпавшие ни с одной кнопкой, проверяются
+    динамическими маршрутами (например, названиями проектов).
+    Клавиатуры меню строятся из тех же зарегистрированных кнопок
+    """
+    def __init__(self):
+        self.routes = {}
+        self.menus = OrderedDict()
+        self.fallbacks = []
+        # Счетчик вызовов маршрутов обновляется из потоков диспетчера
+        self.hits = Counter()
+        self._lock = Lock()
+
+    def add(self, label, handler, menus=()):
+        """
+        Регистрация обработчика кнопки и добавление кнопки в меню
+        """
+        self.routes[label] = handler
+        for menu in menus:
+            self.menus.setdefault(menu, []).append(label)
+
+    def add_fallback(self, name, matcher, handler):
+        """
+        Регистрация динамического маршрута: matcher(text) решает,
+        подходит ли сообщение обработчику
+        """
+        self.fallbacks.append((name, matcher, handler))
+
+    def wrap(self, wrapper):
+        """
+        Замена всех обработчиков на wrapper(название маршрута, обработчик)
+        """
+        for label, handler in self.routes.items():
+            self.routes[label] = wrapper(label, handler)
+        self.fallbacks = [(name, matcher, wrapper(name, handler))
+                          for name, matcher, handler in self.fallbacks]
+
+    def resolve(self, text):
+        """
+        Поиск маршрута для текста, возвращает название маршрута
+        и обработчик или (None, None)
+        """
+        handler = self.routes.get(text)
+        if handler is not None:
+            return text, handler
+        for name, matcher, handler in self.fallbacks:
+            if matcher(text):
+                return name, handler
+        return None, None
+
+    def dispatch(self, bot, update):
+        """
+        Вызов обработчика, соответствующего тексту сообщения
+        """
+        name, handler = self.resolve(update.message.text)
+        if handler is not None:
+            with self._lock:
+                self.hits[name] += 1
+            return handler(bot, update)
+
+    def hit_counts(self):
+        """
+        Копия счетчика вызовов маршрутов: {название маршрута: вызовов}
+        """
+        with self._lock:
+            return dict(self.hits)
+
+    def keyboard(self, menu, **kwargs):
+        """
+        Клавиатура меню, по одной кнопке в строке
+        """
+        return ReplyKeyboardMarkup([
+            [KeyboardButton(label)] for label in self.menus[menu]
+        ], **kwargs)
@@ -0,0 +1,60 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .cache import catalog_cache, settings_cache, user_cache
+from .database import configure_connection
+from .models import Project, ReferralLink, ReferralUser, Settings
+
+
+@receiver(post_save, sender=Settings)
+@receiver(post_delete, sender=Settings)
+def invalidate_settings(sender, **kwargs):
+    """
+    Сброс кэша настроек при их изменении после фиксации транзакции
+    """
+    transaction.on_commit(settings_cache.invalidate)
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def invalidate_catalog(sender, **kwargs):
+    """
+    Сброс кэша каталога при изменении проектов после фиксации
+    транзакции
+    """
+    transaction.on_commit(catalog_cache.invalidate)
+
+
+@receiver(post_save, sender=ReferralUser)
+@receiver(post_delete, sender=ReferralUser)
+def invalidate_users(sender, created=False, **kwargs):
+    """
+    Сброс кэша пользователей при изменении пользователя, например
+    в админке. Зарегистрированный пользователь добавляется в кэш
+    при регистрации
+    """
+    if not created:
+        user_cache.invalidate()
+
+
+@receiver(pre_delete, sender=ReferralUser)
+def remove_referral_links(sender, instance, **kwargs):
+    """
+    Удаление связей приглашенных пользователя с его пригласившими.
+    Приглашенные становятся корнями своих деревьев, связи с самим
+    пользователем удаляются каскадно
+    """
+    ReferralLink.objects.filter(
+        ancestor__in=instance.ancestor_links.values('ancestor'),
+        descendant__in=instance.descendant_links.values('descendant'),
+    ).delete()
+
+
+@receiver(connection_created)
+def configure_database(sender, connection, **kwargs):
+    """
+    Настройка нового подключения к базе данных
+    """
+    configure_connection(connection)
@@ -0,0 +1,224 @@
+import json
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from datetime import timedelta
+from threading import Lock
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .database import write_queue
+from .models import ConversationState
+
+# Маркер отсутствующей записи
+MISSING = object()
+# Маркер записи, отсутствие которой в хранилище за кэшем уже известно
+ABSENT = object()
+# Размер кэша в памяти по умолчанию
+DEFAULT_CACHE_SIZE = 100000
+
+
+class StateStore(object):
+    """
+    Базовый класс хранилища состояния диалогов.
+    Ключи - строки, значения - данные, сериализуемые в JSON
+    """
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def keys(self, prefix):
+        raise NotImplementedError
+
+
+class DBStateStore(StateStore):
+    """
+    Класс хранилища состояния в базе данных.
+    Записи, не изменявшиеся дольше ttl секунд, считаются брошенными
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+    def _actual(self):
+        states = ConversationState.objects.all()
+        if self.ttl:
+            states = states.filter(
+                updated__gte=timezone.now() - timedelta(seconds=self.ttl)
+            )
+        return states
+
+    def get(self, key, default=None):
+        value = self._actual().filter(key=key).values_list(
+            'value', flat=True
+        ).first()
+        if value is None:
+            return default
+        return json.loads(value)
+
+    def set(self, key, value):
+        value = json.dumps(value)
+        now = timezone.now()
+        states = ConversationState.objects.filter(key=key)
+        with write_queue.write():
+            if not states.update(value=value, updated=now):
+                try:
+                    with transaction.atomic():
+                        ConversationState.objects.create(key=key,
+                                                         value=value,
+                                                         updated=now)
+                except IntegrityError:
+                    states.update(value=value, updated=now)
+
+    def delete(self, key):
+        with write_queue.write():
+            ConversationState.objects.filter(key=key).delete()
+
+    def keys(self, prefix):
+        return list(self._actual().filter(key__startswith=prefix).values_list(
+            'key', flat=True
+        ))
+
+    def purge_expired(self):
+        """
+        Удаление брошенных диалогов, возвращает количество удаленных записей
+        """
+        if not self.ttl:
+            return 0
+        deleted, _ = ConversationState.objects.filter(
+            updated__lt=timezone.now() - timedelta(seconds=self.ttl)
+        ).delete()
+        return deleted
+
+
+class MemoryStateStore(StateStore):
+    """
+    Класс хранилища состояния в памяти процесса с вытеснением давно
+    не использованных записей (LRU) и истечением по ttl.
+    Если указано хранилище backend, память служит кэшем перед ним:
+    запись идет в оба хранилища, чтение - из памяти при наличии записи.
+    Кэш подходит только для случая, когда все обновления одного чата
+    обрабатывает один процесс
+    """
+    def __init__(self, max_size=10000, ttl=None, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def _get_local(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return MISSING
+            value, expires = item
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        value = self._get_local(key)
+        if value is MISSING:
+            if self.backend is None:
+                return default
+            value = self.backend.get(key, ABSENT)
+            # Отсутствие записи тоже кэшируется, чтобы сообщения вне
+            # диалога не обращались к базе
+            self._set_local(key, value)
+        return default if value is ABSENT else value
+
+    def set(self, key, value):
+        if self.backend is not None:
+            self.backend.set(key, value)
+        self._set_local(key, value)
+
+    def delete(self, key):
+        if self.backend is None:
+            with self._lock:
+                self._data.pop(key, None)
+        else:
+            self.backend.delete(key)
+            self._set_local(key, ABSENT)
+
+    def keys(self, prefix):
+        if self.backend is not None:
+            return self.backend.keys(prefix)
+        with self._lock:
+            return [key for key in self._data if key.startswith(prefix)
+                    and self._data[key][0] is not ABSENT]
+
+
+class StateMapping(MutableMapping):
+    """
+    Класс словаря поверх хранилища состояния с отдельным пространством
+    ключей. Ключами могут быть числа или кортежи чисел, как у
+    ConversationHandler.conversations
+    """
+    def __init__(self, store, namespace):
+        self.store = store
+        self.prefix = '{}:'.format(namespace)
+
+    def _make_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        return self.prefix + ':'.join(str(part) for part in key)
+
+    def _parse_key(self, key):
+        key = tuple(int(part) for part in key[len(self.prefix):].split(':'))
+        return key[0] if len(key) == 1 else key
+
+    def __getitem__(self, key):
+        value = self.store.get(self._make_key(key), MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.store.set(self._make_key(key), value)
+
+    def __delitem__(self, key):
+        self.store.delete(self._make_key(key))
+
+    def __iter__(self):
+        return iter([self._parse_key(key)
+                     for key in self.store.keys(self.prefix)])
+
+    def __len__(self):
+        return len(self.store.keys(self.prefix))
+
+
+def get_state_store():
+    """
+    Функция создания хранилища состояния по настройке BOT_STATE_STORE
+    """
+    options = getattr(settings, 'BOT_STATE_STORE', {})
+    ttl = options.get('TTL')
+    cache_size = options.get('CACHE_SIZE', 0)
+    if cache_size is None:
+        # Кэш безопасен, только когда чаты распределены между процессами
+        # очередью обновлений
+        queue = getattr(settings, 'BOT_UPDATE_QUEUE', {})
+        cache_size = DEFAULT_CACHE_SIZE if queue.get('ENABLED') else 0
+    if options.get('BACKEND', 'memory') == 'db':
+        store = DBStateStore(ttl=ttl)
+        if cache_size:
+            store = MemoryStateStore(cache_size, ttl=ttl, backend=store)
+        return store
+    return MemoryStateStore(cache_size or DEFAULT_CACHE_SIZE, ttl=ttl)
@@ -0,0 +1,177 @@
+import logging
+from datetime import timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import CharField, Case, F, Q, Value, When
+from django.utils import timezone
+
+from testbot.settings import EMAIL_HOST_USER
+from .cache import get_settings
+from .database import write_queue
+from .models import OrderNotification
+
+
+logger = logging.getLogger(__name__)
+
+# Количество попыток отправки и задержка перед первым повтором,
+# каждая следующая задержка вдвое больше предыдущей
+MAX_ATTEMPTS = 8
+RETRY_DELAY = timedelta(seconds=30)
+# Время, на которое процесс берет уведомления в отправку. Уведомления
+# упавшего процесса отправляются снова по истечении этого времени
+CLAIM_TIMEOUT = timedelta(minutes=5)
+# Статусы отправки, которые еще нужно выполнить
+UNSENT = (OrderNotification.PENDING, OrderNotification.SENDING)
+
+
+@write_queue.write()
+def enqueue_notification(message):
+    """
+    Функция добавления уведомления о заказе в очередь отправки
+    """
+    return OrderNotification.objects.create(text=message)
+
+
+def get_pending_notifications(batch_size):
+    """
+    Функция выбирает уведомления, время отправки которых наступило.
+    Уведомления в статусе отправки выбираются, если процесс, взявший
+    их, не закончил отправку за CLAIM_TIMEOUT
+    """
+    return list(OrderNotification.objects.filter(
+        Q(telegram_status__in=UNSENT) | Q(email_status__in=UNSENT),
+        next_attempt__lte=timezone.now()
+    ).order_by('id')[:batch_size])
+
+
+def sending_status(field):
+    """
+    Функция возвращает выражение нового статуса при взятии в отправку:
+    неотправленное уведомление переходит в статус отправки
+    """
+    return Case(When(**{'{}__in'.format(field): UNSENT,
+                        'then': Value(OrderNotification.SENDING)}),
+                default=F(field), output_field=CharField())
+
+
+def claim_notifications(notifications):
+    """
+    Функция берет уведомления в отправку условным UPDATE: уведомление
+    достается только процессу, который первым сдвинул время следующей
+    попытки. Возвращает уведомления, взятые этим процессом
+    """
+    now = timezone.now()
+    claimed = []
+    for notification in notifications:
+        with write_queue.write():
+            updated = OrderNotification.objects.filter(
+                pk=notification.pk, next_attempt__lte=now
+            ).update(next_attempt=now + CLAIM_TIMEOUT,
+                     telegram_status=sending_status('telegram_status'),
+                     email_status=sending_status('email_status'))
+        if not updated:
+            continue
+        for field in ('telegram_status', 'email_status'):
+            if getattr(notification, field) in UNSENT:
+                setattr(notification, field, OrderNotification.SENDING)
+        claimed.append(notification)
+    return claimed
+
+
+def send_telegram_notifications(bot, notifications, errors):
+    """
+    Функция отправки уведомлений о заказах в телеграм
+    """
+    settings = get_settings()
+    for notification in notifications:
+        if notification.telegram_status != OrderNotification.SENDING:
+            continue
+        if settings is None or not settings.telegram:
+            logger.info('Отсутствует Telegram ID для отправки '
+                        'информации о заказах')
+            notification.telegram_status = OrderNotification.SKIPPED
+            continue
+        try:
+            bot.sendMessage(settings.telegram.chat_id, notification.text)
+        except Exception as e:
+            logger.error('Ошибка отправки в телеграм: {}'.format(e))
+            errors.setdefault(notification.id, []).append(str(e))
+        else:
+            notification.telegram_status = OrderNotification.SENT
+
+
+def send_email_notifications(notifications, errors):
+    """
+    Функция отправки уведомлений о заказах на E-mail.
+    Все письма пачки отправляются через одно SMTP соединение
+    """
+    settings = get_settings()
+    pending = [notification for notification in notifications
+               if notification.email_status == OrderNotification.SENDING]
+    if not pending:
+        return
+    if settings is None or not settings.email:
+        logger.info('Отсутствует Email для отправки информации о заказах')
+        for notification in pending:
+            notification.email_status = OrderNotification.SKIPPED
+        return
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:
+        logger.error('Ошибка подключения к почтовому серверу: {}'.format(e))
+        for notification in pending:
+            errors.setdefault(notification.id, []).append(str(e))
+        return
+    try:
+        for notification in pending:
+            email = EmailMessage(subject='Новый заказ',
+                                 body=notification.text,
+                                 from_email=EMAIL_HOST_USER,
+                                 to=[settings.email],
+                                 connection=connection)
+            try:
+                email.send()
+            except Exception as e:
+                logger.error('Ошибка отправки E-mail: {}'.format(e))
+                errors.setdefault(notification.id, []).append(str(e))
+            else:
+                notification.email_status = OrderNotification.SENT
+    finally:
+        connection.close()
+
+
+def deliver_notifications(bot, batch_size=50):
+    """
+    Функция отправки пачки уведомлений о заказах.
+    Уведомления сначала берутся в отправку, поэтому несколько
+    одновременно запущенных процессов не отправляют одно уведомление
+    дважды. Неудачные отправки повторяются с экспоненциально растущей
+    задержкой, после MAX_ATTEMPTS попыток уведомление помечается
+    как ошибочное. Возвращает количество выбранных уведомлений
+    """
+    selected = get_pending_notifications(batch_size)
+    notifications = claim_notifications(selected)
+    errors = {}
+    send_telegram_notifications(bot, notifications, errors)
+    send_email_notifications(notifications, errors)
+    for notification in notifications:
+        if notification.id in errors:
+            notification.attempts += 1
+            notification.last_error = '\n'.join(errors[notification.id])
+            failed = notification.attempts >= MAX_ATTEMPTS
+            if not failed:
+                notification.next_attempt = timezone.now() + (
+                    RETRY_DELAY * 2 ** (notification.attempts - 1)
+                )
+            for field in ('telegram_status', 'email_status'):
+                if getattr(notification, field) == OrderNotification.SENDING:
+                    setattr(notification, field,
+                            OrderNotification.FAILED if failed
+                            else OrderNotification.PENDING)
+        with write_queue.write():
+            notification.save(update_fields=[
+                'telegram_status', 'email_status', 'attempts',
+                'next_attempt', 'last_error'
+            ])
+    return len(selected)
@@ -1,33 +1,68 @@
 import logging
 import re
 
-from django.core.mail import send_mail
+from django.conf import settings
 from django_telegrambot.apps import DjangoTelegramBot
-from telegram import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import (CommandHandler, MessageHandler, RegexHandler,
-                          Filters, ConversationHandler)
-
-from testbot.settings import EMAIL_HOST_USER
-from .models import Project, ReferralUser, Settings
+from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
+                      KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove,
+                      Update)
+from telegram.error import BadRequest
+from telegram.ext import (CallbackQueryHandler, CommandHandler,
+                          MessageHandler, RegexHandler, TypeHandler, Filters,
+                          ConversationHandler)
+
+from .cache import (DerivedCache, catalog_cache, get_catalog, get_settings,
+                    get_user, settings_cache, user_cache)
+from .database import write_queue
+from .ledger import (get_balance as get_user_balance, get_statistics,
+                     record_rewards)
+from .metrics import instrument, instrument_bot
+from .models import Project, ReferralUser
+from .referrals import (LEGACY_CODE_RE, REFERRAL_LEVELS, make_referral_token,
+                        parse_referral_token)
+from .router import Router
+from .state import StateMapping, get_state_store
+from .tasks import enqueue_notification
+from .throttle import get_throttle
+from .tree import get_tree
+from .updates import configure_bot_requests
 
 
 logger = logging.getLogger(__name__)
 
-main_keyboard = ReplyKeyboardMarkup([
-    [KeyboardButton('Как зарабатывать в интернете')],
-    [KeyboardButton('Приглашенные друзья')],
-    [KeyboardButton('Заказать')],
-])
-
-go_back_keyboard = ReplyKeyboardMarkup([
-    [KeyboardButton('Назад')]
-], resize_keyboard=True)
-
+# Клавиатуры сериализуются один раз, при отправке передается готовый JSON
 get_phone_keyboard = ReplyKeyboardMarkup([
     [KeyboardButton('Отправить свой номер телефона', request_contact=True)]
-], resize_keyboard=True, one_time_keyboard=True)
+], resize_keyboard=True, one_time_keyboard=True).to_json()
+
+confirm_name_keyboard = ReplyKeyboardMarkup([
+    [KeyboardButton('Да'), KeyboardButton('Нет')]
+], resize_keyboard=True, one_time_keyboard=True).to_json()
+
+make_order_keyboard = ReplyKeyboardMarkup([
+    [KeyboardButton('Сделать заказ')]
+], resize_keyboard=True).to_json()
+
+remove_keyboard = ReplyKeyboardRemove().to_json()
 
-orders = {}
+# Данные заказов и состояния диалогов хранятся в общем хранилище,
+# чтобы заказ можно было продолжить в любом процессе и после перезапуска
+state_store = get_state_store()
+orders = StateMapping(state_store, 'order')
+
+# Дерево приглашений в режиме из настройки BOT_TREE_BACKEND
+tree = get_tree()
+
+# Количество приглашенных на одной странице списка, с запасом
+# укладывается в ограничение Telegram в 4096 символов
+REFERRALS_PAGE_SIZE = 30
+# Ограничение Telegram на длину подписи к фото
+CAPTION_LIMIT = 1024
+LEVEL_TITLES = {
+    1: 'Первый уровень',
+    2: 'Второй уровень',
+    3: 'Третий уровень',
+}
 
 
 def start(bot, update):
@@ -43,35 +78,44 @@ def start(bot, update):
         referral_code = update.message.text.split(' ')[1]
     except IndexError:
         referral_code = None
-    parent = None
-    if referral_code is not None:
-        try:
-            parent = ReferralUser.objects.get(refer_code=referral_code)
-        except ReferralUser.DoesNotExist:
-            pass
 
-    try:
-        ReferralUser.objects.get(chat_id=update.message.chat_id)
-    except ReferralUser.DoesNotExist:
-        user = ReferralUser.objects.create(
-            chat_id=update.message.chat_id,
-            name=name,
-            username=username if username is not None else '',
-            parent=parent
-        )
-        if parent is not None:
-            increase_balance(user.id)
+    user = get_user(update.message.chat_id)
+    if user is None:
+        parent = None
+        if referral_code is not None:
+            parent = get_referrer(referral_code)
+        with write_queue.write():
+            user, ancestors = tree.create_user(
+                chat_id=update.message.chat_id,
+                name=name,
+                username=username if username is not None else '',
+                parent=parent
+            )
+            if ancestors:
+                record_rewards(user, ancestors)
+        user_cache.set(user)
+    elif user.is_blocked:
+        # Пользователь снова запустил бота, рассылки ему доступны
+        with write_queue.write():
+            ReferralUser.objects.filter(id=user.id).update(is_blocked=False)
+        user_cache.delete(user.chat_id)
     update.message.reply_text(text=text, reply_markup=main_keyboard)
 
 
-def increase_balance(user_id):
+def get_referrer(referral_code):
     """
-    Функция увеличивает баланс у родителей за привлеченного пользователя
+    Функция возвращает пригласившего пользователя по реферальному коду
+    или None. Код с неверной подписью отклоняется без запроса к базе
+    данных. Старые коды из поля refer_code принимаются, пока включена
+    настройка BOT_LEGACY_REFER_CODES
     """
-    user = ReferralUser.objects.get(id=user_id)
-    for parent in user.get_ancestors(ascending=True)[:3]:
-        parent.balance += 100
-        parent.save()
+    user_id = parse_referral_token(referral_code)
+    if user_id is not None:
+        return ReferralUser.objects.filter(id=user_id).first()
+    if (getattr(settings, 'BOT_LEGACY_REFER_CODES', False) and
+            LEGACY_CODE_RE.match(referral_code)):
+        return ReferralUser.objects.filter(refer_code=referral_code).first()
+    return None
 
 
 def home(bot, update):
@@ -85,14 +129,7 @@ def projects_list(bot, update):
     """
     Функция отображения списка проектов по заработку в интернете
     """
-    text = 'Проекты еще не добавлены'
-    keyboard = main_keyboard
-    projects = Project.objects.all()
-    if projects.exists():
-        text = 'Проекты по заработку в интернете:'
-        keyboard = ReplyKeyboardMarkup([
-            [KeyboardButton(project.title)] for project in projects
-        ])
+    text, keyboard = screens_cache.get()['projects']
     update.message.reply_text(text, reply_markup=keyboard)
 
 
@@ -100,145 +137,272 @@ def show_project(bot, update):
     """
     Функция вывода детальной информации по проекту
     """
-    text = update.message.text
-    try:
-        project = Project.objects.get(title=text)
-    except Project.DoesNotExist:
-        project = None
-    if project:
-        reply_text = '<b>{title}</b>\n<i>{description}</i>\n'.format(
-            title=project.title,
-            description=project.description
-        )
-        if project.image:
-            reply_text += '<a href="https://rutests.com{}">&#8205;</a>\n'.format(
-                project.image.url
-            )
-        if project.link:
-            reply_text += '<a href="{}">Ссылка на сайт проекта</a>\n'.format(
-                project.link
-            )
-
+    screen = screens_cache.get().get(('project', update.message.text))
+    if screen is not None:
+        reply_text, keyboard = screen
+        project = get_catalog().get(update.message.text)
+        if project is not None and project.photo:
+            send_project_photo(bot, update.message.chat_id, project,
+                               reply_text, keyboard)
+            return
         bot.sendMessage(update.message.chat_id,
                         reply_text,
-                        reply_markup=go_back_keyboard,
+                        reply_markup=keyboard,
+                        parse_mode='HTML')
+
+
+def send_project_photo(bot, chat_id, project, text, keyboard):
+    """
+    Функция отправки фото проекта с описанием в подписи. Описание
+    длиннее допустимой подписи отправляется отдельным сообщением.
+    Фото загружается в Telegram один раз, дальше отправляется
+    по сохраненному идентификатору
+    """
+    caption = text if len(text) <= CAPTION_LIMIT else None
+    options = {'caption': caption, 'parse_mode': 'HTML',
+               'reply_markup': keyboard if caption else None}
+    message = None
+    if project.telegram_file_id:
+        try:
+            message = bot.sendPhoto(chat_id, project.telegram_file_id,
+                                    **options)
+        except BadRequest as e:
+            logger.warning('Не удалось отправить фото проекта %s '
+                           'по идентификатору: %s', project.pk, e)
+    if message is None:
+        # Проект общий для потоков из кеша каталога, поэтому файл
+        # открывается отдельно для каждой отправки
+        with project.photo.storage.open(project.photo.name, 'rb') as photo:
+            message = bot.sendPhoto(chat_id, photo, **options)
+        remember_file_id(project, message)
+    if caption is None:
+        bot.sendMessage(chat_id, text, reply_markup=keyboard,
                         parse_mode='HTML')
 
 
+def remember_file_id(project, message):
+    """
+    Функция сохраняет идентификатор загруженного в Telegram фото
+    проекта, если за это время фото не заменили
+    """
+    if not message.photo:
+        return
+    file_id = message.photo[-1].file_id
+    project.telegram_file_id = file_id
+    with write_queue.write():
+        Project.objects.filter(pk=project.pk,
+                               photo=project.photo.name).update(
+            telegram_file_id=file_id
+        )
+    # Остальные процессы перечитают проект с идентификатором
+    catalog_cache.invalidate()
+
+
 def friends_menu(bot, update):
     """
     Функция отображения меню для работы с приглашенными друзьями
     """
-    keyboard = ReplyKeyboardMarkup([
-        [KeyboardButton('Ссылка для приглашения')],
-        [KeyboardButton('Список приглашенных')],
-        [KeyboardButton('Баланс')],
-        [KeyboardButton('Описание')],
-        [KeyboardButton('Назад')],
-    ])
-    update.message.reply_text('Выберите действие', reply_markup=keyboard)
+    update.message.reply_text('Выберите действие',
+                              reply_markup=friends_keyboard)
 
 
 def get_referral_link(bot, update):
     """
     Функция для получения своей реферральной ссылки
     """
-    user = ReferralUser.objects.get(chat_id=update.message.chat_id)
+    user = get_user(update.message.chat_id)
+    if user is None:
+        return
     text = 'https://t.me/{bot_name}?start={refer_code}'.format(
         bot_name=bot.username,
-        refer_code=user.refer_code
+        refer_code=make_referral_token(user.id)
     )
     update.message.reply_text(text)
 
 
+def render_referrals_page(rows, next_page, counts=None):
+    """
+    Функция формирования текста и клавиатуры страницы приглашенных
+    """
+    lines = []
+    if counts is not None:
+        lines.append('Всего приглашенных: {}'.format(', '.join(
+            '{} ур. - {}'.format(level, counts.get(level, 0))
+            for level in range(1, REFERRAL_LEVELS + 1)
+        )))
+    current_level = None
+    for level, key, name in rows:
+        if level != current_level:
+            current_level = level
+            lines.append('{}:'.format(LEVEL_TITLES[level]))
+        lines.append('- {}'.format(name))
+    keyboard = None
+    if next_page is not None:
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(
+            'Следующая страница',
+            callback_data='referrals:{}:{}'.format(*next_page)
+        )]])
+    return '\n'.join(lines), keyboard
+
+
 def show_user_referrals(bot, update):
     """
     Функция для вывода списка приглашенных друзей (реферралов)
     """
-    user = None
-    try:
-        user = ReferralUser.objects.get(chat_id=update.message.chat_id)
-    except ReferralUser.DoesNotExist:
-        pass
+    user = get_user(update.message.chat_id)
     if user is not None:
-        text = 'Ваш список приглашенных пуст'
-        referrals_level_1 = user.get_descendants().filter(level=user.level + 1)
-        if referrals_level_1.exists():
-            text = 'Первый уровень:\n'
-            text += '\n'.join('- {}'.format(r.name) for r in referrals_level_1)
-        referrals_level_2 = user.get_descendants().filter(level=user.level + 2)
-        if referrals_level_2.exists():
-            text += '\nВторой уровень:\n'
-            text += '\n'.join('- {}'.format(r.name) for r in referrals_level_2)
-        referrals_level_3 = user.get_descendants().filter(level=user.level + 3)
-        if referrals_level_3.exists():
-            text += '\nТретий уровень:\n'
-            text += '\n'.join('- {}'.format(r.name) for r in referrals_level_3)
-        update.message.reply_text(text)
+        rows, next_page, counts = tree.first_referrals_page(
+            user, limit=REFERRALS_PAGE_SIZE
+        )
+        if not rows:
+            update.message.reply_text('Ваш список приглашенных пуст')
+            return
+        text, keyboard = render_referrals_page(rows, next_page, counts)
+        update.message.reply_text(text, reply_markup=keyboard)
+
+
+def show_user_referrals_page(bot, update):
+    """
+    Функция для вывода следующей страницы списка приглашенных
+    """
+    query = update.callback_query
+    query.answer()
+    level, key = (int(value) for value in query.data.split(':')[1:])
+    user = get_user(query.message.chat_id)
+    if user is None:
+        return
+    rows, next_page = tree.referrals_page(user, after=(level, key),
+                                          limit=REFERRALS_PAGE_SIZE)
+    if rows:
+        text, keyboard = render_referrals_page(rows, next_page)
+        bot.sendMessage(query.message.chat_id, text, reply_markup=keyboard)
 
 
 def get_balance(bot, update):
     """
     Функция для отображения баланса пользователя
     """
-    user = None
-    try:
-        user = ReferralUser.objects.get(chat_id=update.message.chat_id)
-    except ReferralUser.DoesNotExist:
-        pass
+    user = get_user(update.message.chat_id)
+    if user is not None:
+        update.message.reply_text('Ваш баланс: {}'.format(
+            get_user_balance(user)
+        ))
+
+
+def show_statistics(bot, update):
+    """
+    Функция для отображения статистики приглашений по уровням
+    """
+    user = get_user(update.message.chat_id)
     if user is not None:
-        update.message.reply_text('Ваш баланс: {}'.format(user.balance))
+        balance, levels = get_statistics(user)
+        lines = ['Статистика приглашений:']
+        for level in range(1, REFERRAL_LEVELS + 1):
+            lines.append('{}: приглашено {}, заработано {}'.format(
+                LEVEL_TITLES[level], *levels[level]
+            ))
+        lines.append('Баланс: {}'.format(balance))
+        update.message.reply_text('\n'.join(lines))
 
 
 def show_description(bot, update):
     """
     Функция выводит описание на странице с приглашенными пользователями
     """
-    description = 'Описание пока не добавлено'
-    if Settings.objects.exists():
-        if Settings.objects.first().referrals_description:
-            description = Settings.objects.first().referrals_description
-    update.message.reply_text(description)
+    text, keyboard = screens_cache.get()['description']
+    update.message.reply_text(text, reply_markup=keyboard)
 
 
 def show_order_notification(bot, update):
     """
     Функция выводит текст описания при нажании на кнопку Заказать
     """
-    text = 'Текст еще не добавлен'
-    keyboard = ReplyKeyboardMarkup([
-        [KeyboardButton('Сделать заказ')]
-    ], resize_keyboard=True)
-    if Settings.objects.exists():
-        if Settings.objects.first().order_text:
-            text = Settings.objects.first().order_text
+    text, keyboard = screens_cache.get()['order']
     update.message.reply_text(text, reply_markup=keyboard)
 
 
+# Кнопки меню и их обработчики. Клавиатуры строятся по этой же таблице,
+# кнопки выводятся в порядке регистрации
+router = Router()
+router.add('Как зарабатывать в интернете', projects_list, menus=('main',))
+router.add('Приглашенные друзья', friends_menu, menus=('main',))
+router.add('Заказать', show_order_notification, menus=('main',))
+router.add('Ссылка для приглашения', get_referral_link, menus=('friends',))
+router.add('Список приглашенных', show_user_referrals, menus=('friends',))
+router.add('Баланс', get_balance, menus=('friends',))
+router.add('Статистика', show_statistics, menus=('friends',))
+router.add('Описание', show_description, menus=('friends',))
+router.add('Назад', home, menus=('friends', 'back'))
+router.add_fallback('project', lambda text: text in get_catalog(),
+                    show_project)
+
+main_keyboard = router.keyboard('main').to_json()
+friends_keyboard = router.keyboard('friends').to_json()
+go_back_keyboard = router.keyboard('back', resize_keyboard=True).to_json()
+
+
+def render_project(project):
+    """
+    Функция формирования описания проекта в HTML
+    """
+    text = '<b>{title}</b>\n<i>{description}</i>\n'.format(
+        title=project.title,
+        description=project.description
+    )
+    if project.image and not project.photo:
+        # Копии изображения еще не созданы, Telegram покажет превью
+        # исходного файла
+        text += '<a href="https://rutests.com{}">&#8205;</a>\n'.format(
+            project.image.url
+        )
+    if project.link:
+        text += '<a href="{}">Ссылка на сайт проекта</a>\n'.format(
+            project.link
+        )
+    return text
+
+
+def render_screens():
+    """
+    Функция подготовки ответов для экранов, зависящих только от проектов
+    и настроек: текст и сериализованная клавиатура
+    """
+    catalog = get_catalog()
+    settings = get_settings()
+    screens = {}
+    if catalog.titles:
+        screens['projects'] = (
+            'Проекты по заработку в интернете:',
+            ReplyKeyboardMarkup([
+                [KeyboardButton(title)] for title in catalog.titles
+            ]).to_json()
+        )
+    else:
+        screens['projects'] = ('Проекты еще не добавлены', main_keyboard)
+    for title, project in catalog.projects.items():
+        screens[('project', title)] = (render_project(project),
+                                       go_back_keyboard)
+    description = 'Описание пока не добавлено'
+    if settings is not None and settings.referrals_description:
+        description = settings.referrals_description
+    screens['description'] = (description, None)
+    order_text = 'Текст еще не добавлен'
+    if settings is not None and settings.order_text:
+        order_text = settings.order_text
+    screens['order'] = (order_text, make_order_keyboard)
+    return screens
+
+
+# Готовые ответы пересобираются только после изменения проектов
+# или настроек
+screens_cache = DerivedCache(render_screens, settings_cache, catalog_cache)
+
+
 def text_processing(bot, update):
     """
     Функция обработки ответов пользователя
     """
-    projects = [project.title for project in Project.objects.all()]
-    text = update.message.text
-    if text == 'Как зарабатывать в интернете':
-        projects_list(bot, update)
-    elif text == 'Назад':
-        home(bot, update)
-    elif text == 'Приглашенные друзья':
-        friends_menu(bot, update)
-    elif text == 'Список приглашенных':
-        show_user_referrals(bot, update)
-    elif text == 'Ссылка для приглашения':
-        get_referral_link(bot, update)
-    elif text == 'Баланс':
-        get_balance(bot, update)
-    elif text == 'Описание':
-        show_description(bot, update)
-    elif text in projects:
-        show_project(bot, update)
-    elif text == 'Заказать':
-        show_order_notification(bot, update)
+    router.dispatch(bot, update)
 
 
 # Диалог с пользователем для создания заказа
@@ -249,8 +413,7 @@ def cancel(bot, update):
     """
     Функция для отмены заказа
     """
-    order = orders.get(update.message.chat_id, None)
-    if order is not None:
+    if update.message.chat_id in orders:
         del orders[update.message.chat_id]
     update.message.reply_text('Заказ отменен')
     home(bot, update)
@@ -262,11 +425,8 @@ def start_conversation(bot, update):
     Функция начала диалога
     """
     user = update.message.from_user
-    keyboard = ReplyKeyboardMarkup([
-        [KeyboardButton('Да'), KeyboardButton('Нет')]
-    ], resize_keyboard=True, one_time_keyboard=True)
     update.message.reply_text('Ваше имя {}?'.format(user.first_name),
-                              reply_markup=keyboard)
+                              reply_markup=confirm_name_keyboard)
     return CONFIRM_NAME
 
 
@@ -277,20 +437,18 @@ def confirm_name(bot, update):
     user = update.message.from_user
     text = update.message.text
     if text == 'Да':
-        orders[update.message.chat_id] = {'name': user.first_name}
+        order = {'name': user.first_name}
         if user.username:
-            orders[update.message.chat_id].update(
-                {'username': '@{}'.format(user.username)}
-            )
+            order['username'] = '@{}'.format(user.username)
+        orders[update.message.chat_id] = order
         update.message.reply_text('Пришлите Ваш номер телефона, или отправьте '
                                   '/cancel для отмены заказа',
                                   reply_markup=get_phone_keyboard)
         return PHONE
     elif text == 'Нет':
-        keyboard = ReplyKeyboardRemove()
         update.message.reply_text('Введите Ваше имя, или отправьте /cancel для'
                                   ' отмены заказа',
-                                  reply_markup=keyboard)
+                                  reply_markup=remove_keyboard)
         return GET_NAME
 
 
@@ -300,11 +458,10 @@ def get_name(bot, update):
     """
     text = update.message.text
     user = update.message.from_user
-    orders[update.message.chat_id] = {'name': text}
+    order = {'name': text}
     if user.username:
-        orders[update.message.chat_id].update(
-            {'username': '@{}'.format(user.username)}
-        )
+        order['username'] = '@{}'.format(user.username)
+    orders[update.message.chat_id] = order
     update.message.reply_text('Спасибо, {}! '
                               'Пришлите Ваш номер телефона, или отправьте '
                               '/cancel для отмены заказа'.format(text),
@@ -317,10 +474,12 @@ def get_phone(bot, update):
     Функция для получения номера телефона клиента
     """
     phone_number = update.message.contact.phone_number
-    orders[update.message.chat_id].update({'phone': phone_number})
+    order = orders[update.message.chat_id]
+    order['phone'] = phone_number
+    orders[update.message.chat_id] = order
     update.message.reply_text('Спасибо! Теперь укажите Ваш E-mail, или '
                               'отправьте /cancel для отмены заказа',
-                              reply_markup=ReplyKeyboardRemove())
+                              reply_markup=remove_keyboard)
 
     return EMAIL
 
@@ -334,13 +493,13 @@ def get_email(bot, update):
         r'^[a-z0-9](\.?[a-z0-9_-]){0,}@[a-z0-9-]+\.([a-z]{1,6}\.)?[a-z]{2,6}$'
     )
     if regex_email.match(email):
-        orders[update.message.chat_id].update({'email': email})
+        order = orders[update.message.chat_id]
+        order['email'] = email
         update.message.reply_text('Ваши данные приняты. Ожидайте '
                                   'с Вами свяжутся в ближайшее время',
-                                  reply_markup=ReplyKeyboardRemove())
-        message = create_message(orders.get(update.message.chat_id))
-        send_message(bot, message)
-        send_email_message(message)
+                                  reply_markup=remove_keyboard)
+        message = create_message(order)
+        enqueue_notification(message)
         del orders[update.message.chat_id]
         home(bot, update)
 
@@ -349,7 +508,7 @@ def get_email(bot, update):
         update.message.reply_text('Введен некорректный Email: {}\n'
                                   'укажите правильный E-mail, или отправьте '
                                   '/cancel для отмены заказа'.format(email),
-                                  reply_markup=ReplyKeyboardRemove())
+                                  reply_markup=remove_keyboard)
         return EMAIL
 
 
@@ -369,40 +528,6 @@ def create_message(order_info):
     return text
 
 
-def send_message(bot, message):
-    """
-    Функция отправки сообщения о заказе в телеграмм
-    """
-
-    if Settings.objects.exists():
-        if Settings.objects.first().telegram:
-            telegram_id = Settings.objects.first().telegram.chat_id
-            bot.sendMessage(telegram_id, message)
-    else:
-        logger.info('Отсутствует Telegram ID для отправки информации о заказах')
-
-
-def send_email_message(message):
-    """
-    Отправка сообщения о новом заказе на Email
-    """
-    email = None
-    if Settings.objects.exists():
-        if Settings.objects.first().email:
-            email = Settings.objects.first().email
-    if email is not None:
-        try:
-            send_mail(subject='Новый заказ',
-                      message=message,
-                      from_email=EMAIL_HOST_USER,
-                      recipient_list=[email],
-                      fail_silently=False)
-        except Exception as e:
-            logger.error('Ошибка отправки E-mail: {}'.format(e))
-    else:
-        logger.info('Отсутствует Email для отправки информации о заказах')
-
-
 conv_handler = ConversationHandler(
     entry_points=[RegexHandler('^Сделать заказ$', start_conversation)],
     states={
@@ -413,16 +538,47 @@ conv_handler = ConversationHandler(
     },
     fallbacks=[CommandHandler('cancel', cancel)]
 )
+conv_handler.conversations = StateMapping(state_store, 'conversation')
 
 
 def error(bot, update, error):
-    """Log Errors caused by Updates."""
-    logger.error('Update "%s" caused error "%s"', update, error)
+    """
+    Функция записывает в журнал ошибку обработки обновления. Само
+    обновление не форматируется, в журнал попадают его номер и чат
+    """
+    chat = update.effective_chat if isinstance(update, Update) else None
+    logger.error('Ошибка обработки обновления: %s', error, extra={
+        'update_id': getattr(update, 'update_id', None),
+        'chat_id': chat.id if chat is not None else None,
+    }, exc_info=(type(error), error, error.__traceback__))
 
 
-def main():
-    dp = DjangoTelegramBot.dispatcher
-    dp.add_handler(CommandHandler("start", start))
+def main(dispatcher=None):
+    """
+    Регистрация обработчиков бота. По умолчанию в диспетчере
+    django_telegrambot, для тестов и замеров можно передать свой.
+    Все обработчики оборачиваются сбором телеметрии
+    """
+    if dispatcher is None:
+        configure_bot_requests()
+    dp = dispatcher or DjangoTelegramBot.dispatcher
+    instrument_bot(dp.bot)
+    for handler in (conv_handler.entry_points + conv_handler.fallbacks +
+                    [state_handler for state_handlers
+                     in conv_handler.states.values()
+                     for state_handler in state_handlers]):
+        handler.callback = instrument(
+            'order:{}'.format(handler.callback.__name__), handler.callback
+        )
+    router.wrap(lambda name, handler: instrument('text:{}'.format(name),
+                                                 handler))
+    # Ограничение частоты запросов проверяется до всех обработчиков
+    dp.add_handler(TypeHandler(Update, get_throttle()), group=-1)
+    dp.add_handler(CommandHandler("start", instrument('start', start)))
     dp.add_handler(conv_handler)
+    dp.add_handler(CallbackQueryHandler(
+        instrument('referrals_page', show_user_referrals_page),
+        pattern='^referrals:'
+    ))
     dp.add_handler(MessageHandler(Filters.text, text_processing))
     dp.add_error_handler(error)
@@ -1,3 +1,930 @@
-from django.test import TestCase
+import csv
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from threading import Lock, Thread
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import JsonResponse
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from telegram.error import Unauthorized
+from telegram.ext import DispatcherHandlerStop
+
+from .broadcast import RateScheduler, send_broadcast
+from .cache import (VersionedCache, catalog_cache, get_catalog, get_settings,
+                    settings_cache)
+from .ledger import (compact_ledger, get_balance, get_statistics,
+                     record_rewards)
+from .metrics import TimedRequest
+from .models import (Broadcast, ConversationState, OrderNotification,
+                     Project, QueuedUpdate, ReferralLink, ReferralUser,
+                     Reward, Settings)
+from .referrals import make_referral_token, parse_referral_token
+from .router import Router
+from .state import (DBStateStore, MemoryStateStore, StateMapping,
+                    get_state_store)
+from .tasks import (MAX_ATTEMPTS, claim_notifications, deliver_notifications,
+                    enqueue_notification, get_pending_notifications)
+from .telegrambot import get_referrer
+from .throttle import THROTTLED_TEXT, Throttle, TokenBucketLimiter
+from .tree import ClosureTree, MPTTTree
+from .updates import (UpdateConsumer, configure_bot_requests, enqueue_update,
+                      get_queue_depth, reset_bot_requests)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Тесты не должны менять версии и данные в общем кэше работающего бота
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'bot-tests',
+    }
+}
+
+
+def create_users(tree, parents):
+    """
+    Функция регистрирует пользователей с начислениями пригласившим.
+    parents - список номеров пригласивших в этом же списке или None,
+    chat_id пользователя равен его номеру плюс 1
+    """
+    users = []
+    for index, parent in enumerate(parents):
+        user, ancestors = tree.create_user(
+            chat_id=index + 1, name='user{}'.format(index + 1),
+            parent=users[parent] if parent is not None else None
+        )
+        record_rewards(user, ancestors)
+        users.append(user)
+    return users
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SettingsCacheTests(TransactionTestCase):
+    """
+    Класс тестов кэша настроек
+    """
+    def setUp(self):
+        cache.clear()
+        user = ReferralUser.objects.create(chat_id=1, name='user1')
+        self.settings = Settings.objects.create(email='a@example.com',
+                                                telegram=user)
+
+    def test_invalidate_after_commit(self):
+        self.assertEqual(get_settings().email, 'a@example.com')
+        version = cache.get(settings_cache.version_key)
+        with transaction.atomic():
+            self.settings.email = 'b@example.com'
+            self.settings.save()
+            # До фиксации другие процессы не должны перечитать настройки
+            self.assertEqual(cache.get(settings_cache.version_key), version)
+        self.assertNotEqual(cache.get(settings_cache.version_key), version)
+        self.assertEqual(get_settings().email, 'b@example.com')
+
+    def test_value_kept_until_reload(self):
+        values = iter([1, 2])
+        versioned = VersionedCache('test', lambda: next(values))
+        self.assertEqual(versioned.get(), 1)
+        versioned.invalidate()
+        # Поток, уже прочитавший состояние, получает прежнее значение
+        self.assertEqual(versioned._loaded[1], 1)
+        self.assertEqual(versioned.get(), 2)
+        self.assertEqual(versioned.get(), 2)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CatalogCacheTests(TransactionTestCase):
+    """
+    Класс тестов кэша каталога проектов
+    """
+    def setUp(self):
+        cache.clear()
+        Project.objects.create(title='first', description='d')
+
+    def test_invalidate_after_commit(self):
+        self.assertEqual(get_catalog().titles, ['first'])
+        version = cache.get(catalog_cache.version_key)
+        with transaction.atomic():
+            Project.objects.create(title='second', description='d')
+            self.assertEqual(cache.get(catalog_cache.version_key), version)
+            self.assertNotIn('second', get_catalog())
+        self.assertEqual(get_catalog().titles, ['first', 'second'])
+        self.assertIn('second', get_catalog())
+
+
+class FakeBot(object):
+    """
+    Класс бота, записывающего отправленные сообщения вместо отправки.
+    Первые failures вызовов завершаются ошибкой
+    """
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.messages = []
+
+    def sendMessage(self, chat_id, text, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ValueError('Сеть недоступна')
+        self.messages.append((chat_id, text))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class NotificationTests(TestCase):
+    """
+    Класс тестов очереди уведомлений о заказах
+    """
+    def setUp(self):
+        cache.clear()
+        owner = ReferralUser.objects.create(chat_id=1, name='owner')
+        Settings.objects.create(email='owner@example.com', telegram=owner)
+        settings_cache.invalidate()
+        self.notification = enqueue_notification('Новый заказ')
+
+    def refresh(self):
+        self.notification.refresh_from_db()
+        return self.notification
+
+    def make_due(self):
+        OrderNotification.objects.update(next_attempt=timezone.now())
+
+    def test_retry(self):
+        bot = FakeBot(failures=1)
+        self.assertEqual(deliver_notifications(bot), 1)
+        notification = self.refresh()
+        self.assertEqual(notification.telegram_status,
+                         OrderNotification.PENDING)
+        self.assertEqual(notification.email_status, OrderNotification.SENT)
+        self.assertEqual(notification.attempts, 1)
+        self.assertGreater(notification.next_attempt, timezone.now())
+        # Повтор только после задержки
+        self.assertEqual(deliver_notifications(bot), 0)
+        self.make_due()
+        self.assertEqual(deliver_notifications(bot), 1)
+        self.assertEqual(self.refresh().telegram_status,
+                         OrderNotification.SENT)
+        self.assertEqual(bot.messages, [(1, 'Новый заказ')])
+        # Письмо повторно не отправляется
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_failed(self):
+        OrderNotification.objects.update(attempts=MAX_ATTEMPTS - 1)
+        deliver_notifications(FakeBot(failures=1))
+        notification = self.refresh()
+        self.assertEqual(notification.telegram_status,
+                         OrderNotification.FAILED)
+        self.assertEqual(notification.email_status, OrderNotification.SENT)
+        self.make_due()
+        self.assertEqual(deliver_notifications(FakeBot()), 0)
+
+    def test_claim(self):
+        selected = get_pending_notifications(10)
+        # Уведомление достается только одному процессу
+        self.assertEqual(claim_notifications(selected), selected)
+        self.assertEqual(claim_notifications(get_pending_notifications(10) +
+                                             selected), [])
+        self.assertEqual(self.refresh().telegram_status,
+                         OrderNotification.SENDING)
+        bot = FakeBot()
+        self.assertEqual(deliver_notifications(bot), 0)
+        self.assertEqual(bot.messages, [])
+        # Уведомления упавшего процесса отправляются после CLAIM_TIMEOUT
+        self.make_due()
+        self.assertEqual(deliver_notifications(bot), 1)
+        self.assertEqual(bot.messages, [(1, 'Новый заказ')])
+        self.assertEqual(len(mail.outbox), 1)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StateStoreTests(TestCase):
+    """
+    Класс тестов хранилищ состояния диалогов
+    """
+    def test_db_store(self):
+        store = DBStateStore(ttl=60)
+        store.set('order:1', {'name': 'Иван'})
+        store.set('order:1', {'name': 'Петр'})
+        store.set('conversation:1', 2)
+        self.assertEqual(store.get('order:1'), {'name': 'Петр'})
+        self.assertEqual(store.keys('order:'), ['order:1'])
+        store.delete('order:1')
+        self.assertIsNone(store.get('order:1'))
+        # Брошенный диалог не читается и удаляется
+        ConversationState.objects.update(
+            updated=timezone.now() - timedelta(seconds=120)
+        )
+        self.assertIsNone(store.get('conversation:1'))
+        self.assertEqual(store.purge_expired(), 1)
+
+    def test_memory_front(self):
+        store = MemoryStateStore(10, backend=DBStateStore())
+        store.set('order:1', {'phone': '1'})
+        store.get('order:2')
+        # Записи и их отсутствие читаются из памяти
+        with self.assertNumQueries(0):
+            self.assertEqual(store.get('order:1'), {'phone': '1'})
+            self.assertIsNone(store.get('order:2'))
+        store.delete('order:1')
+        with self.assertNumQueries(0):
+            self.assertEqual(store.get('order:1', 'default'), 'default')
+        self.assertFalse(ConversationState.objects.exists())
+
+    def test_memory_eviction(self):
+        store = MemoryStateStore(2)
+        store.set('a', 1)
+        store.set('b', 2)
+        store.get('a')
+        store.set('c', 3)
+        self.assertEqual(store.get('a'), 1)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(sorted(store.keys('')), ['a', 'c'])
+
+    def test_mapping(self):
+        mapping = StateMapping(MemoryStateStore(), 'conversation')
+        mapping[(1, 2)] = 'state'
+        mapping[3] = 'other'
+        self.assertEqual(mapping[(1, 2)], 'state')
+        self.assertEqual(sorted(mapping, key=str), [(1, 2), 3])
+        del mapping[3]
+        self.assertNotIn(3, mapping)
+        self.assertEqual(len(mapping), 1)
+
+    def test_cache_follows_queue(self):
+        options = {'BACKEND': 'db', 'CACHE_SIZE': None}
+        with self.settings(BOT_STATE_STORE=options,
+                           BOT_UPDATE_QUEUE={'ENABLED': False}):
+            self.assertIsInstance(get_state_store(), DBStateStore)
+        with self.settings(BOT_STATE_STORE=options,
+                           BOT_UPDATE_QUEUE={'ENABLED': True}):
+            store = get_state_store()
+            self.assertIsInstance(store, MemoryStateStore)
+            self.assertIsInstance(store.backend, DBStateStore)
+
+
+def make_message_update(text, chat_id=1):
+    """
+    Функция возвращает обновление с текстовым сообщением
+    """
+    update = mock.Mock()
+    update.message.text = text
+    update.message.chat_id = chat_id
+    update.effective_message = update.message
+    update.effective_chat.id = chat_id
+    update.callback_query = None
+    return update
+
+
+class RouterTests(TestCase):
+    """
+    Класс тестов маршрутизатора текстовых сообщений
+    """
+    def setUp(self):
+        self.router = Router()
+        self.calls = []
+        self.router.add('Баланс', self.handler('balance'),
+                        menus=('main', 'friends'))
+        self.router.add('Назад', self.handler('back'), menus=('friends',))
+        self.router.add_fallback('project', lambda text: text == 'Проект',
+                                 self.handler('project'))
+
+    def handler(self, name):
+        return lambda bot, update: self.calls.append(name)
+
+    def test_dispatch(self):
+        for text in ('Баланс', 'Проект', 'Неизвестно'):
+            self.router.dispatch(None, make_message_update(text))
+        self.assertEqual(self.calls, ['balance', 'project'])
+        self.assertEqual(self.router.hit_counts(),
+                         {'Баланс': 1, 'project': 1})
+        self.assertEqual(self.router.resolve('Неизвестно'), (None, None))
+
+    def test_keyboard(self):
+        keyboard = self.router.keyboard('friends')
+        self.assertEqual([[button.text for button in row]
+                          for row in keyboard.keyboard],
+                         [['Баланс'], ['Назад']])
+
+    def test_wrap(self):
+        self.router.wrap(lambda name, handler: (
+            lambda bot, update: self.calls.append('wrapped:' + name)
+        ))
+        self.router.dispatch(None, make_message_update('Проект'))
+        self.assertEqual(self.calls, ['wrapped:project'])
+
+    def test_concurrent_hits(self):
+        update = make_message_update('Баланс')
+
+        def dispatch():
+            for _ in range(1000):
+                self.router.dispatch(None, update)
+
+        threads = [Thread(target=dispatch) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.router.hit_counts(), {'Баланс': 8000})
+
+
+class ThrottleTests(TestCase):
+    """
+    Класс тестов ограничения частоты запросов
+    """
+    def test_bucket(self):
+        limiter = TokenBucketLimiter(rate=1, burst=2, duplicate_window=0)
+        self.assertTrue(limiter.allow(1, 'a', now=0))
+        self.assertTrue(limiter.allow(1, 'b', now=0))
+        self.assertFalse(limiter.allow(1, 'c', now=0))
+        self.assertTrue(limiter.allow(2, 'a', now=0))
+        self.assertTrue(limiter.allow(1, 'c', now=1))
+        self.assertFalse(limiter.allow(1, 'd', cost=2, now=1.5))
+
+    def test_duplicate(self):
+        limiter = TokenBucketLimiter(rate=1, burst=10, duplicate_window=2)
+        self.assertTrue(limiter.allow(1, 'a', now=0))
+        self.assertFalse(limiter.allow(1, 'a', now=1))
+        self.assertTrue(limiter.allow(1, 'b', now=1))
+        self.assertTrue(limiter.allow(1, 'a', now=3))
+
+    def test_max_chats(self):
+        limiter = TokenBucketLimiter(rate=0, burst=1, max_chats=2)
+        for chat_id in (1, 2, 3):
+            self.assertTrue(limiter.allow(chat_id, None, now=0))
+        # Первый чат вытеснен, его ведро снова полное
+        self.assertTrue(limiter.allow(1, None, now=0))
+        self.assertFalse(limiter.allow(3, None, now=0))
+
+    def test_message(self):
+        throttle = Throttle({'RATE': 0, 'BURST': 1, 'DUPLICATE_WINDOW': 0})
+        update = make_message_update('Баланс')
+        throttle(None, update)
+        with self.assertRaises(DispatcherHandlerStop):
+            throttle(None, update)
+
+    def test_callback_query(self):
+        throttle = Throttle({'RATE': 0, 'BURST': 1, 'DUPLICATE_WINDOW': 0,
+                             'COSTS': {'referrals': 2}})
+        update = mock.Mock()
+        update.effective_chat.id = 1
+        update.callback_query.data = 'referrals:1:10'
+        with self.assertRaises(DispatcherHandlerStop):
+            throttle(None, update)
+        update.callback_query.answer.assert_called_once_with(THROTTLED_TEXT)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ReferralStatsTests(TestCase):
+    """
+    Класс тестов пересчета статистики приглашений
+    """
+    def setUp(self):
+        # 1 <- 2 <- 3 <- 4 и 1 <- 5
+        create_users(MPTTTree(), [None, 0, 1, 2, 0])
+        # Начисления второго уровня изменены, как после recompute_balances
+        Reward.objects.filter(level=2).update(amount=40)
+        compact_ledger(delay=timedelta(0))
+
+    def repair(self):
+        out = StringIO()
+        call_command('repair_referral_stats', stdout=out)
+        return out.getvalue()
+
+    def test_unchanged(self):
+        self.assertEqual(self.repair(), 'Исправлено пользователей: 0\n')
+        user = ReferralUser.objects.get(chat_id=1)
+        self.assertEqual(user.earned_level_2, Decimal('40'))
+
+    def test_repair(self):
+        ReferralUser.objects.update(invited_level_1=0, earned_level_2=0)
+        self.assertEqual(self.repair(), 'Исправлено пользователей: 3\n')
+        user = ReferralUser.objects.get(chat_id=1)
+        self.assertEqual((user.invited_level_1, user.invited_level_2,
+                          user.invited_level_3), (2, 1, 1))
+        self.assertEqual((user.earned_level_1, user.earned_level_2,
+                          user.earned_level_3),
+                         (Decimal('200'), Decimal('40'), Decimal('100')))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ClosureTreeTests(TestCase):
+    """
+    Класс тестов дерева приглашений на таблице связей
+    """
+    def setUp(self):
+        # Цепочка 1 <- 2 <- 3 <- 4 <- 5 и 1 <- 6
+        self.tree = ClosureTree()
+        self.users = create_users(self.tree, [None, 0, 1, 2, 3, 0])
+
+    def test_links(self):
+        links = ReferralLink.objects.filter(
+            descendant=self.users[4]
+        ).order_by('depth').values_list('ancestor__chat_id', 'depth')
+        # Связи хранятся только до третьего уровня
+        self.assertEqual(list(links), [(4, 1), (3, 2), (2, 3)])
+        self.assertFalse(ReferralLink.objects.filter(
+            descendant=self.users[0]
+        ).exists())
+        self.assertEqual(ReferralLink.objects.count(), 1 + 2 + 3 + 3 + 1)
+
+    def test_counts(self):
+        self.assertEqual(self.tree.referral_counts(self.users[0]),
+                         {1: 2, 2: 1, 3: 1})
+        rows, next_page, counts = self.tree.first_referrals_page(
+            self.users[0], limit=2
+        )
+        self.assertEqual([(depth, name) for depth, key, name in rows],
+                         [(1, 'user2'), (1, 'user6')])
+        self.assertIsNotNone(next_page)
+        self.assertEqual(counts, {1: 2, 2: 1, 3: 1})
+
+    def test_refresh(self):
+        self.tree.refresh()
+        root = ReferralUser.objects.get(chat_id=1)
+        self.assertEqual(root.get_descendant_count(), 5)
+        self.assertEqual(ReferralUser.objects.get(chat_id=5).level, 4)
+
+    def test_delete(self):
+        self.users[2].delete()
+        links = ReferralLink.objects.order_by(
+            'descendant__chat_id', 'depth'
+        ).values_list('descendant__chat_id', 'ancestor__chat_id', 'depth')
+        # Пользователь 4 стал корнем, у пользователя 5 осталась только
+        # связь с ним
+        self.assertEqual(list(links), [(2, 1, 1), (5, 4, 1), (6, 1, 1)])
+        self.assertEqual(self.tree.referral_counts(self.users[0]), {1: 2})
+
+
+@override_settings(CACHES=TEST_CACHES)
+class LedgerTests(TestCase):
+    """
+    Класс тестов баланса по снимку и журналу начислений
+    """
+    def setUp(self):
+        # 1 <- 2 <- 3
+        self.users = create_users(MPTTTree(), [None, 0, 1])
+
+    def test_balance_from_tail(self):
+        root = ReferralUser.objects.get(chat_id=1)
+        self.assertEqual(root.balance, Decimal('0'))
+        self.assertEqual(get_balance(root), Decimal('200'))
+
+    def test_balance_from_snapshot_and_tail(self):
+        self.assertEqual(compact_ledger(delay=timedelta(0)), 3)
+        root = ReferralUser.objects.get(chat_id=1)
+        self.assertEqual(root.balance, Decimal('200'))
+        self.assertEqual(get_balance(root), Decimal('200'))
+        # Начисление после снимка учитывается по журналу
+        user, ancestors = MPTTTree().create_user(chat_id=4, name='user4',
+                                                 parent=self.users[2])
+        record_rewards(user, ancestors)
+        root.refresh_from_db()
+        self.assertEqual(root.balance, Decimal('200'))
+        self.assertEqual(get_balance(root), Decimal('300'))
+        balance, levels = get_statistics(root)
+        self.assertEqual(balance, Decimal('300'))
+        self.assertEqual(levels[1], (1, Decimal('100')))
+        self.assertEqual(levels[3], (1, Decimal('100')))
+
+    def test_compact_twice(self):
+        compact_ledger(delay=timedelta(0))
+        self.assertEqual(compact_ledger(delay=timedelta(0)), 0)
+        root = ReferralUser.objects.get(chat_id=1)
+        self.assertEqual(get_balance(root), Decimal('200'))
+        self.assertEqual((root.invited_level_1, root.invited_level_2),
+                         (1, 1))
+
+
+class FakeDispatcher(object):
+    """
+    Класс диспетчера, запоминающего номера обработанных обновлений
+    """
+    bot = None
+
+    def __init__(self):
+        self.processed = []
+
+    def process_update(self, update):
+        self.processed.append((update.effective_chat.id, update.update_id))
+
+
+def make_update_data(update_id, chat_id):
+    """
+    Функция возвращает обновление с текстовым сообщением в виде,
+    присланном Telegram
+    """
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'User'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': 'Баланс',
+        'chat': dict(user, type='private'), 'from': user,
+    }}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class UpdateQueueTests(TestCase):
+    """
+    Класс тестов очереди входящих обновлений
+    """
+    def setUp(self):
+        # Обновления чатов 1 и 2 вперемешку
+        for update_id, chat_id in enumerate([1, 2, 1, 1, 2], 1):
+            enqueue_update('1', make_update_data(update_id, chat_id))
+
+    def consumer(self, **options):
+        dispatcher = FakeDispatcher()
+        consumer = UpdateConsumer(dispatchers={'1': dispatcher}, **options)
+        return consumer, dispatcher
+
+    def test_duplicate(self):
+        self.assertFalse(enqueue_update('1', make_update_data(1, 1)))
+        self.assertEqual(get_queue_depth(), 5)
+
+    def test_shards(self):
+        first, first_dispatcher = self.consumer(shard=0, shards=2)
+        second, second_dispatcher = self.consumer(shard=1, shards=2)
+        first.drain()
+        second.drain()
+        self.assertEqual(first_dispatcher.processed, [(2, 2), (2, 5)])
+        self.assertEqual(second_dispatcher.processed,
+                         [(1, 1), (1, 3), (1, 4)])
+        self.assertEqual(get_queue_depth(), 0)
+
+    def test_busy_chat(self):
+        first, first_dispatcher = self.consumer(batch_size=1)
+        second, second_dispatcher = self.consumer()
+        claimed = first.claim()
+        # Пока первое обновление чата 1 в обработке, остальные
+        # обновления чата ждут
+        second.drain()
+        self.assertEqual(second_dispatcher.processed, [(2, 2), (2, 5)])
+        first.process(claimed)
+        second.drain()
+        self.assertEqual(first_dispatcher.processed, [(1, 1)])
+        self.assertEqual(second_dispatcher.processed[2:], [(1, 3), (1, 4)])
+
+    def test_claim_timeout(self):
+        first, _ = self.consumer(batch_size=1)
+        second, second_dispatcher = self.consumer(claim_timeout=60)
+        first.claim()
+        second.drain()
+        self.assertEqual(second_dispatcher.processed, [(2, 2), (2, 5)])
+        # Обновление, взятое упавшим обработчиком, возвращается в очередь
+        # и обрабатывается раньше следующих обновлений чата
+        QueuedUpdate.objects.update(
+            claimed=timezone.now() - timedelta(minutes=2)
+        )
+        second.drain()
+        self.assertEqual(second_dispatcher.processed[2:],
+                         [(1, 1), (1, 3), (1, 4)])
+        self.assertEqual(get_queue_depth(), 0)
+
+
+@override_settings(CACHES=TEST_CACHES, BOT_UPDATE_QUEUE={'ENABLED': True})
+class WebhookTests(TestCase):
+    """
+    Класс тестов приема обновлений от Telegram
+    """
+    def setUp(self):
+        patcher = mock.patch('bot.views.DjangoTelegramBot.getBot')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = reverse('bot-webhook', kwargs={'bot_token': '1:token'})
+
+    def post(self, data):
+        return self.client.post(self.url, data,
+                                content_type='application/json')
+
+    def test_enqueue(self):
+        data = json.dumps(make_update_data(1, 1))
+        self.assertEqual(self.post(data).status_code, 200)
+        self.assertEqual(self.post(data).status_code, 200)
+        update = QueuedUpdate.objects.get()
+        self.assertEqual((update.bot_id, update.update_id, update.chat_id),
+                         ('1', 1, 1))
+
+    def test_invalid(self):
+        for data in ('{', '[]', '{"message": {}}'):
+            self.assertEqual(self.post(data).status_code, 200)
+        self.assertEqual(get_queue_depth(), 0)
+
+    def test_queue_disabled(self):
+        with self.settings(BOT_UPDATE_QUEUE={'ENABLED': False}), \
+                mock.patch('bot.views.telegrambot_views.webhook',
+                           return_value=JsonResponse({})) as webhook:
+            self.post(json.dumps(make_update_data(1, 1)))
+        self.assertEqual(webhook.call_count, 1)
+        self.assertEqual(get_queue_depth(), 0)
+
+
+class BotRequestTests(TestCase):
+    """
+    Класс тестов создания HTTP-клиентов ботов по настройке
+    """
+    request_kwargs = {
+        'proxy_url': 'socks5://proxy:1080',
+        'urllib3_proxy_kwargs': {'username': 'user', 'password': 'secret'},
+        'read_timeout': 10,
+    }
+
+    def setUp(self):
+        self.bots = [mock.Mock(token='1:first', _request=None),
+                     mock.Mock(token='2:second', _request=None)]
+        self.bots[1]._request = TimedRequest(None)
+        patcher = mock.patch.multiple(
+            'bot.updates.DjangoTelegramBot', bots=self.bots,
+            dispatchers=[mock.Mock(bot=self.bots[0])]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reset(self):
+        telegrambot = {'BOTS': [{'TOKEN': '1:first',
+                                 'REQUEST_KWARGS': self.request_kwargs}]}
+        with self.settings(DJANGO_TELEGRAMBOT=telegrambot), \
+                mock.patch('bot.updates.Request') as request:
+            reset_bot_requests()
+        self.assertEqual(request.call_args_list,
+                         [mock.call(**self.request_kwargs), mock.call()])
+        self.assertIs(self.bots[0]._request, request.return_value)
+        self.assertIsInstance(self.bots[1]._request, TimedRequest)
+        self.assertIs(self.bots[1]._request.request, request.return_value)
+
+    def test_configure(self):
+        telegrambot = {'BOTS': [{'TOKEN': '2:second',
+                                 'REQUEST_KWARGS': self.request_kwargs}]}
+        with self.settings(DJANGO_TELEGRAMBOT=telegrambot), \
+                mock.patch('bot.updates.Request') as request:
+            configure_bot_requests()
+        request.assert_called_once_with(**self.request_kwargs)
+        self.assertIsNone(self.bots[0]._request)
+        self.assertIs(self.bots[1]._request.request, request.return_value)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class BroadcastBot(object):
+    """
+    Класс бота для рассылки: чаты blocked заблокировали бота,
+    на чате interrupt отправка прерывается
+    """
+    def __init__(self, blocked=(), interrupt=None):
+        self.blocked = blocked
+        self.interrupt = interrupt
+        self.sent = []
+        self._lock = Lock()
+
+    def sendMessage(self, chat_id, text, parse_mode=None):
+        if chat_id == self.interrupt:
+            raise Interrupted()
+        if chat_id in self.blocked:
+            raise Unauthorized('Forbidden: bot was blocked by the user')
+        with self._lock:
+            self.sent.append(chat_id)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BroadcastTests(TestCase):
+    """
+    Класс тестов рассылки
+    """
+    def setUp(self):
+        create_users(MPTTTree(), [None] * 5)
+        self.broadcast = Broadcast.objects.create(text='Новости')
+
+    def test_scheduler(self):
+        scheduler = RateScheduler(rate=200)
+        started = time.monotonic()
+        for _ in range(21):
+            scheduler.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        scheduler.pause(0.1)
+        started = time.monotonic()
+        scheduler.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+    def test_blocked(self):
+        bot = BroadcastBot(blocked=(2, 4))
+        with mock.patch('bot.broadcast.user_cache') as user_cache:
+            send_broadcast(bot, self.broadcast, rate=1000, workers=2,
+                           batch_size=10)
+        self.assertEqual(sorted(bot.sent), [1, 3, 5])
+        self.assertEqual(sorted(user_cache.evict.call_args[0][0]), [2, 4])
+        user_cache.invalidate.assert_not_called()
+        self.assertEqual(sorted(ReferralUser.objects.filter(
+            is_blocked=True
+        ).values_list('chat_id', flat=True)), [2, 4])
+        self.broadcast.refresh_from_db()
+        self.assertEqual((self.broadcast.status, self.broadcast.sent,
+                          self.broadcast.blocked), (Broadcast.DONE, 3, 2))
+
+    def test_resume(self):
+        bot = BroadcastBot(interrupt=3)
+        with self.assertRaises(Interrupted):
+            send_broadcast(bot, self.broadcast, rate=1000, workers=1,
+                           batch_size=2)
+        self.broadcast.refresh_from_db()
+        self.assertEqual((self.broadcast.status, self.broadcast.sent),
+                         (Broadcast.PENDING, 2))
+        # Продолжение с сохраненной позиции без повторной отправки
+        bot = BroadcastBot()
+        send_broadcast(bot, self.broadcast, rate=1000, workers=1,
+                       batch_size=2)
+        self.assertEqual(bot.sent, [3, 4, 5])
+        self.broadcast.refresh_from_db()
+        self.assertEqual((self.broadcast.status, self.broadcast.sent),
+                         (Broadcast.DONE, 5))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ReferralUserAdminTests(TestCase):
+    """
+    Класс тестов списка пользователей в админке
+    """
+    def setUp(self):
+        # 1 <- 2 <- 3, 1 <- 4 и 5
+        self.users = create_users(MPTTTree(), [None, 0, 1, 0, None])
+        compact_ledger(delay=timedelta(0))
+        # Начисление после снимка учитывается по журналу
+        user, ancestors = MPTTTree().create_user(chat_id=6, name='user6',
+                                                 parent=self.users[0])
+        record_rewards(user, ancestors)
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+
+    def get_rows(self, **params):
+        response = self.client.get('/admin/bot/referraluser/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl'].result_list
+
+    def test_annotations(self):
+        rows = {user.chat_id: user for user in self.get_rows()}
+        self.assertEqual((rows[1].children_count, rows[1].downline_count,
+                          rows[1].balance_total), (3, 4, Decimal('400')))
+        self.assertEqual((rows[2].children_count, rows[2].downline_count,
+                          rows[2].balance_total), (1, 1, Decimal('100')))
+        self.assertEqual(rows[5].balance_total, Decimal('0'))
+
+    def test_queries(self):
+        with CaptureQueriesContext(connection) as first:
+            self.get_rows()
+        for chat_id in range(10, 15):
+            MPTTTree().create_user(chat_id=chat_id, name='user')
+        with CaptureQueriesContext(connection) as second:
+            self.get_rows()
+        self.assertEqual(len(first), len(second))
+
+    def test_ordering_ignored(self):
+        ids = [user.id for user in self.get_rows()]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual([user.id for user in self.get_rows(o='-1')], ids)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ReferralTokenTests(TestCase):
+    """
+    Класс тестов подписанных реферальных кодов
+    """
+    def test_parse(self):
+        self.assertEqual(parse_referral_token(make_referral_token(12345)),
+                         12345)
+
+    def test_forged_token(self):
+        token = make_referral_token(12345)
+        value, signature = token.split('-')
+        forged_signature = ('0' if signature[0] != '0' else '1') + \
+            signature[1:]
+        self.assertIsNone(parse_referral_token(
+            '{}-{}'.format(value, forged_signature)
+        ))
+        # Подпись другого id не подходит
+        other = make_referral_token(12346).split('-')[0]
+        self.assertIsNone(parse_referral_token(
+            '{}-{}'.format(other, signature)
+        ))
+        for token in ('', 'abc', token.upper(), token + '0', '-' + signature):
+            self.assertIsNone(parse_referral_token(token))
+
+    def test_referrer(self):
+        user = ReferralUser.objects.create(chat_id=1, name='user1')
+        self.assertEqual(get_referrer(make_referral_token(user.id)), user)
+        forged = make_referral_token(user.id)[:-1] + 'x'
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_referrer(forged))
+
+    def test_legacy_code(self):
+        code = 'a' * 27
+        user = ReferralUser.objects.create(chat_id=1, name='user1',
+                                           refer_code=code)
+        with self.settings(BOT_LEGACY_REFER_CODES=True):
+            self.assertEqual(get_referrer(code), user)
+        with self.settings(BOT_LEGACY_REFER_CODES=False):
+            self.assertIsNone(get_referrer(code))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ExportReferralsTests(TestCase):
+    """
+    Класс тестов команды export_referrals
+    """
+    def setUp(self):
+        users = create_users(MPTTTree(), [None, 0, 1, 2, 0])
+        # Пользователь, добавленный без пересчета вложенных множеств
+        user, ancestors = ClosureTree().create_user(chat_id=6, name='user6',
+                                                    parent=users[0])
+        record_rewards(user, ancestors)
+
+    def export(self, *args):
+        stream = StringIO()
+        call_command('export_referrals', *args, stdout=stream)
+        return stream.getvalue()
+
+    def test_csv(self):
+        rows = list(csv.DictReader(StringIO(self.export('--chunk-size',
+                                                        '2'))))
+        self.assertEqual(len(rows), ReferralUser.objects.count())
+        self.assertEqual(len({row['id'] for row in rows}), len(rows))
+        rows = {row['chat_id']: row for row in rows}
+        self.assertEqual(
+            [rows['1']['level_{}'.format(level)] for level in (1, 2, 3)],
+            ['3', '1', '1']
+        )
+        self.assertEqual(rows['1']['downline'], '5')
+        self.assertEqual(rows['1']['balance'], '500.00')
+        self.assertEqual(rows['6']['parent_chat_id'], '1')
+        self.assertEqual(rows['6']['depth'], '1')
+
+    def test_jsonl(self):
+        lines = self.export('--format', 'jsonl').splitlines()
+        self.assertEqual(len(lines), ReferralUser.objects.count())
+        self.assertEqual(
+            sorted(json.loads(line)['chat_id'] for line in lines),
+            sorted(ReferralUser.objects.values_list('chat_id', flat=True))
+        )
+
+
+@skipIf(numpy is None, 'Для пересчета нужен пакет numpy')
+@override_settings(CACHES=TEST_CACHES)
+class RecomputeBalancesTests(TestCase):
+    """
+    Класс тестов команды recompute_balances
+    """
+    def setUp(self):
+        # 1 <- 2 <- 3 <- 4 и 1 <- 5
+        create_users(MPTTTree(), [None, 0, 1, 2, 0])
+
+    def recompute(self, *args):
+        call_command('recompute_balances', *args, stdout=StringIO())
+        return {user.chat_id: user for user in ReferralUser.objects.all()}
+
+    def test_recompute(self):
+        compact_ledger(delay=timedelta(0))
+        expected = {user.chat_id: get_balance(user)
+                    for user in ReferralUser.objects.all()}
+        ReferralUser.objects.filter(chat_id=2).update(
+            balance=Decimal('7.5'), invited_level_2=99
+        )
+        users = self.recompute()
+        for chat_id, user in users.items():
+            self.assertEqual(get_balance(user), expected[chat_id])
+        self.assertEqual(users[2].invited_level_2, 1)
+        self.assertEqual((users[1].invited_level_1, users[1].invited_level_2,
+                          users[1].invited_level_3), (2, 1, 1))
+
+    def test_dry_run(self):
+        ReferralUser.objects.filter(chat_id=2).update(balance=Decimal('7.5'))
+        stream = StringIO()
+        call_command('recompute_balances', '--dry-run', stdout=stream)
+        self.assertIn('2: 207.50 -> 200.00', stream.getvalue())
+        self.assertEqual(ReferralUser.objects.get(chat_id=2).balance,
+                         Decimal('7.5'))
+
+    def test_short_rewards(self):
+        users = self.recompute('--rewards', '50', '20')
+        self.assertEqual(users[1].balance, Decimal('120'))
+        self.assertEqual(users[2].balance, Decimal('70'))
+        self.assertEqual(users[3].balance, Decimal('50'))
+        self.assertEqual((users[1].invited_level_1, users[1].invited_level_2,
+                          users[1].invited_level_3), (2, 1, 1))
+        self.assertEqual(users[1].earned_level_3, Decimal('0'))
+
+    def test_single_reward(self):
+        users = self.recompute('--rewards', '30')
+        self.assertEqual(users[1].balance, Decimal('60'))
+        self.assertEqual(users[2].balance, Decimal('30'))
+        self.assertEqual((users[1].earned_level_1, users[1].earned_level_2,
+                          users[1].earned_level_3),
+                         (Decimal('60'), Decimal('0'), Decimal('0')))
+        self.assertEqual(users[1].invited_level_3, 1)
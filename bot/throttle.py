@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from telegram.error import TelegramError
+from telegram.ext import DispatcherHandlerStop
+
+from .metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+THROTTLED_TEXT = 'Слишком много запросов, попробуйте позже'
+
+
+class TokenBucketLimiter(object):
+    """
+    Класс ограничения частоты запросов чата по алгоритму token bucket.
+    Ведро чата пополняется на rate токенов в секунду до burst токенов,
+    каждый запрос забирает из ведра свою стоимость.
+    Повтор того же запроса key в течение duplicate_window секунд
+    отбрасывается без списания токенов.
+    Для чата хранится только кортеж из четырех значений, число чатов
+    ограничено max_chats: вытесняются давно неактивные чаты, ведра
+    которых к этому времени все равно полны
+    """
+    def __init__(self, rate=1.0, burst=10, duplicate_window=2,
+                 max_chats=100000):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, chat_id, key, cost=1, now=None):
+        """
+        Проверка, можно ли обработать запрос key стоимостью cost
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            state = self._chats.pop(chat_id, None)
+            if state is None:
+                tokens, last_key, last_time = self.burst, None, None
+            else:
+                tokens, updated, last_key, last_time = state
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            duplicate = (key is not None and key == last_key and
+                         now - last_time < self.duplicate_window)
+            allowed = not duplicate and tokens >= cost
+            if allowed:
+                tokens -= cost
+                last_key, last_time = key, now
+            self._chats[chat_id] = (tokens, now, last_key, last_time)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        return allowed
+
+
+def get_request_keys(update):
+    """
+    Функция возвращает текст запроса для поиска повторов и ключ для
+    расчета стоимости: команду, текст кнопки или префикс данных
+    inline-кнопки
+    """
+    if update.callback_query:
+        text = update.callback_query.data or ''
+        return text, text.split(':')[0]
+    message = update.effective_message
+    if message is None or not message.text:
+        return None, None
+    if message.text.startswith('/'):
+        return message.text, message.text.split()[0]
+    return message.text, message.text
+
+
+class Throttle(object):
+    """
+    Класс обработчика обновлений, отбрасывающего запросы чатов,
+    превысивших ограничение частоты. Регистрируется в группе
+    диспетчера, которая проверяется раньше остальных обработчиков
+    """
+    def __init__(self, options):
+        self.costs = options.get('COSTS', {})
+        self.limiter = TokenBucketLimiter(
+            rate=options.get('RATE', 1.0),
+            burst=options.get('BURST', 10),
+            duplicate_window=options.get('DUPLICATE_WINDOW', 2),
+            max_chats=options.get('MAX_CHATS', 100000),
+        )
+
+    def __call__(self, bot, update):
+        chat = update.effective_chat
+        if chat is None:
+            return
+        text, key = get_request_keys(update)
+        cost = self.costs.get(key, 1)
+        if not self.limiter.allow(chat.id, text, cost):
+            logger.debug('Запрос чата %s отброшен: %s', chat.id, key,
+                         extra={'chat_id': chat.id})
+            metrics.observe('throttled:{}'.format(key), cost)
+            if update.callback_query:
+                # Без ответа клиент показывает загрузку на кнопке,
+                # пока не истечет время ожидания
+                try:
+                    update.callback_query.answer(THROTTLED_TEXT)
+                except TelegramError as e:
+                    logger.warning('Не удалось ответить на запрос чата '
+                                   '%s: %s', chat.id, e,
+                                   extra={'chat_id': chat.id})
+            raise DispatcherHandlerStop()
+
+
+def get_throttle():
+    """
+    Функция создания ограничителя по настройке BOT_RATE_LIMIT
+    """
+    return Throttle(getattr(settings, 'BOT_RATE_LIMIT', {}))
@@ -0,0 +1,315 @@
+"""
+Хранение дерева приглашений.
+Связи пользователя с пригласившими его до REFERRAL_LEVELS уровня
+хранятся в таблице ReferralLink и добавляются при регистрации
+в любом режиме, поэтому режим можно переключить без миграции данных.
+Режим 'mptt' при регистрации пересчитывает вложенные множества
+(lft/rght) всего дерева, режим 'closure' добавляет только
+пользователя и его связи, а вложенные множества пересобираются
+командой rebuild_tree. Код, читающий поля вложенных множеств,
+в режиме 'closure' должен сначала вызвать refresh()
+"""
+from functools import partial
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, IntegerField, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .cache import user_cache
+from .database import write_queue
+from .models import ReferralLink, ReferralUser
+from .referrals import REFERRAL_LEVELS
+
+
+def add_links(user):
+    """
+    Функция добавляет связи нового пользователя с пригласившими его
+    и возвращает список (id пригласившего, уровень)
+    """
+    if user.parent_id is None:
+        return []
+    ancestors = [(user.parent_id, 1)]
+    ancestors.extend(
+        (ancestor_id, depth + 1) for ancestor_id, depth
+        in ReferralLink.objects.filter(
+            descendant_id=user.parent_id, depth__lt=REFERRAL_LEVELS
+        ).values_list('ancestor_id', 'depth')
+    )
+    ReferralLink.objects.bulk_create([
+        ReferralLink(ancestor_id=ancestor_id, descendant=user, depth=depth)
+        for ancestor_id, depth in ancestors
+    ])
+    return ancestors
+
+
+def rebuild_nested_sets(batch_size=10000):
+    """
+    Функция пересобирает поля вложенных множеств (tree_id, lft, rght,
+    level) по пригласившим пользователям. Пользователи читаются пачками
+    по id, деревья обходятся без рекурсии, приглашенные и деревья идут
+    в порядке регистрации, как в режиме 'mptt'. Записываются только
+    изменившиеся строки пачками по batch_size, каждая пачка в своей
+    транзакции. Возвращает количество измененных пользователей
+    """
+    users = ReferralUser.objects.order_by('id').values_list(
+        'id', 'parent_id', 'tree_id', 'lft', 'rght', 'level'
+    )
+    current = {}
+    children = {}
+    roots = []
+    last = 0
+    while True:
+        rows = list(users.filter(id__gt=last)[:batch_size])
+        if not rows:
+            break
+        for user_id, parent_id, *values in rows:
+            current[user_id] = tuple(values)
+            if parent_id is None:
+                roots.append(user_id)
+            else:
+                children.setdefault(parent_id, []).append(user_id)
+        last = rows[-1][0]
+    changed = []
+    rebuilt = 0
+    for tree_id, root in enumerate(roots, 1):
+        counter = 1
+        # Путь от корня: (id, level, lft, еще не обойденные приглашенные)
+        path = [(root, 0, counter, iter(children.get(root, ())))]
+        while path:
+            user_id, level, lft, pending = path[-1]
+            child = next(pending, None)
+            counter += 1
+            if child is not None:
+                path.append((child, level + 1, counter,
+                             iter(children.get(child, ()))))
+                continue
+            path.pop()
+            values = (tree_id, lft, counter, level)
+            if current[user_id] != values:
+                changed.append(values + (user_id,))
+                if len(changed) >= batch_size:
+                    rebuilt += save_nested_sets(changed)
+                    changed = []
+    if changed:
+        rebuilt += save_nested_sets(changed)
+    return rebuilt
+
+
+def save_nested_sets(rows):
+    """
+    Функция записывает строки (tree_id, lft, rght, level, id) одной
+    транзакцией и возвращает их количество
+    """
+    quote = connection.ops.quote_name
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        quote(ReferralUser._meta.db_table),
+        ', '.join('{} = %s'.format(quote(column))
+                  for column in ('tree_id', 'lft', 'rght', 'level')),
+        quote('id')
+    )
+    with write_queue.write(), connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+    return len(rows)
+
+
+class MPTTTree(object):
+    """
+    Класс дерева приглашений на вложенных множествах
+    """
+    name = 'mptt'
+
+    def create_user(self, **fields):
+        """
+        Регистрация пользователя, возвращает пользователя и список
+        (id пригласившего, уровень)
+        """
+        with transaction.atomic():
+            user = ReferralUser.objects.create(**fields)
+            ancestors = add_links(user)
+            # Регистрация сдвигает границы вложенных множеств других
+            # пользователей дерева. Границы для выборок читаются
+            # из базы данных, поэтому из кэша удаляются только
+            # пригласившие, у которых появился приглашенный
+            if ancestors:
+                chat_ids = list(ReferralUser.objects.filter(
+                    id__in=[ancestor_id for ancestor_id, _ in ancestors]
+                ).values_list('chat_id', flat=True))
+                transaction.on_commit(partial(user_cache.evict, chat_ids))
+            return user, ancestors
+
+    def descendants(self, user):
+        """
+        Приглашенные пользователя до REFERRAL_LEVELS уровня
+        """
+        # Границы узла берутся из базы данных: у пользователя из кэша
+        # они могли сдвинуться после чужих регистраций
+        bounds = ReferralUser.objects.filter(pk=user.pk)
+        return ReferralUser.objects.filter(
+            tree_id=user.tree_id,
+            lft__gt=Subquery(bounds.values('lft')),
+            rght__lt=Subquery(bounds.values('rght')),
+            level__lte=user.level + REFERRAL_LEVELS
+        )
+
+    def referrals_page(self, user, after=None, limit=30):
+        """
+        Страница приглашенных до REFERRAL_LEVELS уровня: список
+        (уровень, ключ, имя) и позиция следующей страницы или None.
+        Страницы упорядочены по (level, lft), следующая страница
+        выбирается по ключу последней записи, а не смещением
+        """
+        referrals = self.descendants(user)
+        if after is not None:
+            depth, lft = after
+            referrals = referrals.filter(
+                Q(level=user.level + depth, lft__gt=lft) |
+                Q(level__gt=user.level + depth)
+            )
+        rows = [
+            (level - user.level, lft, name) for level, lft, name
+            in referrals.order_by('level', 'lft').values_list(
+                'level', 'lft', 'name'
+            )[:limit + 1]
+        ]
+        return paginate(rows, limit)
+
+    def first_referrals_page(self, user, limit=30):
+        """
+        Первая страница приглашенных, позиция следующей страницы
+        и количество приглашенных по уровням одним запросом
+        """
+        counts = {
+            'count_{}'.format(depth): count_subquery(
+                self.descendants(user).filter(level=user.level + depth),
+                'tree_id'
+            ) for depth in range(1, REFERRAL_LEVELS + 1)
+        }
+        rows = [
+            (level - user.level, lft, name) + tuple(level_counts)
+            for level, lft, name, *level_counts
+            in self.descendants(user).annotate(**counts).order_by(
+                'level', 'lft'
+            ).values_list('level', 'lft', 'name', *counts)[:limit + 1]
+        ]
+        return split_counts(rows, limit)
+
+    def referral_counts(self, user):
+        """
+        Количество приглашенных пользователя по уровням
+        """
+        counts = self.descendants(user).values_list('level').annotate(
+            count=Count('id')
+        ).order_by()
+        return {level - user.level: count for level, count in counts}
+
+    def refresh(self):
+        """
+        Подготовка вложенных множеств для выгрузок и пересчетов,
+        в этом режиме они всегда актуальны
+        """
+
+
+class ClosureTree(MPTTTree):
+    """
+    Класс дерева приглашений на таблице связей. Регистрация не изменяет
+    других пользователей, из полей вложенных множеств актуален только level
+    """
+    name = 'closure'
+
+    def create_user(self, **fields):
+        with transaction.atomic(), \
+                ReferralUser.objects.disable_mptt_updates():
+            user = ReferralUser.objects.create(**fields)
+            return user, add_links(user)
+
+    def referrals_page(self, user, after=None, limit=30):
+        links = ReferralLink.objects.filter(ancestor=user)
+        if after is not None:
+            depth, descendant_id = after
+            links = links.filter(
+                Q(depth=depth, descendant_id__gt=descendant_id) |
+                Q(depth__gt=depth)
+            )
+        rows = list(links.order_by('depth', 'descendant_id').values_list(
+            'depth', 'descendant_id', 'descendant__name'
+        )[:limit + 1])
+        return paginate(rows, limit)
+
+    def first_referrals_page(self, user, limit=30):
+        counts = {
+            'count_{}'.format(depth): count_subquery(
+                ReferralLink.objects.filter(ancestor=user, depth=depth),
+                'ancestor'
+            ) for depth in range(1, REFERRAL_LEVELS + 1)
+        }
+        rows = list(ReferralLink.objects.filter(ancestor=user).annotate(
+            **counts
+        ).order_by('depth', 'descendant_id').values_list(
+            'depth', 'descendant_id', 'descendant__name', *counts
+        )[:limit + 1])
+        return split_counts(rows, limit)
+
+    def referral_counts(self, user):
+        counts = ReferralLink.objects.filter(ancestor=user).values_list(
+            'depth'
+        ).annotate(count=Count('id')).order_by()
+        return dict(counts)
+
+    def refresh(self):
+        if rebuild_nested_sets():
+            user_cache.invalidate()
+
+
+def paginate(rows, limit):
+    """
+    Функция отделяет лишнюю запись страницы и возвращает строки
+    и ключ следующей страницы
+    """
+    next_page = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_page = rows[-1][:2]
+    return rows, next_page
+
+
+def count_subquery(queryset, field):
+    """
+    Функция возвращает подзапрос количества записей queryset.
+    Подзапрос не зависит от строк основного запроса, поэтому база
+    данных выполняет его один раз
+    """
+    return Coalesce(Subquery(
+        queryset.order_by().values(field).annotate(
+            count=Count('id')
+        ).values('count'),
+        output_field=IntegerField()
+    ), 0)
+
+
+def split_counts(rows, limit):
+    """
+    Функция отделяет от строк страницы количество приглашенных
+    по уровням и возвращает строки, ключ следующей страницы
+    и {уровень: количество}
+    """
+    counts = {}
+    if rows:
+        counts = dict(enumerate(rows[0][3:], 1))
+    rows, next_page = paginate([row[:3] for row in rows], limit)
+    return rows, next_page, counts
+
+
+TREE_BACKENDS = {
+    MPTTTree.name: MPTTTree,
+    ClosureTree.name: ClosureTree,
+}
+
+
+def get_tree(name=None):
+    """
+    Функция создания дерева приглашений по настройке BOT_TREE_BACKEND
+    """
+    if name is None:
+        name = getattr(settings, 'BOT_TREE_BACKEND', MPTTTree.name)
+    return TREE_BACKENDS[name]()
@@ -0,0 +1,328 @@
+"""
+Очередь входящих обновлений Telegram.
+Webhook проверяет и сохраняет обновление в базу данных и сразу отвечает
+Telegram, поэтому время ответа не зависит от обработчиков бота.
+Обработчики вызываются в фоне процессами команды consume_updates,
+каждый процесс забирает обновления пачками. Обновления распределяются
+между процессами по номеру чата, поэтому обновления одного чата
+обрабатываются одним процессом в порядке поступления
+"""
+import json
+import logging
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+from django_telegrambot.apps import DjangoTelegramBot
+from telegram import Update
+from telegram.utils.request import Request
+
+from .database import write_queue
+from .metrics import (Metrics, TimedRequest, export_metrics, load_metrics,
+                      metrics)
+from .models import QueuedUpdate
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_queue_options():
+    """
+    Функция возвращает настройку BOT_UPDATE_QUEUE
+    """
+    return getattr(settings, 'BOT_UPDATE_QUEUE', {})
+
+
+def get_bot_id(token):
+    """
+    Функция возвращает идентификатор бота из токена, сам токен
+    в базе данных не хранится
+    """
+    return token.split(':')[0]
+
+
+def get_dispatcher(bot_id):
+    """
+    Функция возвращает диспетчер бота по идентификатору или None
+    """
+    for token, dispatcher in zip(DjangoTelegramBot.bot_tokens,
+                                 DjangoTelegramBot.dispatchers):
+        if get_bot_id(token) == bot_id:
+            return dispatcher
+    return None
+
+
+def get_request_kwargs(token):
+    """
+    Функция возвращает параметры HTTP-клиента бота из REQUEST_KWARGS
+    его настройки в DJANGO_TELEGRAMBOT, как request_kwargs у Updater:
+    proxy_url, urllib3_proxy_kwargs, con_pool_size и таймауты
+    """
+    for options in settings.DJANGO_TELEGRAMBOT.get('BOTS', []):
+        if options.get('TOKEN') == token:
+            return dict(options.get('REQUEST_KWARGS') or {})
+    return {}
+
+
+def get_bots():
+    """
+    Функция возвращает ботов django_telegrambot, в том числе ботов
+    диспетчеров
+    """
+    bots = {id(bot): bot for bot in DjangoTelegramBot.bots}
+    bots.update((id(dispatcher.bot), dispatcher.bot)
+                for dispatcher in DjangoTelegramBot.dispatchers)
+    return list(bots.values())
+
+
+def set_bot_request(bot):
+    """
+    Функция создает боту HTTP-клиент по настройке. Учет времени
+    запросов, если он подключен, сохраняется
+    """
+    request = Request(**get_request_kwargs(bot.token))
+    if isinstance(bot._request, TimedRequest):
+        request = TimedRequest(request)
+    bot._request = request
+
+
+def configure_bot_requests():
+    """
+    Функция создает HTTP-клиенты ботам с REQUEST_KWARGS в настройке:
+    django_telegrambot создает ботов с клиентом по умолчанию
+    """
+    for bot in get_bots():
+        if get_request_kwargs(bot.token):
+            set_bot_request(bot)
+
+
+def reset_bot_requests():
+    """
+    Функция создает ботам новые HTTP-клиенты по настройке.
+    Вызывается в процессе, порожденном fork: пул соединений urllib3
+    родителя с его открытыми сокетами не должен использоваться
+    из нескольких процессов
+    """
+    for bot in get_bots():
+        set_bot_request(bot)
+
+
+# Поля обновления, содержащие сообщение с чатом
+MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post',
+                  'edited_channel_post')
+
+
+def get_chat_id(data):
+    """
+    Функция возвращает номер чата обновления без разбора всего
+    обновления. Для обновлений без чата используется номер
+    пользователя, 0 - если нет и его
+    """
+    values = [data[field] for field in MESSAGE_FIELDS
+              if isinstance(data.get(field), dict)]
+    values.extend(value for value in data.values()
+                  if isinstance(value, dict))
+    for value in values:
+        message = value.get('message', value)
+        if isinstance(message, dict) and isinstance(message.get('chat'),
+                                                    dict):
+            return message['chat'].get('id', 0)
+        if isinstance(value.get('from'), dict):
+            return value['from'].get('id', 0)
+    return 0
+
+
+def enqueue_update(bot_id, data):
+    """
+    Функция добавляет обновление в очередь. Повторно присланное
+    Telegram обновление пропускается, возвращает False
+    """
+    try:
+        with write_queue.write():
+            QueuedUpdate.objects.create(bot_id=bot_id,
+                                        update_id=data['update_id'],
+                                        chat_id=get_chat_id(data),
+                                        data=json.dumps(data))
+    except IntegrityError:
+        return False
+    return True
+
+
+def get_queue_depth():
+    """
+    Функция возвращает количество необработанных обновлений
+    """
+    return QueuedUpdate.objects.count()
+
+
+def get_consumer_metrics():
+    """
+    Функция собирает телеметрию, опубликованную процессами
+    consume_updates: время в очереди, глубину очереди и обработчики
+    """
+    merged = Metrics()
+    first = load_metrics('consumer:0')
+    if first is None:
+        return merged
+    for shard in range(first.get('shards', 1)):
+        exported = first if shard == 0 else load_metrics(
+            'consumer:{}'.format(shard)
+        )
+        if exported is not None:
+            merged.merge(exported['metrics'])
+    return merged
+
+
+class UpdateConsumer(object):
+    """
+    Класс обработчика очереди обновлений.
+    Обработчик с номером shard из shards берет только обновления чатов,
+    номер которых дает остаток shard при делении на shards.
+    Пачка обновлений помечается именем обработчика одним UPDATE,
+    поэтому несколько процессов не берут одно обновление дважды.
+    Обновления, взятые обработчиком, который не завершил их за
+    claim_timeout секунд, возвращаются в очередь. Раз в stats_interval
+    секунд обработчик замеряет глубину очереди и публикует телеметрию
+    в общем кэше
+    """
+    def __init__(self, batch_size=100, claim_timeout=300, shard=0, shards=1,
+                 dispatchers=None, stats_interval=10):
+        self.name = uuid.uuid4().hex
+        self.batch_size = batch_size
+        self.claim_timeout = timedelta(seconds=claim_timeout)
+        self.shard = shard
+        self.shards = shards
+        self.dispatchers = dispatchers
+        self.stats_interval = stats_interval
+        self.stopping = False
+        self._published = None
+
+    def claimable(self, stale):
+        """
+        Обновления, не взятые в обработку или взятые раньше stale
+        """
+        return QueuedUpdate.objects.filter(Q(owner='') | Q(claimed__lt=stale))
+
+    def pending(self, stale=None):
+        """
+        Необработанные обновления чатов этого обработчика. Обновление
+        не берется, пока более раннее обновление того же чата взято
+        другим обработчиком и не вернулось в очередь: после падения
+        обработчика его обновления дождутся возврата в очередь
+        и обработаются раньше более поздних
+        """
+        if stale is None:
+            stale = timezone.now() - self.claim_timeout
+        busy = QueuedUpdate.objects.filter(
+            chat_id=OuterRef('chat_id'), id__lt=OuterRef('id'),
+            claimed__gte=stale
+        ).exclude(owner='')
+        queryset = self.claimable(stale).annotate(
+            busy=Exists(busy)
+        ).filter(busy=False)
+        if self.shards > 1:
+            # Остаток от деления отрицательного номера чата в SQL
+            # отрицательный
+            queryset = queryset.annotate(
+                shard=F('chat_id') % self.shards
+            ).filter(shard__in=(self.shard, self.shard - self.shards))
+        return queryset
+
+    def get_dispatcher(self, bot_id):
+        if self.dispatchers is not None:
+            return self.dispatchers.get(bot_id)
+        return get_dispatcher(bot_id)
+
+    def claim(self):
+        """
+        Взятие пачки обновлений в обработку в порядке поступления
+        """
+        stale = timezone.now() - self.claim_timeout
+        ids = list(self.pending(stale).order_by('id').values_list(
+            'id', flat=True
+        )[:self.batch_size])
+        if not ids:
+            return []
+        # Проверка занятости чата здесь не повторяется: UPDATE видит
+        # уже взятые этим же запросом обновления пачки
+        self.claimable(stale).filter(id__in=ids).update(
+            owner=self.name, claimed=timezone.now()
+        )
+        return list(QueuedUpdate.objects.filter(
+            owner=self.name, id__in=ids
+        ).order_by('id'))
+
+    def process(self, queued):
+        """
+        Обработка пачки обновлений обработчиками бота и удаление
+        обработанных обновлений из очереди
+        """
+        for item in queued:
+            metrics.observe('queue:lag', (
+                timezone.now() - item.created
+            ).total_seconds() * 1000)
+            dispatcher = self.get_dispatcher(item.bot_id)
+            if dispatcher is None:
+                logger.error('Не найден бот для обновления %s', item)
+                continue
+            try:
+                update = Update.de_json(json.loads(item.data),
+                                        dispatcher.bot)
+                dispatcher.process_update(update)
+            except Exception:
+                logger.exception('Ошибка обработки обновления %s', item)
+        QueuedUpdate.objects.filter(
+            owner=self.name, id__in=[item.id for item in queued]
+        ).delete()
+
+    def publish_stats(self):
+        """
+        Замер глубины очереди и публикация телеметрии процесса не чаще
+        раза в stats_interval секунд
+        """
+        now = time.monotonic()
+        if (self._published is not None and
+                now - self._published < self.stats_interval):
+            return
+        self._published = now
+        metrics.observe('queue:depth', get_queue_depth())
+        # Телеметрия остановленного процесса со временем исчезает
+        export_metrics('consumer:{}'.format(self.shard),
+                       self.stats_interval * 10, shards=self.shards)
+
+    def run_once(self):
+        """
+        Обработка одной пачки, возвращает количество обновлений
+        """
+        self.publish_stats()
+        queued = self.claim()
+        if queued:
+            self.process(queued)
+        return len(queued)
+
+    def run(self, interval=0.5):
+        """
+        Обработка очереди до вызова stop(). Взятая пачка всегда
+        обрабатывается до конца
+        """
+        while not self.stopping:
+            if self.run_once() < self.batch_size and not self.stopping:
+                time.sleep(interval)
+
+    def drain(self):
+        """
+        Обработка очереди до опустошения
+        """
+        while not self.stopping and self.run_once() == self.batch_size:
+            pass
+
+    def stop(self, *args):
+        """
+        Остановка после обработки текущей пачки, подходит для
+        обработчика сигнала
+        """
+        self.stopping = True
@@ -1,3 +1,55 @@
-from django.shortcuts import render
+import json
+import logging
+import time
 
-# Create your views here.
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django_telegrambot import views as telegrambot_views
+from django_telegrambot.apps import DjangoTelegramBot
+
+from .metrics import metrics
+from .telegrambot import router
+from .updates import (enqueue_update, get_bot_id, get_consumer_metrics,
+                      get_queue_depth, get_queue_options)
+
+
+logger = logging.getLogger(__name__)
+
+
+@staff_member_required
+def stats(request):
+    """
+    Телеметрия обработчиков бота текущего процесса и процессов
+    очереди обновлений
+    """
+    return JsonResponse({
+        'metrics': metrics.snapshot(),
+        'consumers': get_consumer_metrics().snapshot(),
+        'routes': router.hit_counts(),
+        'queue_depth': get_queue_depth(),
+    }, json_dumps_params={'ensure_ascii': False})
+
+
+@csrf_exempt
+def webhook(request, bot_token):
+    """
+    Прием обновлений от Telegram. Если очередь обновлений включена,
+    обновление только сохраняется в очередь, иначе обрабатывается
+    сразу, как в django_telegrambot
+    """
+    if not get_queue_options().get('ENABLED'):
+        return telegrambot_views.webhook(request, bot_token)
+    started = time.perf_counter()
+    if DjangoTelegramBot.getBot(bot_id=bot_token, safe=False) is None:
+        logger.warning('Обновление для неизвестного бота')
+        return JsonResponse({})
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        int(data['update_id'])
+    except (ValueError, KeyError, TypeError):
+        logger.warning('Некорректное обновление: %r', request.body[:200])
+        return JsonResponse({})
+    enqueue_update(get_bot_id(bot_token), data)
+    metrics.observe('webhook', (time.perf_counter() - started) * 1000)
+    return JsonResponse({})
@@ -62,10 +62,161 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Подключения переиспользуются между запросами
+        'CONN_MAX_AGE': 600,
     }
 }
 
 
+# Настройка SQLite для одновременной работы потоков и процессов бота.
+# PRAGMAS выполняются при каждом подключении: журнал WAL позволяет
+# читать во время записи, busy_timeout - сколько миллисекунд запись ждет
+# снятия блокировки, synchronous=NORMAL - fsync только при переносе
+# журнала в базу, mmap_size - сколько байт базы читается через
+# отображение в память, cache_size - кэш страниц (отрицательное
+# значение - в килобайтах).
+# WRITE_QUEUE: пишущие транзакции потоков одного процесса выполняются
+# по очереди
+
+BOT_SQLITE = {
+    'PRAGMAS': {
+        'journal_mode': 'WAL',
+        'busy_timeout': 5000,
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -20000,
+    },
+    'WRITE_QUEUE': True,
+}
+
+
+# Cache
+# Общий для всех процессов бота кэш: через него процессы узнают
+# о сбросе закэшированных в памяти настроек и проектов
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    }
+}
+
+
+# Как часто процесс проверяет по общему кэшу, не сброшены ли данные,
+# закэшированные в его памяти, секунд. Изменение, сделанное в другом
+# процессе, становится видно не позже чем через это время
+
+BOT_CACHE_CHECK_INTERVAL = 1
+
+
+# Хранилище данных заказов и состояний диалогов.
+# BACKEND: 'memory' - в памяти процесса, 'db' - в базе данных, общее
+# для всех процессов и не теряется при перезапуске.
+# CACHE_SIZE: размер кэша в памяти перед базой данных, годится, только
+# если все обновления одного чата обрабатывает один процесс. Так
+# работает очередь обновлений BOT_UPDATE_QUEUE: чаты распределены между
+# процессами consume_updates. None - кэш на 100000 записей включается
+# только при включенной очереди, без нее каждое обновление читает
+# состояние из базы данных. С одним процессом webhook без очереди кэш
+# можно включить явно.
+# TTL: через сколько секунд бездействия диалог считается брошенным
+
+BOT_STATE_STORE = {
+    'BACKEND': 'db',
+    'CACHE_SIZE': None,
+    'TTL': 24 * 60 * 60,
+}
+
+
+# Ограничение частоты запросов одного чата.
+# RATE: сколько токенов в секунду получает чат, BURST: емкость ведра,
+# COSTS: стоимость запросов (команд, кнопок, префиксов inline-кнопок),
+# остальные запросы стоят 1 токен.
+# DUPLICATE_WINDOW: повтор того же сообщения в течение этого числа
+# секунд отбрасывается.
+# MAX_CHATS: сколько чатов хранить в памяти
+
+BOT_RATE_LIMIT = {
+    'RATE': 1.0,
+    'BURST': 10,
+    'COSTS': {
+        '/start': 5,
+        'Список приглашенных': 3,
+        'referrals': 3,
+    },
+    'DUPLICATE_WINDOW': 2,
+    'MAX_CHATS': 100000,
+}
+
+
+# Принимать реферальные ссылки со старыми кодами из поля refer_code.
+# Новые ссылки содержат id пригласившего с подписью и проверяются без
+# запроса к базе данных, старые ищутся по полю. Выключить, когда старые
+# ссылки перестанут использоваться
+
+BOT_LEGACY_REFER_CODES = True
+
+
+# Кэш пользователей по chat_id в памяти процесса.
+# MAX_SIZE: сколько пользователей хранить, давно не обращавшиеся
+# вытесняются, TTL: через сколько секунд пользователь перечитывается
+# из базы данных
+
+BOT_USER_CACHE = {
+    'MAX_SIZE': 100000,
+    'TTL': 10 * 60,
+}
+
+
+# Хранение дерева приглашений.
+# 'mptt' - регистрация пересчитывает поля lft/rght всего дерева,
+# 'closure' - регистрация добавляет только пользователя и его связи
+# с пригласившими до третьего уровня. В этом режиме поля tree_id,
+# lft и rght не поддерживаются при регистрации и пересобираются
+# командой rebuild_tree
+
+BOT_TREE_BACKEND = 'mptt'
+
+
+# Очередь входящих обновлений.
+# ENABLED: webhook сохраняет обновление в очередь и сразу отвечает
+# Telegram, обработчики вызываются командой consume_updates. По умолчанию
+# выключена: с включенной очередью команда consume_updates должна быть
+# запущена, иначе обновления копятся в базе и бот не отвечает.
+# WORKERS: количество процессов команды consume_updates, чаты
+# распределяются между процессами по номеру чата. Каждый процесс
+# создает HTTP-клиенты ботов заново по REQUEST_KWARGS настройки бота
+# в DJANGO_TELEGRAMBOT (proxy_url, urllib3_proxy_kwargs, con_pool_size,
+# таймауты), как request_kwargs у Updater,
+# BATCH_SIZE: сколько обновлений процесс берет за раз,
+# INTERVAL: пауза при пустой очереди, секунд.
+# CLAIM_TIMEOUT: через сколько секунд обновления, взятые упавшим
+# процессом, возвращаются в очередь.
+# STATS_INTERVAL: как часто процесс замеряет глубину очереди
+# и публикует телеметрию для /bot/stats/, секунд
+
+BOT_UPDATE_QUEUE = {
+    'ENABLED': False,
+    'WORKERS': 1,
+    'BATCH_SIZE': 100,
+    'INTERVAL': 0.5,
+    'CLAIM_TIMEOUT': 5 * 60,
+    'STATS_INTERVAL': 10,
+}
+
+
+# Рассылки командой broadcast.
+# RATE: сообщений в секунду на всех пользователей, общий лимит
+# Telegram - около 30, WORKERS: потоков отправки,
+# BATCH_SIZE: через сколько пользователей сохраняется прогресс
+
+BOT_BROADCAST = {
+    'RATE': 25,
+    'WORKERS': 8,
+    'BATCH_SIZE': 500,
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -107,6 +258,13 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Журнал пишется строками JSON в фоновом потоке (bot.logs). В файл
+# пишут все процессы бота, поэтому его вращает по размеру logrotate
+# (пример в logrotate.conf, без copytruncate), обработчик сам
+# открывает новый файл после вращения.
+# Отладочные сообщения с одним шаблоном прореживаются: пишется каждое
+# every-е, в записи указывается поле sampled
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -117,13 +275,23 @@ LOGGING = {
         'simple': {
             'format': '%(levelname)s %(message)s'
         },
+        'json': {
+            '()': 'bot.logs.JsonFormatter',
+        },
+    },
+    'filters': {
+        'sample_debug': {
+            '()': 'bot.logs.SamplingFilter',
+            'every': 100,
+        },
     },
     'handlers': {
         'file': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            'class': 'bot.logs.AsyncFileHandler',
             'filename': os.path.join(BASE_DIR, 'telebot.log'),
-            'formatter': 'verbose',
+            'formatter': 'json',
+            'filters': ['sample_debug'],
         },
     },
     'loggers': {
@@ -132,11 +300,7 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
-        'bot.telegrambot': {
-            'handlers': ['file'],
-            'level': 'DEBUG',
-        },
-        'bot.tasks': {
+        'bot': {
             'handlers': ['file'],
             'level': 'DEBUG',
         },
@@ -13,10 +13,28 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
+import re
+
+from django.conf import settings
 from django.conf.urls import url, include
 from django.contrib import admin
 
+from bot import views as bot_views
+
+# Адрес webhook тот же, что у django_telegrambot, обработчик бота
+# складывает обновления в очередь
+webhook_prefix = re.escape(
+    settings.DJANGO_TELEGRAMBOT.get('WEBHOOK_PREFIX', '/').strip('/')
+)
+if webhook_prefix:
+    webhook_prefix += '/+'
+
 urlpatterns = [
-    url(r'^', include('django_telegrambot.urls')),
+    # Адрес webhook django_telegrambot не привязан к началу пути и
+    # перехватывает вложенные адреса админки, поэтому она идет раньше
     url(r'^admin/', admin.site.urls),
+    url(r'^bot/stats/$', bot_views.stats, name='bot-stats'),
+    url(r'^[/]*{}(?P<bot_token>\d+:[\w-]+)/$'.format(webhook_prefix),
+        bot_views.webhook, name='bot-webhook'),
+    url(r'^', include('django_telegrambot.urls')),
 ]